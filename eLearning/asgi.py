@@ -3,16 +3,20 @@
 import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-from channels.auth import AuthMiddlewareStack
-import eLearningApp.routing
 
 #  settings module for the 'django' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'eLearning.settings')
 
+# Initialize Django before importing the consumers, which use the models
+django_asgi_app = get_asgi_application()
+
+from channels.auth import AuthMiddlewareStack
+import eLearningApp.routing
+
 # the ASGI application to handle different types of connections.
 application = ProtocolTypeRouter({
     # HTTP protocol uses Django's ASGI application.
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     
     # WebSocket protocol is handled by Channels
     "websocket": AuthMiddlewareStack(
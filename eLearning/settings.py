@@ -11,6 +11,27 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
+# Transactional mail (enrollments, digests) has its own queue so bulk announcements never delay it,
+# run `celery -A eLearning worker -Q transactional,default,bulk` or separate workers per queue
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'eLearningApp.tasks.send_enrollment_notification': {'queue': 'transactional'},
+    'eLearningApp.tasks.send_bulk_enrollment_notification': {'queue': 'transactional'},
+    'eLearningApp.tasks.send_notification_digest': {'queue': 'transactional'},
+    'eLearningApp.tasks.send_material_notification': {'queue': 'bulk'},
+    'eLearningApp.tasks.send_material_email_batch': {'queue': 'bulk'},
+    'eLearningApp.tasks.fan_out_material_notification': {'queue': 'bulk'},
+    'eLearningApp.tasks.fan_out_activity': {'queue': 'bulk'},
+    'eLearningApp.tasks.trim_activity_feeds': {'queue': 'bulk'},
+}
+# A worker consuming several queues on Redis empties them in the order given to -Q
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}
+# Tasks are acknowledged once finished so the tasks of a crashed worker are delivered again,
+# and each worker process only reserves the task it is running
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('SECRET_KEY', 'django-insecure-z80lp)wwlm79qst8q30icvm9gcefdj1cy!$_$4=%36!tylsq&t')
 
@@ -70,12 +91,46 @@ ASGI_APPLICATION = 'eLearning.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default, PostgreSQL when DB_ENGINE=postgresql
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'elearning'),
+            'USER': os.getenv('DB_USER', 'elearning'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', '127.0.0.1'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            # Reuse connections across requests and check them before reuse
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+            },
+        }
+    }
+    # Pooled mode, connecting through a transaction pooler such as PgBouncer
+    # The pooler owns the server connections, so Django closes its side after each request
+    # (the ASGI server runs sync views in worker threads that would otherwise each hold one)
+    # and server side cursors, which do not survive transaction pooling, are disabled
+    if os.getenv('DB_POOLED', 'False') == 'True':
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            # Tests use an in-memory database unless a file is given, which the concurrency tests need
+            'TEST': {'NAME': os.getenv('DB_TEST_NAME') or None},
+            'OPTIONS': {
+                # Wait for the write lock instead of failing right away under concurrent writes
+                'timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '20')),
+            },
+        }
     }
-}
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -100,9 +155,18 @@ AUTH_USER_MODEL = 'eLearningApp.CustomUser'
 
 # Authentication Backends
 AUTHENTICATION_BACKENDS = [
-    'django.contrib.auth.backends.ModelBackend',
+    'eLearningApp.backends.CachedPermissionBackend',
 ]
 
+# Cache alias and lifetime of the per-user permission sets kept by CachedPermissionBackend
+PERMISSION_CACHE_ALIAS = 'default'
+PERMISSION_CACHE_TIMEOUT = int(os.getenv('PERMISSION_CACHE_TIMEOUT', '3600'))
+
+# Cache alias and lifetime of the authenticated user rows kept by CachedPermissionBackend,
+# dropped whenever the user is saved
+USER_CACHE_ALIAS = 'default'
+USER_CACHE_TIMEOUT = int(os.getenv('USER_CACHE_TIMEOUT', '300'))
+
 # Secure Proxy
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
@@ -126,6 +190,28 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Course material downloads: bytes per streamed chunk and optional offloading to the front proxy
+# MATERIAL_DOWNLOAD_OFFLOAD is '' (stream from Django), 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd)
+MATERIAL_DOWNLOAD_CHUNK_SIZE = int(os.getenv('MATERIAL_DOWNLOAD_CHUNK_SIZE', str(64 * 1024)))
+MATERIAL_DOWNLOAD_OFFLOAD = os.getenv('MATERIAL_DOWNLOAD_OFFLOAD', '')
+# Internal nginx location mapped to MEDIA_ROOT, used with X-Accel-Redirect
+MATERIAL_ACCEL_REDIRECT_PREFIX = os.getenv('MATERIAL_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+
+# Profile photos: longest side of the stored photo, edge of the square thumbnails in pixels
+# and the format they are encoded in ('WEBP' or 'JPEG')
+PROFILE_PHOTO_MAX_SIZE = int(os.getenv('PROFILE_PHOTO_MAX_SIZE', '1024'))
+PROFILE_THUMBNAIL_SIZES = {'small': 64, 'large': 300}
+PROFILE_PHOTO_FORMAT = os.getenv('PROFILE_PHOTO_FORMAT', 'WEBP')
+PROFILE_PHOTO_QUALITY = int(os.getenv('PROFILE_PHOTO_QUALITY', '85'))
+
+# Chunked material uploads: partial files are kept outside MEDIA_ROOT until finalized,
+# preferably on the same filesystem so finalizing moves the file instead of copying it
+MATERIAL_UPLOAD_TEMP_DIR = os.getenv('MATERIAL_UPLOAD_TEMP_DIR', os.path.join(BASE_DIR, 'uploads'))
+MATERIAL_UPLOAD_CHUNK_SIZE = int(os.getenv('MATERIAL_UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+MATERIAL_UPLOAD_MAX_SIZE = int(os.getenv('MATERIAL_UPLOAD_MAX_SIZE', str(20 * 1024 ** 3)))
+# Seconds after which the claim of a chunk write that never finished can be taken over
+MATERIAL_UPLOAD_CLAIM_TIMEOUT = int(os.getenv('MATERIAL_UPLOAD_CLAIM_TIMEOUT', '3600'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -136,12 +222,56 @@ LOGIN_URL = '/'
 
 API_BASE_URL = '/api'
 
+# Number of rows per page for the cursor paginated listings (courses, feedback, status updates)
+LISTING_PAGE_SIZE = int(os.getenv('LISTING_PAGE_SIZE', '20'))
+LISTING_MAX_PAGE_SIZE = int(os.getenv('LISTING_MAX_PAGE_SIZE', '100'))
+
+# Page size of the user API, larger as it is read by admin tools and exports
+USER_API_PAGE_SIZE = int(os.getenv('USER_API_PAGE_SIZE', '100'))
+USER_API_MAX_PAGE_SIZE = int(os.getenv('USER_API_MAX_PAGE_SIZE', '1000'))
+
 # Checking if the app is hosted or not
 IS_HOSTED_ENV = os.getenv('IS_HOSTED_ENV', 'False') == 'True'
 
 # Set Redis host based on the environment
 REDIS_HOST = '128.199.94.95' if IS_HOSTED_ENV else '127.0.0.1'
 
+# Cache shared by all workers, stored in Redis when enabled (always in the hosted environment)
+USE_REDIS_CACHE = os.getenv('USE_REDIS_CACHE', str(IS_HOSTED_ENV)) == 'True'
+
+if USE_REDIS_CACHE:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': f'redis://{REDIS_HOST}:6379/1',
+        },
+        # Separate database so sessions are not evicted by or flushed with the page caches
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': f'redis://{REDIS_HOST}:6379/3',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'sessions',
+        },
+    }
+
+# Sessions are read from the cache, cached_db also writes them to the database so they survive
+# a cache flush, set SESSION_ENGINE=django.contrib.sessions.backends.cache to skip the database entirely
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
+SESSION_CACHE_ALIAS = 'sessions'
+
+# Rendered page fragments (course header, materials, roster, status feed), see eLearningApp/fragments.py
+FRAGMENT_CACHE_TIMEOUT = int(os.getenv('FRAGMENT_CACHE_TIMEOUT', '3600'))
+# Count fragment cache hits and misses in the cache for monitoring
+FRAGMENT_CACHE_STATS = os.getenv('FRAGMENT_CACHE_STATS', 'True') == 'True'
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -150,3 +280,71 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Number of users notified per batch when fanning out real-time notifications
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', '500'))
+
+# Number of unread notifications replayed to a user when their notification socket connects
+NOTIFICATION_REPLAY_LIMIT = int(os.getenv('NOTIFICATION_REPLAY_LIMIT', '50'))
+
+# Seconds the unread notification count of a user is cached
+NOTIFICATION_UNREAD_CACHE_TIMEOUT = int(os.getenv('NOTIFICATION_UNREAD_CACHE_TIMEOUT', '60'))
+
+# Enrollment notifications of teachers who chose digests are sent every NOTIFICATION_DIGEST_WINDOW seconds
+NOTIFICATION_DIGEST_WINDOW = int(os.getenv('NOTIFICATION_DIGEST_WINDOW', '900'))
+
+# Transactional outbox: side effects recorded with the change causing them and relayed to the broker
+# every OUTBOX_RELAY_INTERVAL seconds, failed dispatches are retried with a backoff of up to OUTBOX_MAX_BACKOFF seconds
+OUTBOX_RELAY_INTERVAL = float(os.getenv('OUTBOX_RELAY_INTERVAL', '1.0'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+OUTBOX_MAX_BACKOFF = int(os.getenv('OUTBOX_MAX_BACKOFF', '300'))
+# Dispatched messages are kept this many seconds to deduplicate repeated side effects
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', '86400'))
+# Seconds messages that failed OUTBOX_MAX_ATTEMPTS times are kept for inspection and requeueing
+OUTBOX_FAILED_RETENTION = int(os.getenv('OUTBOX_FAILED_RETENTION', str(7 * 86400)))
+
+# Periodic tasks run by `celery -A eLearning beat`
+CELERY_BEAT_SCHEDULE = {
+    'flush-notification-digests': {
+        'task': 'eLearningApp.tasks.flush_notification_digests',
+        'schedule': NOTIFICATION_DIGEST_WINDOW,
+    },
+    'relay-outbox': {
+        'task': 'eLearningApp.tasks.relay_outbox',
+        'schedule': OUTBOX_RELAY_INTERVAL,
+    },
+    'trim-activity-feeds': {
+        'task': 'eLearningApp.tasks.trim_activity_feeds',
+        'schedule': 3600,
+    },
+}
+
+# Number of recipients per new material email batch, each batch uses one mail connection
+MATERIAL_EMAIL_BATCH_SIZE = int(os.getenv('MATERIAL_EMAIL_BATCH_SIZE', '100'))
+
+# Number of roster entries resolved and inserted per batch by bulk enrollment
+ENROLLMENT_BATCH_SIZE = int(os.getenv('ENROLLMENT_BATCH_SIZE', '1000'))
+
+# Chat history: Redis ring buffer replayed on join (empty URL disables it) and batched database writes
+CHAT_REDIS_URL = os.getenv('CHAT_REDIS_URL', f'redis://{REDIS_HOST}:6379/2')
+CHAT_HISTORY_SIZE = int(os.getenv('CHAT_HISTORY_SIZE', '50'))
+CHAT_WRITE_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BATCH_SIZE', '100'))
+CHAT_WRITE_INTERVAL = float(os.getenv('CHAT_WRITE_INTERVAL', '1.0'))
+# Unsaved messages kept in memory for the next flush while the database is failing
+CHAT_WRITE_MAX_PENDING = int(os.getenv('CHAT_WRITE_MAX_PENDING', '10000'))
+
+# Chat presence: heartbeat lifetime of a roster entry and window over which joins/leaves are coalesced
+CHAT_PRESENCE_TTL = int(os.getenv('CHAT_PRESENCE_TTL', '60'))
+CHAT_PRESENCE_INTERVAL_MS = int(os.getenv('CHAT_PRESENCE_INTERVAL_MS', '1000'))
+
+# Activity feed: per-user timelines in Redis sorted sets (empty URL reads them from the database),
+# capped to FEED_TIMELINE_SIZE events and filled FEED_FANOUT_BATCH_SIZE users at a time
+FEED_REDIS_URL = os.getenv('FEED_REDIS_URL', f'redis://{REDIS_HOST}:6379/4')
+FEED_TIMELINE_SIZE = int(os.getenv('FEED_TIMELINE_SIZE', '500'))
+FEED_FANOUT_BATCH_SIZE = int(os.getenv('FEED_FANOUT_BATCH_SIZE', '1000'))
+
+# Chat access: lifetime of cached course membership checks and per-connection message rate limit
+CHAT_MEMBERSHIP_CACHE_TIMEOUT = int(os.getenv('CHAT_MEMBERSHIP_CACHE_TIMEOUT', '300'))
+CHAT_RATE_LIMIT = float(os.getenv('CHAT_RATE_LIMIT', '2'))
+CHAT_RATE_BURST = int(os.getenv('CHAT_RATE_BURST', '10'))
@@ -1,23 +1,44 @@
 from django.contrib import admin
-from .models import CustomUser, Course, Enrollment, Feedback, CourseMaterial
+from django.db.models import Q
+from .models import CustomUser, Course, Enrollment, Feedback, CourseMaterial, ChatMessage, SearchTerm
+from .search import ranked_ids
+
+# Admin search through the search index instead of LIKE '%term%' scans over joined text columns
+# search_index maps a lookup to the kind of indexed object it holds, e.g. {'instructor': SearchTerm.USER},
+# search_fields only lists what the index covers, plus any unindexed field named in text_search_fields
+class IndexedSearchMixin:
+    search_index = {}
+    text_search_fields = ()
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        condition = Q()
+        for lookup, kind in self.search_index.items():
+            condition |= Q(**{f'{lookup}__in': ranked_ids(kind, search_term)})
+        for field in self.text_search_fields:
+            condition |= Q(**{f'{field}__icontains': search_term})
+        return queryset.filter(condition), False
 
 # Custom admin configuration for CustomUser model
-class CustomUserAdmin(admin.ModelAdmin):
+class CustomUserAdmin(IndexedSearchMixin, admin.ModelAdmin):
     # Fields to display in the admin list view
     list_display = ('username', 'email', 'full_name', 'role', 'is_active')
     # Filters available in the admin list view
     list_filter = ('role', 'is_active', 'date_joined')
-    # Fields to search in the admin list view
+    # Fields to search in the admin list view, through the search index
     search_fields = ('username', 'email', 'full_name')
+    search_index = {'pk': SearchTerm.USER}
    
     ordering = ('-date_joined',)
 
 
-class CourseAdmin(admin.ModelAdmin):
+class CourseAdmin(IndexedSearchMixin, admin.ModelAdmin):
     # Fields to display in the admin list view
-    list_display = ('title', 'instructor', 'description')
-    # Fields to search in the admin list view
+    list_display = ('title', 'instructor', 'description', 'enrollment_count', 'feedback_count', 'material_count')
+    # Fields to search in the admin list view, through the search index
     search_fields = ('title', 'description', 'instructor__username', 'instructor__full_name')
+    search_index = {'pk': SearchTerm.COURSE, 'instructor': SearchTerm.USER}
     # Filters available in the admin list view
     list_filter = ('instructor',)
     
@@ -35,11 +56,13 @@ class EnrollmentAdmin(admin.ModelAdmin):
     ordering = ('-date_enrolled',)
 
 # Custom admin configuration for Feedback model
-class FeedbackAdmin(admin.ModelAdmin):
+class FeedbackAdmin(IndexedSearchMixin, admin.ModelAdmin):
     # Fields to display in the admin list view
     list_display = ('course', 'student', 'text', 'created_at')
-    # Fields to search in the admin list view
+    # Fields to search in the admin list view, the student and course through the search index
     search_fields = ('student__username', 'student__full_name', 'course__title', 'text')
+    search_index = {'student': SearchTerm.USER, 'course': SearchTerm.COURSE}
+    text_search_fields = ('text',)
     # Filters available in the admin list view
     list_filter = ('course', 'student', 'created_at')
     
@@ -56,9 +79,21 @@ class CourseMaterialAdmin(admin.ModelAdmin):
     
     ordering = ('course', 'name')
 
+# Custom admin configuration for ChatMessage model
+class ChatMessageAdmin(admin.ModelAdmin):
+    # Fields to display in the admin list view
+    list_display = ('room', 'author', 'text', 'created_at')
+    # Fields to search in the admin list view
+    search_fields = ('room', 'author__username', 'text')
+    # Filters available in the admin list view
+    list_filter = ('room',)
+
+    ordering = ('-id',)
+
 # Registering models with their respective custom admin configurations
 admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Course, CourseAdmin)
 admin.site.register(Enrollment, EnrollmentAdmin)
 admin.site.register(Feedback, FeedbackAdmin)
 admin.site.register(CourseMaterial, CourseMaterialAdmin)
+admin.site.register(ChatMessage, ChatMessageAdmin)
@@ -10,6 +10,35 @@ router.register(r'users', views.CustomUserViewSet, basename='users')
 
 # Define the URL patterns for the API
 urlpatterns = [
-   
+    # Cursor paginated listings
+    path('courses/', views.CourseListAPIView.as_view(), name='api_courses'),
+    path('courses/<int:course_id>/feedback/', views.CourseFeedbackListAPIView.as_view(), name='api_course_feedback'),
+    path('users/<str:username>/statuses/', views.UserStatusListAPIView.as_view(), name='api_user_statuses'),
+    path('courses/<int:course_id>/chat/messages/', views.ChatMessageListAPIView.as_view(), name='api_chat_messages'),
+
+    # Idempotent enrollment of the current user and roster import for course teachers
+    path('courses/<int:course_id>/enrollment/', views.EnrollmentAPIView.as_view(), name='api_enrollment'),
+    path('courses/<int:course_id>/enrollments/bulk/', views.BulkEnrollmentAPIView.as_view(), name='api_bulk_enrollment'),
+
+    # Chunked, resumable material uploads
+    path('courses/<int:course_id>/uploads/', views.MaterialUploadStartAPIView.as_view(), name='api_upload_start'),
+    path('uploads/<uuid:upload_id>/', views.MaterialUploadAPIView.as_view(), name='api_upload'),
+    path('uploads/<uuid:upload_id>/finalize/', views.MaterialUploadFinalizeAPIView.as_view(), name='api_upload_finalize'),
+
+    # Notification inbox of the current user
+    path('notifications/', views.NotificationListAPIView.as_view(), name='api_notifications'),
+    path('notifications/unread-count/', views.NotificationUnreadCountAPIView.as_view(), name='api_notifications_unread_count'),
+    path('notifications/read/', views.NotificationReadAPIView.as_view(), name='api_notifications_read'),
+
+    # Activity feed of the current user
+    path('feed/', views.ActivityFeedAPIView.as_view(), name='api_feed'),
+
+    # Fragment cache and Celery task monitoring for staff
+    path('cache/stats/', views.FragmentCacheStatsAPIView.as_view(), name='api_cache_stats'),
+    path('tasks/metrics/', views.TaskMetricsAPIView.as_view(), name='api_task_metrics'),
+
+    # Ranked search of users and courses
+    path('search/', views.SearchAPIView.as_view(), name='api_search'),
+
     path('', include(router.urls)),
 ]
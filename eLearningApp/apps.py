@@ -6,3 +6,4 @@ class ElearningappConfig(AppConfig):
 
     def ready(self):
         import eLearningApp.signals
+        import eLearningApp.metrics
@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+
+# Cache key holding the set of permission names of a user
+def permission_cache_key(user_id):
+    return f'perms:{user_id}'
+
+
+# Forget the cached permissions of the given users
+# Accepts user ids or user instances, the in-memory copies on instances are dropped too
+def invalidate_permission_cache(*users):
+    keys = []
+    for user in users:
+        user_id = getattr(user, 'pk', user)
+        keys.append(permission_cache_key(user_id))
+        for attr in ('_perm_cache', '_user_perm_cache', '_group_perm_cache'):
+            if hasattr(user, attr):
+                delattr(user, attr)
+    caches[settings.PERMISSION_CACHE_ALIAS].delete_many(keys)
+
+
+# Cache key holding the row of an authenticated user
+def user_cache_key(user_id):
+    return f'user:{user_id}'
+
+
+# Forget the cached rows of the given users, accepts user ids or user instances
+def invalidate_user_cache(*users):
+    caches[settings.USER_CACHE_ALIAS].delete_many([user_cache_key(getattr(user, 'pk', user)) for user in users])
+
+
+# Authentication backend that keeps each user's row and permission set in the shared cache
+# ModelBackend only caches permissions on the user instance, which lives for one request,
+# so every page view would reload them through user_permissions and groups
+class CachedPermissionBackend(ModelBackend):
+    # Load the user of a session, called on every authenticated request and WebSocket handshake
+    def get_user(self, user_id):
+        cache = caches[settings.USER_CACHE_ALIAS]
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            UserModel = get_user_model()
+            try:
+                user = UserModel._default_manager.get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            cache = caches[settings.PERMISSION_CACHE_ALIAS]
+            key = permission_cache_key(user_obj.pk)
+            perms = cache.get(key)
+            if perms is None:
+                perms = super().get_all_permissions(user_obj)
+                cache.set(key, perms, settings.PERMISSION_CACHE_TIMEOUT)
+            user_obj._perm_cache = perms
+        return user_obj._perm_cache
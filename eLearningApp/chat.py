@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+import msgpack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import Q
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from .models import ChatMessage, Course
+
+logger = logging.getLogger(__name__)
+
+# Redis clients are bound to the event loop that created them
+_redis_clients = weakref.WeakKeyDictionary()
+
+
+# Return the Redis client used by the chat for the running event loop, or None when disabled
+def get_redis():
+    if not settings.CHAT_REDIS_URL:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _redis_clients.get(loop)
+    if client is None:
+        client = aioredis.Redis.from_url(settings.CHAT_REDIS_URL)
+        _redis_clients[loop] = client
+    return client
+
+
+# Name of the channel layer group of a chat room
+def room_group_name(room):
+    return f'chat_{room}'
+
+
+# Cache key remembering whether a user may join the chat room of a course
+def membership_cache_key(course_id, user_id):
+    return f'chat:member:{course_id}:{user_id}'
+
+
+# Return whether the user teaches or is enrolled in the course, caching the answer
+def is_course_member(user, course_id):
+    key = membership_cache_key(course_id, user.pk)
+    member = cache.get(key)
+    if member is None:
+        member = Course.objects.filter(
+            Q(instructor=user) | Q(enrollments__student=user), pk=course_id
+        ).exists()
+        cache.set(key, member, settings.CHAT_MEMBERSHIP_CACHE_TIMEOUT)
+    return member
+
+
+# Async version of is_course_member used once per chat connection
+is_room_member = database_sync_to_async(is_course_member)
+
+
+# Token bucket limiting how many frames a chat connection may send
+# Holds up to `capacity` tokens, refilled at `rate` tokens per second, one token per frame
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Redis key of the ring buffer holding the latest messages of a room
+def history_key(room):
+    return f'chat:history:{room}'
+
+
+# Structured chat message event as sent to clients
+# The timestamp is in epoch milliseconds so clients can format it in their own time zone
+def chat_event(message_id, user, text, created_at):
+    return {
+        'type': 'chat.message',
+        'id': str(message_id),
+        'user_id': user.pk,
+        'username': user.username,
+        'text': text,
+        'ts': int(created_at.timestamp() * 1000),
+    }
+
+
+# Event of a stored chat message
+def message_event(message):
+    return chat_event(message.uid, message.author, message.text, message.created_at)
+
+
+# Encode an event once for both wire formats, as compact JSON text and as msgpack bytes
+def encode_event(event):
+    return json.dumps(event, separators=(',', ':')), msgpack.packb(event)
+
+
+# Push an encoded message onto the room's ring buffer, keeping only the last CHAT_HISTORY_SIZE entries
+async def remember_message(room, encoded_text):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.lpush(history_key(room), encoded_text)
+            pipe.ltrim(history_key(room), 0, settings.CHAT_HISTORY_SIZE - 1)
+            await pipe.execute()
+    except (RedisError, OSError):
+        logger.warning('Could not store chat history for room %s', room, exc_info=True)
+
+
+# Load the latest messages of a room from the database as encoded JSON events, oldest first
+@database_sync_to_async
+def _history_from_database(room, limit):
+    messages = ChatMessage.objects.filter(room=room).select_related('author').order_by('-id')[:limit]
+    return [encode_event(message_event(message))[0] for message in reversed(messages)]
+
+
+# Return the latest messages of a room as encoded JSON events, oldest first
+# Served from the Redis ring buffer, falling back to the database when it is empty or unreachable
+async def recent_messages(room, limit=None):
+    limit = limit or settings.CHAT_HISTORY_SIZE
+    client = get_redis()
+    if client is not None:
+        try:
+            entries = await client.lrange(history_key(room), 0, limit - 1)
+            if entries:
+                return [entry.decode() for entry in reversed(entries)]
+        except (RedisError, OSError):
+            logger.warning('Could not read chat history for room %s', room, exc_info=True)
+    return await _history_from_database(room, limit)
+
+
+# Save chat messages one at a time after their batch failed, returning (saved, messages to retry)
+# A message the database refuses is dropped. Any other database error stops here, and the message
+# with the ones after it are retried by the next flush
+def _save_one_by_one(messages):
+    saved = 0
+    for position, message in enumerate(messages):
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+        except IntegrityError:
+            logger.exception('Dropping chat message %s that cannot be saved', message.uid)
+        except DatabaseError:
+            retry = messages[position:]
+            logger.warning('Could not save %d chat messages, retrying them later', len(retry), exc_info=True)
+            for message in retry:
+                message.pk = None
+            return saved, retry
+        else:
+            saved += 1
+    return saved, []
+
+
+# Collects chat messages and writes them to the database in batches
+# Messages are flushed once CHAT_WRITE_BATCH_SIZE are pending or CHAT_WRITE_INTERVAL seconds
+# after the first pending one, so the consumer never waits on an INSERT per message
+class ChatMessageWriter:
+    def __init__(self):
+        self.pending = []
+        self.flush_handle = None
+        self.flush_loop = None
+        self.flush_tasks = set()
+        # Set while messages of a failed flush wait for the next one, which then waits CHAT_WRITE_INTERVAL
+        self.retrying = False
+
+    def add(self, message):
+        self.pending.append(message)
+        if len(self.pending) >= settings.CHAT_WRITE_BATCH_SIZE and not self.retrying:
+            self.schedule(0)
+        elif not self.flush_scheduled():
+            self.schedule(settings.CHAT_WRITE_INTERVAL)
+
+    def flush_scheduled(self):
+        # A timer left behind on another (closed) event loop will never fire
+        return (
+            self.flush_handle is not None
+            and not self.flush_handle.cancelled()
+            and self.flush_loop is asyncio.get_running_loop()
+        )
+
+    def schedule(self, delay):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush_loop = asyncio.get_running_loop()
+        self.flush_handle = self.flush_loop.call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        # Keep a reference to the task so it is not garbage collected while running
+        task = asyncio.ensure_future(self.flush())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            await database_sync_to_async(ChatMessage.objects.bulk_create)(batch)
+            self.retrying = False
+            return len(batch)
+        except Exception:
+            logger.warning('Could not save %d chat messages in one batch, saving them one by one', len(batch), exc_info=True)
+        saved, retry = await database_sync_to_async(_save_one_by_one)(batch)
+        self.retrying = bool(retry)
+        if retry:
+            self.requeue(retry)
+        return saved
+
+    # Put messages that could not be saved back ahead of the newer ones for the next flush
+    # At most CHAT_WRITE_MAX_PENDING messages are kept while the database is unavailable
+    def requeue(self, messages):
+        self.pending = messages + self.pending
+        overflow = len(self.pending) - settings.CHAT_WRITE_MAX_PENDING
+        if overflow > 0:
+            logger.error('Dropping the %d oldest unsaved chat messages', overflow)
+            del self.pending[:overflow]
+        if not self.flush_scheduled():
+            self.schedule(settings.CHAT_WRITE_INTERVAL)
+
+
+# Writer shared by every chat consumer of the process
+message_writer = ChatMessageWriter()
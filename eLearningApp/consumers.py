@@ -1,12 +1,21 @@
 import json
+import time
+import uuid
+import msgpack
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from datetime import datetime
+from django.utils import timezone
+from django.conf import settings
+from .chat import message_writer, chat_event, encode_event, remember_message, recent_messages, room_group_name, is_room_member, TokenBucket
+from .presence import presence, mark_present, roster
+from .models import ChatMessage
+from .notifications import notification_group_name, notification_event, unread_backlog
 
 # Notification Consumer for enrolled students and teachers
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):  
         # Create a unique group name for the user based on their username
-        self.user_group_name = f'notifications_{self.scope["user"].username}'
+        self.user_group_name = notification_group_name(self.scope["user"].username)
 
         # Add this WebSocket connection to the group
         await self.channel_layer.group_add(
@@ -17,6 +26,13 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         # Accept the WebSocket connection
         await self.accept()
 
+        # Replay the unread notifications sent while the user was offline
+        if self.scope["user"].is_authenticated:
+            for notification in await database_sync_to_async(unread_backlog)(self.scope["user"].pk):
+                event = notification_event(notification)
+                del event['type']
+                await self.send(text_data=json.dumps({**event, 'replayed': True}))
+
     async def disconnect(self, close_code):
         # Remove this WebSocket connection from the group when disconnected
         await self.channel_layer.group_discard(
@@ -30,66 +46,126 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         message = event['message']
 
         await self.send(text_data=json.dumps({
+            'id': event.get('id'),
             'message': message,
-            'notification_type': notification_type
+            'notification_type': notification_type,
+            'ts': event.get('ts'),
         }))
 
+# Subprotocol a chat client can request to receive msgpack binary frames instead of JSON text
+MSGPACK_SUBPROTOCOL = 'msgpack'
+
 # Chat consumer for the room chat in each course
+# Every event is encoded once by the sender and forwarded as is to all members of the room
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        # Retrieve the room name from the URL route parameters
-        self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = 'chat_%s' % self.room_name
+        # Each chat room belongs to a course, identified in the URL route parameters
+        self.course_id = int(self.scope['url_route']['kwargs']['course_id'])
+        self.room_name = str(self.course_id)
+        self.room_group_name = room_group_name(self.room_name)
+        self.joined = False
+
+        # Reject anonymous users and users who neither teach nor attend the course
+        # before they take a place in the channel layer group
+        user = self.scope['user']
+        if not user.is_authenticated:
+            await self.close(code=4401)
+            return
+        if not await is_room_member(user, self.course_id):
+            await self.close(code=4403)
+            return
+
+        # Limit how fast this connection can push messages into the room
+        self.rate_limiter = TokenBucket(settings.CHAT_RATE_LIMIT, settings.CHAT_RATE_BURST)
 
         # Add this WebSocket connection to the chat room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        # Accept the WebSocket connection
-        await self.accept()
+        # Accept the WebSocket connection, agreeing on msgpack when the client asked for it
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
 
-        # Notify the chat room that a new user has joined
-        username = self.scope['user'].username 
-        join_message = f"{username} has joined the chat room."
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': join_message
-            }
-        )
+        # Replay the latest messages of the room to this connection only
+        for encoded_text in await recent_messages(self.room_name):
+            await self.send_encoded(encoded_text)
+
+        # Announce the new member in the room's next coalesced presence delta
+        await presence.join(self.room_name, user.username)
+        self.joined = True
 
     async def disconnect(self, close_code):
+        # Nothing to clean up for connections rejected at connect
+        if not self.joined:
+            return
         # Remove this WebSocket connection from the chat room group when disconnected
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await presence.leave(self.room_name, self.scope['user'].username)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Drop frames beyond the connection's rate limit to protect the room fan-out
+        if not self.rate_limiter.consume():
+            encoded_text, encoded_bytes = encode_event({'type': 'error', 'code': 'rate_limited'})
+            await self.send_encoded(encoded_text, encoded_bytes)
+            return
+
+        # Receive a message from the WebSocket client, as msgpack bytes or JSON text
+        try:
+            data = msgpack.unpackb(bytes_data) if bytes_data is not None else json.loads(text_data)
+            message_type = data.get('type', 'chat.message')
+            text = data.get('text', data.get('message'))
+        except (ValueError, AttributeError, msgpack.UnpackException):
+            return
+        user = self.scope['user']
 
-    async def receive(self, text_data):
-        # Receive a message from the WebSocket client
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        username = self.scope['user'].username
+        # Heartbeats keep the user in the room's roster
+        if message_type == 'heartbeat':
+            await mark_present(self.room_name, user.username)
+            return
+        # Presence queries are answered to this connection only
+        if message_type == 'presence':
+            encoded_text, encoded_bytes = encode_event({
+                'type': 'presence',
+                'members': await roster(self.room_name),
+                'ts': int(time.time() * 1000),
+            })
+            await self.send_encoded(encoded_text, encoded_bytes)
+            return
+        if not isinstance(text, str) or not text:
+            return
 
-        # Format the message with a timestamp and the username
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        formatted_message = f"{username}: {message} ({timestamp})"
+        # Build the event and encode it once for every recipient
+        message_id = uuid.uuid4()
+        created_at = timezone.now()
+        encoded_text, encoded_bytes = encode_event(chat_event(message_id, user, text, created_at))
 
-        # Send the formatted message to the chat room group
+        # Queue the message for the next batched insert and keep it in the room's recent history
+        message_writer.add(ChatMessage(uid=message_id, room=self.room_name, author=user, text=text, created_at=created_at))
+        await remember_message(self.room_name, encoded_text)
+
+        # Send the encoded message to the chat room group
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
-                'message': formatted_message
+                'text': encoded_text,
+                'bytes': encoded_bytes
             }
         )
 
     async def chat_message(self, event):
-        # Handle the chat message event and send the message to the WebSocket client
-        message = event['message']
+        # Handle the chat message event and forward the pre-encoded message to the WebSocket client
+        await self.send_encoded(event['text'], event['bytes'])
 
-        await self.send(text_data=json.dumps({
-            'message': message
-        }))
+    async def send_encoded(self, encoded_text, encoded_bytes=None):
+        # Send an event in the wire format agreed at connect
+        if self.use_msgpack:
+            if encoded_bytes is None:
+                encoded_bytes = msgpack.packb(json.loads(encoded_text))
+            await self.send(bytes_data=encoded_bytes)
+        else:
+            await self.send(text_data=encoded_text)
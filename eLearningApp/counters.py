@@ -0,0 +1,48 @@
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from .models import Course, CourseMaterial, Enrollment, Feedback
+from .fragments import invalidate_fragments
+
+# Counter column of Course maintained for each related model
+COUNTER_FIELDS = {
+    Enrollment: 'enrollment_count',
+    Feedback: 'feedback_count',
+    CourseMaterial: 'material_count',
+}
+
+
+# Add delta to a counter of a course in a single UPDATE, so concurrent changes are never lost
+# The counter never drops below zero, even if it drifted
+def adjust_counter(model, course_id, delta):
+    field = COUNTER_FIELDS[model]
+    Course.objects.filter(pk=course_id).update(**{field: Greatest(F(field) + delta, Value(0))})
+
+
+# Number of related rows of each course, as an expression usable in queries and updates
+def _actual_count(model):
+    counts = (
+        model.objects.filter(course=OuterRef('pk'))
+        .order_by()
+        .values('course')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+# Recount the counters from the related tables and fix the courses that drifted
+# The fix is a single UPDATE recounting in the database, so changes made meanwhile are not overwritten
+# Returns the number of courses whose counters were corrected
+def reconcile_counters(course_ids=None):
+    courses = Course.objects.all() if course_ids is None else Course.objects.filter(pk__in=course_ids)
+    mismatch = Q()
+    for model, field in COUNTER_FIELDS.items():
+        courses = courses.annotate(**{f'actual_{field}': _actual_count(model)})
+        mismatch |= ~Q(**{field: F(f'actual_{field}')})
+    drifted = list(courses.filter(mismatch).values_list('pk', flat=True))
+    if drifted:
+        Course.objects.filter(pk__in=drifted).update(
+            **{field: _actual_count(model) for model, field in COUNTER_FIELDS.items()}
+        )
+        invalidate_fragments('course_header', *drifted)
+    return len(drifted)
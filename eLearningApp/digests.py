@@ -0,0 +1,56 @@
+from django.db import transaction
+from django.core.mail import send_mail
+from .models import CustomUser, DigestEntry
+from .notifications import notify_users
+
+# Email subject and real-time summary of the digest of each notification type
+DIGEST_TEXTS = {
+    'enrollment': ('New Enrollments', '{count} student(s) enrolled in your courses.'),
+}
+DEFAULT_DIGEST_TEXT = ('New Notifications', 'You have {count} new notification(s).')
+
+
+# Keep a notification for the recipient's next digest
+def queue_digest(recipient_id, notification_type, message):
+    DigestEntry.objects.create(recipient_id=recipient_id, notification_type=notification_type, message=message)
+
+
+# Ids of the users with pending digest entries
+def pending_recipients():
+    return list(DigestEntry.objects.order_by().values_list('recipient_id', flat=True).distinct())
+
+
+# Send the pending entries of a user as one email and one real-time notification per type
+# The entries are claimed and deleted in a short transaction that commits before anything is sent, so
+# no row lock is held while talking to the mail server. Entries whose email fails are put back for
+# the retry of the task. Returns the number of entries sent
+def send_digest(recipient_id):
+    with transaction.atomic():
+        # Entries locked by another worker sending the same digest are skipped
+        entries = list(
+            DigestEntry.objects.select_for_update(skip_locked=True)
+            .filter(recipient_id=recipient_id)
+            .order_by('id')
+            .values_list('id', 'notification_type', 'message')
+        )
+        if not entries:
+            return 0
+        DigestEntry.objects.filter(id__in=[entry_id for entry_id, _, _ in entries]).delete()
+    recipient = CustomUser.objects.only('username', 'email').get(pk=recipient_id)
+
+    messages = {}
+    for _, notification_type, message in entries:
+        messages.setdefault(notification_type, []).append(message)
+    messages = list(messages.items())
+    for index, (notification_type, lines) in enumerate(messages):
+        subject, summary = DIGEST_TEXTS.get(notification_type, DEFAULT_DIGEST_TEXT)
+        try:
+            send_mail(subject, '\n'.join(lines), 'admin@elearning.com', [recipient.email])
+        except BaseException:
+            DigestEntry.objects.bulk_create([
+                DigestEntry(recipient_id=recipient_id, notification_type=pending_type, message=message)
+                for pending_type, pending_lines in messages[index:] for message in pending_lines
+            ])
+            raise
+        notify_users([(recipient.pk, recipient.username)], notification_type, summary.format(count=len(lines)))
+    return len(entries)
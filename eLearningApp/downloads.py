@@ -0,0 +1,120 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, quote_etag
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# Strong validator of a stored file, derived from its size and modification time
+def file_etag(size, modified):
+    return quote_etag(f'{size:x}-{int(modified.timestamp() * 1000):x}')
+
+
+# Parse a single-range Range header into inclusive (start, end) offsets
+# Returns None to serve the whole file (no header, a malformed one or several ranges)
+# and raises ValueError when the range lies outside the file
+def parse_range(header, size):
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+# Yield the bytes start..end (inclusive) of an open file in chunks, closing it when done
+def read_range(file, start, end, chunk_size):
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+# Build the response serving a stored file, honouring If-None-Match, If-Range and Range
+# The bytes are streamed in MATERIAL_DOWNLOAD_CHUNK_SIZE chunks, or handed to the front proxy
+# with X-Accel-Redirect/X-Sendfile when MATERIAL_DOWNLOAD_OFFLOAD is set.
+# Raises FileNotFoundError when the file is missing from storage
+def serve_file(request, field_file, filename=None):
+    storage = field_file.storage
+    name = field_file.name
+    size = storage.size(name)
+    modified = storage.get_modified_time(name)
+    etag = file_etag(size, modified)
+    filename = filename or os.path.basename(name)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(modified.timestamp()),
+        'Accept-Ranges': 'bytes',
+        # Only the requesting user may reuse the file from cache, and must revalidate with the ETag
+        'Cache-Control': 'private, no-cache',
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+        return _with_headers(HttpResponseNotModified(), headers)
+
+    offload = settings.MATERIAL_DOWNLOAD_OFFLOAD
+    if offload:
+        # The proxy sends the bytes and handles ranges itself, the worker returns right away
+        response = HttpResponse(content_type=content_type)
+        if offload == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = quote(settings.MATERIAL_ACCEL_REDIRECT_PREFIX + name)
+        else:
+            response['X-Sendfile'] = storage.path(name)
+        response['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(filename)}"
+        return _with_headers(response, headers)
+
+    # A range is only honoured while the client's copy is still the current file
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return _with_headers(response, headers)
+
+    file = storage.open(name, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type, filename=filename)
+        response.block_size = settings.MATERIAL_DOWNLOAD_CHUNK_SIZE
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            read_range(file, start, end, settings.MATERIAL_DOWNLOAD_CHUNK_SIZE), status=206, content_type=content_type
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(filename)}"
+    return _with_headers(response, headers)
+
+
+def _with_headers(response, headers):
+    for header, value in headers.items():
+        response[header] = value
+    return response
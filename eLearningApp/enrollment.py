@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from .chat import membership_cache_key
+from .counters import adjust_counter
+from .fragments import invalidate_fragments
+from .models import Course, CustomUser, Enrollment
+from .outbox import enqueue
+from .tasks import send_bulk_enrollment_notification
+
+
+# Error raised for a roster that cannot be read
+class RosterError(ValueError):
+    pass
+
+
+# Enroll a student in a course, doing nothing when they are already enrolled
+# get_or_create falls back to reading the existing row when a concurrent request inserted it first,
+# so double submits never fail on the unique (student, course) constraint, and post_save (with the
+# teacher notification) only fires for the request that actually inserted the row.
+# Returns (enrollment, created)
+def enroll(student, course):
+    return Enrollment.objects.get_or_create(student=student, course=course)
+
+
+# Remove a student from a course, returning whether they were enrolled
+def unenroll(student, course):
+    deleted, _ = Enrollment.objects.filter(student=student, course=course).delete()
+    return bool(deleted)
+
+
+# Read the student usernames or emails of a roster
+# CSV rosters use the `username` or `email` column, or the first column when there is no header,
+# JSON rosters are a list of usernames/emails or of objects with a `username` or `email` key
+def parse_roster(content, roster_format='csv'):
+    if isinstance(content, bytes):
+        try:
+            content = content.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise RosterError('The roster must be UTF-8 encoded.')
+    if roster_format == 'json':
+        try:
+            entries = json.loads(content) if isinstance(content, str) else content
+        except ValueError:
+            raise RosterError('The roster is not valid JSON.')
+        if isinstance(entries, dict):
+            entries = entries.get('students')
+        if not isinstance(entries, list):
+            raise RosterError('The roster must be a list of students.')
+        identifiers = [entry.get('username') or entry.get('email') if isinstance(entry, dict) else entry for entry in entries]
+    elif roster_format == 'csv':
+        rows = [row for row in csv.reader(io.StringIO(content)) if row and row[0].strip()]
+        header = [column.strip().lower() for column in rows[0]] if rows else []
+        column = next((header.index(name) for name in ('username', 'email') if name in header), None)
+        if column is None:
+            column = 0
+        else:
+            rows = rows[1:]
+        identifiers = [row[column] if len(row) > column else '' for row in rows]
+    else:
+        raise RosterError(f'Unknown roster format: {roster_format}.')
+    if not all(isinstance(identifier, str) for identifier in identifiers):
+        raise RosterError('Every student must be given as a username or email.')
+    # Keep the roster order and drop blanks and duplicates
+    return list(dict.fromkeys(identifier.strip() for identifier in identifiers if identifier.strip()))
+
+
+# Insert the enrollments of students in a course in one statement, skipping those already enrolled
+# Returns the ids of the students actually inserted. Must run inside a transaction: the course row is
+# locked so concurrent imports of the course take turns, and the students enrolled before the insert
+# are read under that lock, since bulk_create(ignore_conflicts=True) does not report skipped rows
+def _insert_enrollments(course, student_ids):
+    if not student_ids:
+        return set()
+    Course.objects.select_for_update().filter(pk=course.pk).values_list('pk', flat=True).first()
+    enrolled = set(Enrollment.objects.filter(course=course, student_id__in=student_ids).values_list('student_id', flat=True))
+    new_ids = set(student_ids) - enrolled
+    Enrollment.objects.bulk_create(
+        [Enrollment(student_id=student_id, course=course) for student_id in new_ids], ignore_conflicts=True,
+    )
+    return new_ids
+
+
+# Enroll the students of a roster in a course in batches
+# Each batch resolves its students in one query and inserts them with one INSERT that skips existing
+# enrollments, so no per-enrollment signal, email or notification is sent. `progress` is called
+# with the running report after each batch. Returns the report:
+# {'total', 'processed', 'enrolled', 'already_enrolled', 'not_found'}
+def bulk_enroll(course, identifiers, batch_size=None, progress=None):
+    batch_size = batch_size or settings.ENROLLMENT_BATCH_SIZE
+    identifiers = list(identifiers)
+    report = {'total': len(identifiers), 'processed': 0, 'enrolled': 0, 'already_enrolled': 0, 'not_found': []}
+
+    for start in range(0, len(identifiers), batch_size):
+        batch = identifiers[start:start + batch_size]
+        students = CustomUser.objects.filter(
+            Q(username__in=batch) | Q(email__in=batch), role=CustomUser.STUDENT
+        ).values_list('pk', 'username', 'email')
+        found = set()
+        student_ids = set()
+        for pk, username, email in students:
+            student_ids.add(pk)
+            found.update((username, email))
+        report['not_found'].extend(identifier for identifier in batch if identifier not in found)
+
+        with transaction.atomic():
+            new_ids = _insert_enrollments(course, student_ids)
+            # The insert skips post_save, so the counter is moved here by the rows actually inserted
+            if new_ids:
+                adjust_counter(Enrollment, course.pk, len(new_ids))
+        # The chat may have cached that these students are not members yet
+        cache.delete_many([membership_cache_key(course.pk, student_id) for student_id in new_ids])
+
+        report['enrolled'] += len(new_ids)
+        report['already_enrolled'] += len(student_ids) - len(new_ids)
+        report['processed'] += len(batch)
+        if progress is not None:
+            progress(report)
+
+    if report['enrolled']:
+        # The roster and header fragments of the course show the new students
+        invalidate_fragments('course_roster', course.pk)
+        invalidate_fragments('course_header', course.pk)
+        # Tell the instructor once about the whole import instead of once per student
+        enqueue(send_bulk_enrollment_notification, course.pk, report['enrolled'])
+    return report
@@ -0,0 +1,179 @@
+import logging
+import redis
+from django.conf import settings
+from django.db.models import Count, Q
+from redis.exceptions import RedisError
+from .models import ActivityEvent, TimelineEntry, Course, CourseMaterial, CustomUser, Enrollment, Feedback, Status
+from .pagination import KeysetPage
+
+logger = logging.getLogger(__name__)
+
+# Redis clients of the activity feed, by URL
+_redis_clients = {}
+
+
+# Return the Redis client holding the timelines, or None when disabled
+def get_feed_redis():
+    url = settings.FEED_REDIS_URL
+    if not url:
+        return None
+    client = _redis_clients.get(url)
+    if client is None:
+        client = _redis_clients[url] = redis.Redis.from_url(url)
+    return client
+
+
+# Redis key of the sorted set of event ids in a user's feed, scored by event id
+def timeline_key(user_id):
+    return f'feed:timeline:{user_id}'
+
+
+# Create the event of a new status, material or feedback
+def create_event(kind, obj):
+    if kind == ActivityEvent.STATUS:
+        fields = {'actor_id': obj.user_id, 'text': obj.text, 'created_at': obj.created_at}
+    elif kind == ActivityEvent.MATERIAL:
+        fields = {'course_id': obj.course_id, 'text': obj.name}
+    else:
+        fields = {'actor_id': obj.student_id, 'course_id': obj.course_id, 'text': obj.text, 'created_at': obj.created_at}
+    return ActivityEvent.objects.create(kind=kind, object_id=obj.pk, **fields)
+
+
+# Ids of the users whose feed shows an event
+# A status reaches its author and the members of every course they teach or attend, a material
+# the members of its course, and a feedback the course instructor and its author
+def event_audience(event):
+    if event.kind == ActivityEvent.STATUS:
+        courses = Course.objects.filter(Q(instructor_id=event.actor_id) | Q(enrollments__student_id=event.actor_id))
+        audience = set(CustomUser.objects.filter(
+            Q(courses__in=courses) | Q(enrollments__course__in=courses)
+        ).values_list('id', flat=True).distinct())
+        audience.add(event.actor_id)
+    elif event.kind == ActivityEvent.MATERIAL:
+        audience = set(Enrollment.objects.filter(course_id=event.course_id).values_list('student_id', flat=True))
+        audience.add(Course.objects.values_list('instructor_id', flat=True).get(pk=event.course_id))
+    else:
+        audience = {event.actor_id, Course.objects.values_list('instructor_id', flat=True).get(pk=event.course_id)}
+    return sorted(audience)
+
+
+# Push event ids onto the Redis timelines of users, keeping only the latest FEED_TIMELINE_SIZE of each
+def _push(client, user_ids, event_ids):
+    with client.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.zadd(timeline_key(user_id), {event_id: event_id for event_id in event_ids})
+            pipe.zremrangebyrank(timeline_key(user_id), 0, -settings.FEED_TIMELINE_SIZE - 1)
+        pipe.execute()
+
+
+# Copy an event into the feed of its audience, in the database and in Redis, in batches
+# Returns the number of feeds written
+def fan_out(event_id, batch_size=None):
+    batch_size = batch_size or settings.FEED_FANOUT_BATCH_SIZE
+    event = ActivityEvent.objects.filter(pk=event_id).first()
+    if event is None:
+        return 0
+    audience = event_audience(event)
+    client = get_feed_redis()
+    for start in range(0, len(audience), batch_size):
+        batch = audience[start:start + batch_size]
+        TimelineEntry.objects.bulk_create([TimelineEntry(user_id=user_id, event=event) for user_id in batch], ignore_conflicts=True)
+        if client is not None:
+            try:
+                _push(client, batch, [event.pk])
+            except (RedisError, OSError):
+                # The database copy is complete, the timelines are reloaded from it by load_timeline
+                logger.warning('Could not push activity %s to Redis timelines', event.pk, exc_info=True)
+    return len(audience)
+
+
+# Latest event ids of a user's feed from the database, newest first
+def _timeline_ids_from_database(user_id, before=None, limit=None):
+    entries = TimelineEntry.objects.filter(user_id=user_id)
+    if before is not None:
+        entries = entries.filter(event_id__lt=before)
+    return list(entries.order_by('-event_id').values_list('event_id', flat=True)[:limit or settings.FEED_TIMELINE_SIZE])
+
+
+# Load the latest FEED_TIMELINE_SIZE events of a user's feed from the database into Redis
+def load_timeline(user_id):
+    client = get_feed_redis()
+    if client is None:
+        return 0
+    event_ids = _timeline_ids_from_database(user_id)
+    with client.pipeline() as pipe:
+        pipe.delete(timeline_key(user_id))
+        if event_ids:
+            pipe.zadd(timeline_key(user_id), {event_id: event_id for event_id in event_ids})
+        pipe.execute()
+    return len(event_ids)
+
+
+# Ids of one page of a user's feed, newest first, from Redis when it holds the timeline
+def _page_ids(user_id, before, limit):
+    client = get_feed_redis()
+    if client is not None:
+        try:
+            key = timeline_key(user_id)
+            with client.pipeline(transaction=False) as pipe:
+                pipe.exists(key)
+                pipe.zrevrangebyscore(key, f'({before}' if before is not None else '+inf', '-inf', start=0, num=limit)
+                exists, ids = pipe.execute()
+            if exists:
+                return [int(event_id) for event_id in ids]
+            # Timelines are loaded on the first read after an eviction or a Redis restart
+            if before is None and load_timeline(user_id):
+                return [int(event_id) for event_id in client.zrevrangebyscore(key, '+inf', '-inf', start=0, num=limit)]
+        except (RedisError, OSError):
+            logger.warning('Could not read the Redis timeline of user %s', user_id, exc_info=True)
+    return _timeline_ids_from_database(user_id, before, limit)
+
+
+# Return one page of a user's feed, newest first, starting after the cursor (an event id)
+# The cost follows the page size: a range of the sorted set and one query loading the events
+def read_timeline(user_id, cursor=None, page_size=None):
+    page_size = page_size or settings.LISTING_PAGE_SIZE
+    try:
+        before = int(cursor) if cursor else None
+    except ValueError:
+        # An invalid cursor restarts the feed from the newest events
+        before = None
+    ids = _page_ids(user_id, before, page_size + 1)
+    next_cursor = str(ids[page_size - 1]) if len(ids) > page_size else None
+    ids = ids[:page_size]
+    events = ActivityEvent.objects.select_related('actor', 'course').in_bulk(ids)
+    # Events deleted since they were pushed are skipped
+    return KeysetPage([events[event_id] for event_id in ids if event_id in events], next_cursor)
+
+
+# Create the missing events of existing statuses, materials and feedback and fan them out
+# Returns the number of events created
+def backfill(batch_size=None):
+    batch_size = batch_size or settings.FEED_FANOUT_BATCH_SIZE
+    created = 0
+    sources = [(ActivityEvent.STATUS, Status), (ActivityEvent.MATERIAL, CourseMaterial), (ActivityEvent.FEEDBACK, Feedback)]
+    for kind, model in sources:
+        existing = ActivityEvent.objects.filter(kind=kind).values('object_id')
+        for obj in model.objects.exclude(pk__in=existing).order_by('pk').iterator(chunk_size=batch_size):
+            fan_out(create_event(kind, obj).pk, batch_size)
+            created += 1
+    return created
+
+
+# Drop the events beyond FEED_TIMELINE_SIZE from every feed, in the database and in Redis
+# Returns the number of feeds trimmed
+def trim_timelines():
+    size = settings.FEED_TIMELINE_SIZE
+    users = list(
+        TimelineEntry.objects.values('user_id').annotate(entries=Count('id')).filter(entries__gt=size).values_list('user_id', flat=True)
+    )
+    client = get_feed_redis()
+    for user_id in users:
+        oldest_kept = _timeline_ids_from_database(user_id)[-1]
+        TimelineEntry.objects.filter(user_id=user_id, event_id__lt=oldest_kept).delete()
+        if client is not None:
+            try:
+                client.zremrangebyrank(timeline_key(user_id), 0, -size - 1)
+            except (RedisError, OSError):
+                logger.warning('Could not trim the Redis timeline of user %s', user_id, exc_info=True)
+    return len(users)
@@ -14,7 +14,7 @@ class CustomUserUpdateForm(forms.ModelForm):
 
     class Meta:
         model = CustomUser
-        fields = ('email', 'photo', 'new_password', 'confirm_password')
+        fields = ('email', 'photo', 'notification_mode', 'new_password', 'confirm_password')
 
     def __init__(self, *args, **kwargs):
         super(CustomUserUpdateForm, self).__init__(*args, **kwargs)
@@ -0,0 +1,75 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+# Cached fragments and the kind of object their version follows
+FRAGMENTS = {
+    'course_header': 'course',
+    'course_materials': 'course',
+    'course_roster': 'course',
+    'status_feed': 'user',
+}
+
+
+# Cache key holding the current version of a fragment of an object
+def version_key(name, object_id):
+    return f'fragment:version:{name}:{object_id}'
+
+
+# Cache key of a rendered fragment, any cached copy of an older version is never read again
+# The variant values (viewer role, page cursor...) are hashed as they may come from the request
+def fragment_key(name, version, variant=()):
+    digest = hashlib.md5(repr(tuple(variant)).encode(), usedforsecurity=False).hexdigest()
+    return f'fragment:{name}:{version}:{digest}'
+
+
+# Cache keys counting the hits and misses of a fragment
+def stats_key(name, outcome):
+    return f'fragment:stats:{name}:{outcome}'
+
+
+# Return {name: version} for the fragments of an object in one cache round trip
+# Missing versions start from the current time in milliseconds, so a version lost to eviction
+# can never come back to a number that older cached fragments were stored under
+def fragment_versions(object_id, *names):
+    keys = {version_key(name, object_id): name for name in names}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, int(time.time() * 1000), None)
+        versions[key] = cache.get(key)
+    return {name: versions[key] for key, name in keys.items()}
+
+
+# Move fragments of objects to a new version so they are rendered again
+def invalidate_fragments(name, *object_ids):
+    for object_id in object_ids:
+        try:
+            cache.incr(version_key(name, object_id))
+        except ValueError:
+            # No version yet, so nothing was cached
+            pass
+
+
+# Count a fragment cache hit or miss
+def record_access(name, hit):
+    if not settings.FRAGMENT_CACHE_STATS:
+        return
+    key = stats_key(name, 'hits' if hit else 'misses')
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+# Return {name: {'hits', 'misses', 'hit_rate'}} for every cached fragment
+def fragment_stats():
+    keys = [stats_key(name, outcome) for name in FRAGMENTS for outcome in ('hits', 'misses')]
+    counts = cache.get_many(keys)
+    stats = {}
+    for name in FRAGMENTS:
+        hits = counts.get(stats_key(name, 'hits'), 0)
+        misses = counts.get(stats_key(name, 'misses'), 0)
+        stats[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None}
+    return stats
@@ -0,0 +1,55 @@
+import hashlib
+import io
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Photo shipped as the default of new profiles, shared by every user and never deleted
+DEFAULT_PHOTO = 'default.jpg'
+
+PHOTO_EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+
+
+# Encode an image without any metadata, returning the bytes
+# Only the pixels are copied into a fresh image, so EXIF (camera, GPS), ICC and XMP data are dropped
+def encode_image(image):
+    clean = Image.frombytes(image.mode, image.size, image.tobytes())
+    buffer = io.BytesIO()
+    clean.save(buffer, format=settings.PROFILE_PHOTO_FORMAT, quality=settings.PROFILE_PHOTO_QUALITY)
+    return buffer.getvalue()
+
+
+# Store content under a name derived from its hash, so the file can be cached forever by browsers
+# The user id keeps files of different users apart, identical content reuses the existing file
+def save_hashed(user_id, directory, suffix, content):
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    extension = PHOTO_EXTENSIONS[settings.PROFILE_PHOTO_FORMAT]
+    name = f'{directory}/{user_id}-{digest}{suffix}.{extension}'
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(content))
+    return name
+
+
+# Build the stored photo and the square thumbnails of an uploaded photo
+# Returns {'photo': name, 'photo_small': name, 'photo_large': name}
+def process_photo(user_id, source_name):
+    with default_storage.open(source_name, 'rb') as source:
+        image = Image.open(source)
+        # Apply the EXIF orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if settings.PROFILE_PHOTO_FORMAT == 'WEBP' and 'A' in image.getbands() else 'RGB')
+
+    photo = image.copy()
+    photo.thumbnail((settings.PROFILE_PHOTO_MAX_SIZE, settings.PROFILE_PHOTO_MAX_SIZE), Image.LANCZOS)
+    names = {'photo': save_hashed(user_id, 'profile_photos', '', encode_image(photo))}
+    for variant, size in settings.PROFILE_THUMBNAIL_SIZES.items():
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        names[f'photo_{variant}'] = save_hashed(user_id, 'profile_photos/thumbnails', f'-{size}', encode_image(thumbnail))
+    return names
+
+
+# Delete stored photo files, never touching the shared default photo
+def delete_photos(names, keep=()):
+    for name in set(names) - set(keep) - {DEFAULT_PHOTO, ''}:
+        default_storage.delete(name)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from eLearningApp.feed import backfill, load_timeline
+from eLearningApp.models import TimelineEntry
+
+
+# Create the activity events of the statuses, materials and feedback written before the feed existed
+# With --reload, the Redis timelines are also rebuilt from the database, e.g. after a Redis data loss
+class Command(BaseCommand):
+    help = 'Backfill the activity feed from existing statuses, materials and feedback'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--reload', action='store_true', help='Reload every Redis timeline from the database')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Created {backfill(options['batch_size'])} activity event(s)")
+        if options['reload']:
+            users = TimelineEntry.objects.values_list('user_id', flat=True).distinct().order_by('user_id')
+            count = sum(1 for user_id in users.iterator() if load_timeline(user_id))
+            self.stdout.write(f'Reloaded {count} Redis timeline(s)')
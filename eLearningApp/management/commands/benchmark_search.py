@@ -0,0 +1,75 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from eLearningApp.models import CustomUser, SearchTerm
+from eLearningApp.search import object_terms, search
+
+FIRST_NAMES = ['anna', 'ben', 'carla', 'david', 'elena', 'farid', 'grace', 'hugo', 'ines', 'jonas', 'kira', 'liam']
+LAST_NAMES = ['smith', 'garcia', 'chen', 'novak', 'okafor', 'silva', 'tanaka', 'weber', 'kowalski', 'haddad']
+QUERIES = ['anna', 'gar', 'chen kira', 'bench_12345', 'liam weber', 'zz']
+
+
+# Measure search latency against a large synthetic user base
+# Users are inserted with bulk_create so the index is filled directly instead of through post_save
+class Command(BaseCommand):
+    help = 'Benchmark user search over a synthetic user base (removed afterwards unless --keep is given)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic users and their index entries')
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        start = time.perf_counter()
+        self.create_users(options['users'], options['batch_size'])
+        self.stdout.write(f"Created and indexed {options['users']} users in {time.perf_counter() - start:.1f}s")
+
+        try:
+            for query in QUERIES:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    results, _has_next = search(SearchTerm.USER, query)
+                    timings.append((time.perf_counter() - start) * 1000)
+                self.stdout.write(
+                    f'{query!r}: {len(results)} results, median {statistics.median(timings):.2f} ms, '
+                    f'max {max(timings):.2f} ms'
+                )
+        finally:
+            if not options['keep']:
+                self.delete_users()
+
+    def create_users(self, count, batch_size):
+        for offset in range(0, count, batch_size):
+            users = [
+                CustomUser(
+                    username=f'bench_{i}',
+                    email=f'bench_{i}@example.com',
+                    full_name=f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}',
+                    role=CustomUser.STUDENT,
+                )
+                for i in range(offset, min(offset + batch_size, count))
+            ]
+            # Fetch the new ids back, bulk_create only sets them on some databases
+            CustomUser.objects.bulk_create(users)
+            users = CustomUser.objects.filter(username__in=[user.username for user in users]).only(
+                'pk', 'username', 'full_name'
+            )
+            SearchTerm.objects.bulk_create([
+                SearchTerm(kind=SearchTerm.USER, object_id=user.pk, term=term, weight=weight)
+                for user in users
+                for term, weight in object_terms(SearchTerm.USER, user).items()
+            ])
+        if connection.vendor in ('postgresql', 'sqlite'):
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def delete_users(self):
+        ids = CustomUser.objects.filter(username__startswith='bench_').values_list('pk', flat=True)
+        SearchTerm.objects.filter(kind=SearchTerm.USER, object_id__in=ids).delete()
+        # Delete without loading each user for the post_delete receivers, the index entries are already gone
+        CustomUser.objects.filter(username__startswith='bench_')._raw_delete(connection.alias)
@@ -0,0 +1,75 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+from eLearningApp.models import CustomUser
+from eLearningApp.views import CustomUserViewSet
+
+
+# Measure the throughput of the user API listing against a large synthetic user base
+# Every page is requested through the viewset, following the next cursor until the end of the listing
+class Command(BaseCommand):
+    help = 'Benchmark the paginated user API over a synthetic user base (removed afterwards unless --keep is given)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100_000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--page-size', type=int, default=1000)
+        parser.add_argument('--fields', default='', help='Comma separated fields to select, all fields by default')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic users')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        self.create_users(options['users'], options['batch_size'])
+        self.stdout.write(f"Created {options['users']} users in {time.perf_counter() - start:.1f}s")
+
+        try:
+            params = {'page_size': options['page_size']}
+            if options['fields']:
+                params['fields'] = options['fields']
+            pages, rows, elapsed = self.walk(params)
+            self.stdout.write(
+                f'Listed {rows} users in {pages} pages in {elapsed:.2f}s, '
+                f'{rows / elapsed:.0f} users/s, {elapsed / pages * 1000:.1f} ms per page'
+            )
+        finally:
+            if not options['keep']:
+                self.delete_users()
+
+    # Request every page of the listing, returning (pages, rows, seconds)
+    def walk(self, params):
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        view = CustomUserViewSet.as_view({'get': 'list'})
+        # The permission check only looks at is_staff, so an unsaved admin is enough
+        admin = CustomUser(username='bench_api_admin', is_staff=True, is_superuser=True)
+        pages = rows = 0
+        url = '/api/users/'
+        start = time.perf_counter()
+        while url:
+            request = factory.get(url, params if pages == 0 else None)
+            force_authenticate(request, user=admin)
+            response = view(request)
+            response.render()
+            pages += 1
+            rows += len(response.data['results'])
+            url = response.data['next']
+        return pages, rows, time.perf_counter() - start
+
+    def create_users(self, count, batch_size):
+        for offset in range(0, count, batch_size):
+            CustomUser.objects.bulk_create([
+                CustomUser(
+                    username=f'bench_api_{i}',
+                    email=f'bench_api_{i}@example.com',
+                    full_name=f'Bench User {i}',
+                    role=CustomUser.STUDENT,
+                )
+                for i in range(offset, min(offset + batch_size, count))
+            ])
+        if connection.vendor in ('postgresql', 'sqlite'):
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def delete_users(self):
+        # The users were never indexed or linked, so they are deleted without loading them
+        CustomUser.objects.filter(username__startswith='bench_api_')._raw_delete(connection.alias)
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from eLearningApp.enrollment import bulk_enroll, parse_roster, RosterError
+from eLearningApp.models import Course
+
+
+# Enroll the students listed in a CSV or JSON roster file in a course
+class Command(BaseCommand):
+    help = 'Enroll the students of a CSV or JSON roster (usernames or emails) in a course'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_id', type=int)
+        parser.add_argument('roster', help='Path of the roster file')
+        parser.add_argument('--format', choices=['csv', 'json'], help='Roster format, guessed from the file extension by default')
+        parser.add_argument('--batch-size', type=int)
+
+    def handle(self, *args, **options):
+        try:
+            course = Course.objects.get(pk=options['course_id'])
+        except Course.DoesNotExist:
+            raise CommandError(f"Course {options['course_id']} does not exist")
+
+        roster_format = options['format'] or ('json' if options['roster'].lower().endswith('.json') else 'csv')
+        try:
+            with open(options['roster'], 'rb') as roster:
+                identifiers = parse_roster(roster.read(), roster_format)
+        except (OSError, RosterError) as error:
+            raise CommandError(error)
+
+        def progress(report):
+            self.stdout.write(
+                f"{report['processed']}/{report['total']} processed: {report['enrolled']} enrolled, "
+                f"{report['already_enrolled']} already enrolled, {len(report['not_found'])} not found"
+            )
+
+        report = bulk_enroll(course, identifiers, batch_size=options['batch_size'], progress=progress)
+        for identifier in report['not_found']:
+            self.stderr.write(f'Unknown student: {identifier}')
+        self.stdout.write(self.style.SUCCESS(f"Enrolled {report['enrolled']} students in {course.title}"))
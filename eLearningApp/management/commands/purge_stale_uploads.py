@@ -0,0 +1,15 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from eLearningApp.uploads import purge_stale_uploads
+
+
+# Cancel chunked material uploads that were abandoned, deleting their partial files
+class Command(BaseCommand):
+    help = 'Delete chunked material uploads that received no data for the given number of hours'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        count = purge_stale_uploads(timedelta(hours=options['hours']))
+        self.stdout.write(f'Removed {count} stale upload(s)')
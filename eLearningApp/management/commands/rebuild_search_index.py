@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from eLearningApp.models import SearchTerm
+from eLearningApp.search import rebuild_index
+
+# Rebuild the search index of users and courses from scratch, e.g. after a bulk import
+class Command(BaseCommand):
+    help = 'Rebuild the search index of users and courses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=[SearchTerm.USER, SearchTerm.COURSE], help='Only rebuild one kind of object')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        kinds = [options['kind']] if options['kind'] else [SearchTerm.USER, SearchTerm.COURSE]
+        for kind in kinds:
+            count = rebuild_index(kind, batch_size=options['batch_size'])
+            self.stdout.write(f'Indexed {count} {kind} objects')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from eLearningApp.counters import reconcile_counters
+
+
+# Recount the enrollment, feedback and material counters of courses and fix any drift,
+# e.g. after rows were inserted or deleted in bulk without signals
+class Command(BaseCommand):
+    help = 'Recount the enrollment, feedback and material counters of courses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_ids', nargs='*', type=int, help='Only reconcile these courses')
+
+    def handle(self, *args, **options):
+        fixed = reconcile_counters(options['course_ids'] or None)
+        self.stdout.write(f'Corrected the counters of {fixed} course(s)')
@@ -0,0 +1,32 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from eLearningApp.models import OutboxMessage
+from eLearningApp.outbox import relay, purge_dispatched, requeue_failed
+
+
+# Relay the transactional outbox to the broker from a dedicated process
+# Runs until interrupted, polling every OUTBOX_RELAY_INTERVAL seconds while the outbox is empty
+class Command(BaseCommand):
+    help = 'Dispatch the side effects recorded in the outbox to Celery'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Dispatch the pending messages and exit')
+        parser.add_argument('--requeue-failed', nargs='*', type=int, metavar='ID',
+                            help='Retry the messages that failed too many times (all of them without ids) and exit')
+
+    def handle(self, *args, **options):
+        if options['requeue_failed'] is not None:
+            self.stdout.write(f"Requeued {requeue_failed(options['requeue_failed'] or None)} failed message(s)")
+            return
+        if options['once']:
+            failed = OutboxMessage.objects.filter(failed_at__isnull=False).count()
+            self.stdout.write(f'Dispatched {relay()} message(s), purged {purge_dispatched()}, {failed} failed')
+            return
+        purged_at = 0
+        while True:
+            if not relay():
+                time.sleep(settings.OUTBOX_RELAY_INTERVAL)
+            if time.monotonic() - purged_at > 3600:
+                purge_dispatched()
+                purged_at = time.monotonic()
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from eLearningApp.feed import trim_timelines
+
+
+# Drop the events beyond FEED_TIMELINE_SIZE from every activity feed
+class Command(BaseCommand):
+    help = 'Trim every activity feed to its latest FEED_TIMELINE_SIZE events'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Trimmed {trim_timelines()} feed(s)')
@@ -0,0 +1,67 @@
+import time
+from celery import current_app
+from celery.signals import task_prerun, task_postrun
+from django.core.cache import cache
+
+# Start time of the tasks running in this worker process, by task id
+_started = {}
+
+
+# Cache key holding one metric (runs, failures, runtime_ms, items) of a task
+def metric_key(task_name, metric):
+    return f'taskmetrics:{task_name}:{metric}'
+
+
+# Add to a counter kept in the cache, creating it when missing
+def _add(key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+# Count a finished run of a task and its runtime
+def record_run(task_name, seconds, failed=False):
+    _add(metric_key(task_name, 'runs'), 1)
+    _add(metric_key(task_name, 'runtime_ms'), int(seconds * 1000))
+    if failed:
+        _add(metric_key(task_name, 'failures'), 1)
+
+
+# Count the items (e.g. emails) a task run processed, reported as a throughput by task_metrics
+def record_items(task_name, count):
+    if count:
+        _add(metric_key(task_name, 'items'), count)
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_runtime(task_id=None, task=None, state=None, **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None and task is not None:
+        record_run(task.name, time.perf_counter() - started, failed=state == 'FAILURE')
+
+
+# Return {task name: {'runs', 'failures', 'avg_ms', 'items', 'items_per_s'}} for every task of the app
+def task_metrics():
+    names = sorted(name for name in current_app.tasks if name.startswith('eLearningApp.'))
+    keys = [metric_key(name, metric) for name in names for metric in ('runs', 'failures', 'runtime_ms', 'items')]
+    values = cache.get_many(keys)
+    metrics = {}
+    for name in names:
+        runs = values.get(metric_key(name, 'runs'), 0)
+        runtime_ms = values.get(metric_key(name, 'runtime_ms'), 0)
+        items = values.get(metric_key(name, 'items'), 0)
+        metrics[name] = {
+            'runs': runs,
+            'failures': values.get(metric_key(name, 'failures'), 0),
+            'avg_ms': runtime_ms / runs if runs else None,
+            'items': items,
+            'items_per_s': items * 1000 / runtime_ms if items and runtime_ms else None,
+        }
+    return metrics
@@ -1,9 +1,11 @@
+import uuid
 from django.contrib.auth.models import AbstractUser, BaseUserManager, PermissionsMixin, Group, Permission
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 from django.core.validators import MinLengthValidator
+from django.utils import timezone
 
 # Custom user manager to handle the creation of users and superusers
 class CustomUserManager(BaseUserManager):
@@ -46,7 +48,25 @@ class CustomUser(AbstractUser, PermissionsMixin):
         choices=ROLE_CHOICES,
         default=STUDENT,
     )
+    # How the user receives enrollment notifications, one by one or grouped in periodic digests
+    IMMEDIATE = 'immediate'
+    DIGEST = 'digest'
+
+    NOTIFICATION_MODE_CHOICES = [
+        (IMMEDIATE, _('Immediately')),
+        (DIGEST, _('Periodic digest')),
+    ]
+
+    notification_mode = models.CharField(
+        _('Enrollment notifications'),
+        max_length=20,
+        choices=NOTIFICATION_MODE_CHOICES,
+        default=IMMEDIATE,
+    )
     photo = models.ImageField(upload_to='profile_photos/', null=True, blank=True)
+    # Square thumbnails generated from the photo in the background (see images.py)
+    photo_small = models.ImageField(upload_to='profile_photos/thumbnails/', null=True, blank=True, editable=False)
+    photo_large = models.ImageField(upload_to='profile_photos/thumbnails/', null=True, blank=True, editable=False)
 
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
@@ -60,6 +80,18 @@ class CustomUser(AbstractUser, PermissionsMixin):
     def __str__(self):
         return self.username
 
+    # URL of the small thumbnail, falling back to the photo until it is processed
+    @property
+    def small_photo_url(self):
+        photo = self.photo_small or self.photo
+        return photo.url if photo else ''
+
+    # URL of the large thumbnail, falling back to the photo until it is processed
+    @property
+    def large_photo_url(self):
+        photo = self.photo_large or self.photo
+        return photo.url if photo else ''
+
     groups = models.ManyToManyField(
         Group,
         verbose_name=_('groups'),
@@ -87,11 +119,15 @@ class CustomUser(AbstractUser, PermissionsMixin):
 
 # Assign the permission to teachers function
 def assign_teacher_permissions(user):
+    # Imported here because the authentication backends module needs the user model to be loaded
+    from .backends import invalidate_permission_cache
     course_content_type = ContentType.objects.get_for_model(Course)
     permission, _ = Permission.objects.get_or_create(codename='can_create_course',
                                                      name='Can create course',
                                                      content_type=course_content_type)
     user.user_permissions.add(permission)
+    # Make sure the new permission is visible right away to has_perm
+    invalidate_permission_cache(user)
 
 # Course model
 class Course(models.Model):
@@ -100,11 +136,30 @@ class Course(models.Model):
     instructor = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='courses'
     )
+    # Denormalized counts of related rows, kept up to date by signals (see counters.py)
+    enrollment_count = models.PositiveIntegerField(default=0, editable=False)
+    feedback_count = models.PositiveIntegerField(default=0, editable=False)
+    material_count = models.PositiveIntegerField(default=0, editable=False)
+    COUNTER_FIELDS = ('enrollment_count', 'feedback_count', 'material_count')
 
     class Meta:
         permissions = [
             ("can_create_course", "Can create course"),
         ]
+        indexes = [
+            # Catalog listings sorted by popularity
+            models.Index(fields=['-enrollment_count', '-id'], name='course_popularity_idx'),
+        ]
+
+    # Saving an existing course leaves the counters out of the UPDATE, so a course loaded earlier
+    # (by a form or the admin) never overwrites the counts moved since by other requests
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding:
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
 
     def __str__(self):
         return self.title
@@ -118,6 +173,29 @@ class CourseMaterial(models.Model):
     def __str__(self):
         return self.name or f"Material for {self.course.title}"
 
+# Material Upload model
+# A chunked upload of a course material in progress, the bytes are kept in a file on disk
+# until the upload is finalized and becomes a CourseMaterial
+class MaterialUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='uploads')
+    uploader = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='material_uploads')
+    name = models.CharField(max_length=255)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    # Expected SHA-256 of the whole file as lowercase hex
+    sha256 = models.CharField(max_length=64)
+    # Number of bytes received so far, the offset of the next chunk
+    received = models.BigIntegerField(default=0)
+    # Request currently writing a chunk at `received` and when it claimed the upload (see uploads.py)
+    writer = models.UUIDField(null=True, blank=True, editable=False)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload of {self.filename} ({self.received}/{self.size} bytes)"
+
 # Enrollment model
 class Enrollment(models.Model):
     student = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='enrollments')
@@ -126,6 +204,10 @@ class Enrollment(models.Model):
 
     class Meta:
         unique_together = ('student', 'course')
+        indexes = [
+            # Reverse lookups from a course to its students (rosters, counts, notifications)
+            models.Index(fields=['course', 'student'], name='enrollment_course_student_idx'),
+        ]
 
     def __str__(self):
         return f"{self.student.full_name} enrolled in {self.course.title}"
@@ -137,6 +219,12 @@ class Feedback(models.Model):
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of a course's feedback, newest first
+            models.Index(fields=['course', '-created_at', '-id'], name='feedback_course_created_idx'),
+        ]
+
     def __str__(self):
         return f"Feedback by {self.student} on {self.course}"
 
@@ -146,5 +234,176 @@ class Status(models.Model):
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of a user's status updates, newest first
+            models.Index(fields=['user', '-created_at', '-id'], name='status_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.username}: {self.text[:50]}"
+
+# Chat Message model
+class ChatMessage(models.Model):
+    # Public message id, assigned when the message is received and before it is inserted
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    room = models.CharField(max_length=100)
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_messages')
+    text = models.TextField()
+    # Set when the message is received, messages are inserted later in batches
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # History of a room, latest messages first
+            models.Index(fields=['room', 'id'], name='chatmessage_room_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.author}: {self.text[:50]}"
+
+# Search Term model
+# Inverted index of the searchable text of users and courses, one row per term of an object
+class SearchTerm(models.Model):
+    USER = 'user'
+    COURSE = 'course'
+
+    KIND_CHOICES = [
+        (USER, _('User')),
+        (COURSE, _('Course')),
+    ]
+
+    MAX_TERM_LENGTH = 64
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    term = models.CharField(max_length=MAX_TERM_LENGTH)
+    object_id = models.BigIntegerField()
+    # Sum of the weights of the fields of the object containing the term
+    weight = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id', 'term'], name='searchterm_unique_object_term'),
+        ]
+        indexes = [
+            # Exact and prefix lookups of a term
+            models.Index(fields=['kind', 'term'], name='searchterm_kind_term_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}: {self.term}"
+
+# Digest Entry model
+# Notification waiting to be sent to a user in their next digest
+class DigestEntry(models.Model):
+    recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='digest_entries')
+    notification_type = models.CharField(max_length=50)
+    message = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Pending entries of a recipient in arrival order
+            models.Index(fields=['recipient', 'id'], name='digestentry_recipient_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.notification_type} for {self.recipient_id}: {self.message[:50]}"
+
+# Notification model
+# Every notification pushed to a user is kept so it can be read after the fact
+class Notification(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='notifications')
+    notification_type = models.CharField(max_length=50)
+    message = models.TextField()
+    read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Unread counts and the inbox of a user, newest first
+            models.Index(fields=['user', 'read', '-created_at', '-id'], name='notification_user_read_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.notification_type} for {self.user_id}: {self.message[:50]}"
+
+# Outbox Message model
+# Celery task recorded in the same transaction as the change causing it, and handed to the broker
+# by the relay once committed (see outbox.py)
+class OutboxMessage(models.Model):
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    # Identifies the side effect so recording it twice has no effect
+    dedup_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    # Set when the message failed OUTBOX_MAX_ATTEMPTS times, it is kept for inspection until requeued or purged
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Messages waiting for the relay, in the order they become available
+            models.Index(
+                fields=['available_at'],
+                condition=models.Q(dispatched_at__isnull=True, failed_at__isnull=True),
+                name='outbox_pending_idx',
+            ),
+            # Purge of dispatched messages
+            models.Index(fields=['dispatched_at'], name='outbox_dispatched_idx'),
+            # Requeue and purge of failed messages
+            models.Index(fields=['failed_at'], condition=models.Q(failed_at__isnull=False), name='outbox_failed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task}{tuple(self.args)}"
+
+# Activity Event model
+# Something that happened in a course (a status update, a new material or a feedback),
+# copied into the activity feed of every member of the course (see feed.py)
+class ActivityEvent(models.Model):
+    STATUS = 'status'
+    MATERIAL = 'material'
+    FEEDBACK = 'feedback'
+
+    KIND_CHOICES = [
+        (STATUS, _('Status update')),
+        (MATERIAL, _('Course material')),
+        (FEEDBACK, _('Feedback')),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Primary key of the status, material or feedback the event was created for
+    object_id = models.BigIntegerField()
+    actor = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name='activity_events')
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, null=True, blank=True, related_name='activity_events')
+    text = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='activityevent_unique_source'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id}: {self.text[:50]}"
+
+# Timeline Entry model
+# Copy of an event in the activity feed of one user, written on fan-out and backing the Redis timelines
+class TimelineEntry(models.Model):
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='timeline_entries')
+    event = models.ForeignKey(ActivityEvent, on_delete=models.CASCADE, related_name='timeline_entries')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'event'], name='timelineentry_unique_user_event'),
+        ]
+        indexes = [
+            # Pages of a user's feed, newest event first
+            models.Index(fields=['user', '-event'], name='timelineentry_user_event_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_id} in the feed of {self.user_id}"
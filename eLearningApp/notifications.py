@@ -0,0 +1,85 @@
+import asyncio
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from .models import Notification
+
+
+# Name of the channel layer group every NotificationConsumer of a user joins
+def notification_group_name(username):
+    return f'notifications_{username}'
+
+
+# Build the channel layer event handled by NotificationConsumer.user_notification
+# The inbox id lets the client mark a notification pushed live as read
+def notification_event(notification):
+    return {
+        'type': 'user_notification',  # Specify the type of message handler
+        'id': notification.id,
+        'notification_type': notification.notification_type,  # Type of notification
+        'message': notification.message,  # The notification message
+        'ts': int(notification.created_at.timestamp() * 1000),
+    }
+
+
+# Send the notifications of a batch of users concurrently on one event loop
+async def _send_batch(channel_layer, events):
+    await asyncio.gather(*(
+        channel_layer.group_send(notification_group_name(username), event)
+        for username, event in events
+    ))
+
+
+# Cache key holding the number of unread notifications of a user
+def unread_count_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+# Return the number of unread notifications of a user, cached for NOTIFICATION_UNREAD_CACHE_TIMEOUT seconds
+# Writers delete the cached count, the timeout bounds how long a count read during a write stays stale
+def unread_count(user_id):
+    key = unread_count_key(user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(user_id=user_id, read=False).count()
+        cache.set(key, count, settings.NOTIFICATION_UNREAD_CACHE_TIMEOUT)
+    return count
+
+
+# Mark the given notifications of a user (all of them by default) as read, returning how many changed
+def mark_read(user_id, ids=None):
+    notifications = Notification.objects.filter(user_id=user_id, read=False)
+    if ids is not None:
+        notifications = notifications.filter(id__in=ids)
+    marked = notifications.update(read=True)
+    if marked:
+        cache.delete(unread_count_key(user_id))
+    return marked
+
+
+# Latest unread notifications of a user, oldest first, replayed when they connect
+def unread_backlog(user_id, limit=None):
+    limit = limit or settings.NOTIFICATION_REPLAY_LIMIT
+    notifications = Notification.objects.filter(user_id=user_id, read=False).order_by('-created_at', '-id')[:limit]
+    return list(reversed(notifications))
+
+
+# Store a notification for many users and push it to those connected, in batches
+# Recipients are (user id, username) pairs. Each batch is one INSERT and a single trip through
+# async_to_sync whose group sends are issued concurrently, so the Redis round-trips overlap
+def notify_users(recipients, notification_type, message, batch_size=None):
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    channel_layer = get_channel_layer()
+    recipients = list(recipients)
+    for start in range(0, len(recipients), batch_size):
+        batch = recipients[start:start + batch_size]
+        notifications = Notification.objects.bulk_create([
+            Notification(user_id=user_id, notification_type=notification_type, message=message)
+            for user_id, _ in batch
+        ])
+        cache.delete_many([unread_count_key(user_id) for user_id, _ in batch])
+        async_to_sync(_send_batch)(channel_layer, [
+            (username, notification_event(notification)) for (_, username), notification in zip(batch, notifications)
+        ])
+    return len(recipients)
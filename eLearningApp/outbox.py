@@ -0,0 +1,86 @@
+import logging
+from datetime import timedelta
+from celery import current_app
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+# Record a Celery task to run once the current transaction commits
+# The row is written in the same transaction as the change causing it, so nothing is sent for a change
+# that is rolled back, and the request never waits on the broker
+# Recording a second message with the same dedup_key is a no-op
+def enqueue(task, *args, dedup_key=None):
+    OutboxMessage.objects.bulk_create(
+        [OutboxMessage(task=task.name, args=list(args), dedup_key=dedup_key)],
+        ignore_conflicts=dedup_key is not None,
+    )
+
+
+# Hand one batch of pending messages to the broker
+# Messages that fail are retried later with an exponential backoff, up to OUTBOX_MAX_ATTEMPTS times,
+# then marked as failed and logged as errors until they are requeued or purged
+# Returns (dispatched, fetched)
+def relay_batch(batch_size=None):
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    with transaction.atomic():
+        # Messages locked by another relay are skipped, so each message is dispatched by one relay only
+        messages = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(dispatched_at__isnull=True, failed_at__isnull=True, available_at__lte=now)
+            .order_by('available_at', 'id')[:batch_size]
+        )
+        dispatched, failed = [], []
+        for message in messages:
+            try:
+                current_app.tasks[message.task].apply_async(message.args)
+            except Exception:
+                message.attempts += 1
+                message.available_at = now + timedelta(seconds=min(2 ** message.attempts, settings.OUTBOX_MAX_BACKOFF))
+                failed.append(message)
+                if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    message.failed_at = now
+                    logger.error(
+                        'Giving up on outbox message %s (%s) after %d attempts, requeue it with relay_outbox --requeue-failed',
+                        message.pk, message, message.attempts, exc_info=True,
+                    )
+                else:
+                    logger.warning('Could not dispatch outbox message %s (attempt %d)', message.pk, message.attempts, exc_info=True)
+            else:
+                dispatched.append(message.pk)
+        OutboxMessage.objects.filter(pk__in=dispatched).update(dispatched_at=now)
+        OutboxMessage.objects.bulk_update(failed, ['attempts', 'available_at', 'failed_at'])
+    return len(dispatched), len(messages)
+
+
+# Dispatch every pending message in batches, returning the number dispatched
+def relay(batch_size=None):
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    total = 0
+    while True:
+        dispatched, fetched = relay_batch(batch_size)
+        total += dispatched
+        if fetched < batch_size:
+            return total
+
+
+# Delete dispatched messages older than OUTBOX_RETENTION seconds, their dedup keys are no longer needed,
+# and failed messages older than OUTBOX_FAILED_RETENTION seconds. Returns the number of messages deleted
+def purge_dispatched():
+    now = timezone.now()
+    deleted, _ = OutboxMessage.objects.filter(dispatched_at__lt=now - timedelta(seconds=settings.OUTBOX_RETENTION)).delete()
+    expired, _ = OutboxMessage.objects.filter(failed_at__lt=now - timedelta(seconds=settings.OUTBOX_FAILED_RETENTION)).delete()
+    return deleted + expired
+
+
+# Put failed messages (all of them by default) back in the queue with a fresh number of attempts
+# Returns the number of messages requeued
+def requeue_failed(ids=None):
+    messages = OutboxMessage.objects.filter(failed_at__isnull=False)
+    if ids is not None:
+        messages = messages.filter(pk__in=ids)
+    return messages.update(failed_at=None, attempts=0, available_at=timezone.now())
@@ -0,0 +1,166 @@
+import base64
+import json
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+# Keyset (cursor) pagination for the HTML listings
+# Each page is fetched with a WHERE clause on the ordering columns of the last row seen,
+# so deep pages cost the same as the first one instead of growing with an OFFSET
+class KeysetPage:
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+# Encode the ordering values of a row into an opaque url safe cursor
+def encode_cursor(values):
+    raw = json.dumps(values, default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+# Decode a cursor back into the list of ordering values, raising ValueError when it is malformed
+def decode_cursor(cursor, length):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('Invalid cursor')
+    return values
+
+
+# Build the filter selecting the rows that come strictly after the cursor position
+def _after_position(model, ordering, values):
+    condition = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        value = model._meta.get_field(name).to_python(value)
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    return condition
+
+
+# Return one page of the queryset ordered by the given fields, starting after the cursor
+# The ordering must end with a unique field (normally the primary key) to be stable
+def paginate_keyset(queryset, cursor=None, ordering=('-created_at', '-id'), page_size=None):
+    page_size = page_size or settings.LISTING_PAGE_SIZE
+    queryset = queryset.order_by(*ordering)
+
+    if cursor:
+        try:
+            values = decode_cursor(cursor, len(ordering))
+            queryset = queryset.filter(_after_position(queryset.model, ordering, values))
+        except (ValueError, ValidationError):
+            # An invalid or tampered cursor simply restarts the listing from the first page
+            pass
+
+    # Fetch one extra row to find out whether a next page exists
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        # Rows of values() querysets are dicts
+        read = last.get if isinstance(last, dict) else lambda name: getattr(last, name)
+        next_cursor = encode_cursor([read(field.lstrip('-')) for field in ordering])
+    return KeysetPage(items, next_cursor)
+
+
+# Cursor pagination for the API listings ordered newest first, built on paginate_keyset
+# DRF's CursorPagination only positions the cursor on the first ordering field and skips the rows
+# sharing its value with an offset, which degrades when many rows tie (e.g. ?sort=popular)
+# Responses are {"next": url, "results": [...]}, pages are only walked forward
+class NewestFirstCursorPagination(BasePagination):
+    ordering = ('-created_at', '-id')
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    # Page sizes are read per request so they follow the settings
+    def __init__(self):
+        self.page_size = settings.LISTING_PAGE_SIZE
+        self.max_page_size = settings.LISTING_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        return self.ordering
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(page_size, self.max_page_size) if page_size > 0 else self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page = paginate_keyset(
+            queryset,
+            cursor=request.query_params.get(self.cursor_query_param),
+            ordering=self.get_ordering(request, queryset, view),
+            page_size=self.get_page_size(request),
+        )
+        return list(self.page)
+
+    def get_next_link(self):
+        if not self.page.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.page.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+# Cursor pagination for course listings, which are ordered by id
+# or by enrollment count with ?sort=popular
+class CourseCursorPagination(NewestFirstCursorPagination):
+    ordering = ('-id',)
+    popular_ordering = ('-enrollment_count', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        if request.query_params.get('sort') == 'popular':
+            return self.popular_ordering
+        return self.ordering
+
+
+# Cursor pagination for the user API, ordered by id
+class UserCursorPagination(NewestFirstCursorPagination):
+    ordering = ('id',)
+
+    def __init__(self):
+        self.page_size = settings.USER_API_PAGE_SIZE
+        self.max_page_size = settings.USER_API_MAX_PAGE_SIZE
+
+
+# Cursor pagination for chat history, latest messages first
+class ChatMessageCursorPagination(NewestFirstCursorPagination):
+    ordering = ('-id',)
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import Counter, defaultdict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from redis.exceptions import RedisError
+from .chat import get_redis, encode_event, room_group_name
+
+logger = logging.getLogger(__name__)
+
+# Members of each room when Redis is disabled, as {room: {username: expiry}}
+_local_members = defaultdict(dict)
+# Open connections of each user in each room when Redis is disabled, as {(room, username): count}
+_local_connections = Counter()
+
+# Drop one connection of a user and, with the last one, remove them from the room, atomically so a
+# connection opened meanwhile by another worker is never removed with it
+LEAVE_SCRIPT = """
+local remaining = redis.call('DECR', KEYS[1])
+if remaining <= 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return remaining
+"""
+
+
+# Redis key of the sorted set of present members of a room, scored by the expiry of their heartbeat
+def presence_key(room):
+    return f'chat:presence:{room}'
+
+
+# Redis key counting the open connections of a member of a room, across all workers
+def connections_key(room, username):
+    return f'chat:connections:{room}:{username}'
+
+
+# Record that a user is present in a room for the next CHAT_PRESENCE_TTL seconds
+# Each user's connection count expires with their own heartbeat, so a count left by a crashed worker
+# goes away once that user stops sending heartbeats, even while others keep the room busy
+async def mark_present(room, username):
+    expiry = time.time() + settings.CHAT_PRESENCE_TTL
+    client = get_redis()
+    if client is None:
+        _local_members[room][username] = expiry
+        return
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zadd(presence_key(room), {username: expiry})
+            pipe.expire(connections_key(room, username), settings.CHAT_PRESENCE_TTL)
+            await pipe.execute()
+    except (RedisError, OSError):
+        logger.warning('Could not update presence for room %s', room, exc_info=True)
+
+
+# Record a new connection of a user to a room, returning their number of open connections
+async def add_connection(room, username):
+    client = get_redis()
+    if client is None:
+        _local_connections[(room, username)] += 1
+        await mark_present(room, username)
+        return _local_connections[(room, username)]
+    try:
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.incr(connections_key(room, username))
+            pipe.zadd(presence_key(room), {username: time.time() + settings.CHAT_PRESENCE_TTL})
+            pipe.expire(connections_key(room, username), settings.CHAT_PRESENCE_TTL)
+            connections, _, _ = await pipe.execute()
+        return connections
+    except (RedisError, OSError):
+        logger.warning('Could not update presence for room %s', room, exc_info=True)
+        return 1
+
+
+# Record that a connection of a user to a room closed, returning their number of open connections
+# The user only leaves the room when the last of their connections on any worker closes
+async def remove_connection(room, username):
+    client = get_redis()
+    if client is None:
+        key = (room, username)
+        _local_connections[key] -= 1
+        if _local_connections[key] > 0:
+            return _local_connections[key]
+        del _local_connections[key]
+        _local_members[room].pop(username, None)
+        return 0
+    try:
+        return max(await client.eval(LEAVE_SCRIPT, 2, connections_key(room, username), presence_key(room), username), 0)
+    except (RedisError, OSError):
+        logger.warning('Could not update presence for room %s', room, exc_info=True)
+        return 0
+
+
+# Return the sorted usernames present in a room, dropping members whose heartbeat expired
+async def roster(room):
+    now = time.time()
+    client = get_redis()
+    if client is None:
+        members = _local_members[room]
+        for username in [username for username, expiry in members.items() if expiry <= now]:
+            del members[username]
+        return sorted(members)
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(presence_key(room), '-inf', now)
+            pipe.zrange(presence_key(room), 0, -1)
+            _, members = await pipe.execute()
+    except (RedisError, OSError):
+        logger.warning('Could not read presence for room %s', room, exc_info=True)
+        return []
+    return sorted(member.decode() for member in members)
+
+
+# Tracks the chat connections and broadcasts presence changes in coalesced deltas
+# Joins and leaves of a room are collected for CHAT_PRESENCE_INTERVAL_MS and sent as one event,
+# so a burst of N joins costs one frame per member instead of N frames per member
+class PresenceTracker:
+    def __init__(self):
+        self.pending = {}
+        self.flush_handles = {}
+        self.flush_tasks = set()
+
+    async def join(self, room, username):
+        # Only the first connection of a user, on any worker, changes the roster
+        if await add_connection(room, username) == 1:
+            self.record(room, username, joined=True)
+
+    async def leave(self, room, username):
+        # The user stays in the roster while they are connected through another worker
+        if await remove_connection(room, username) == 0:
+            self.record(room, username, joined=False)
+
+    def record(self, room, username, joined):
+        delta = self.pending.setdefault(room, {'joined': set(), 'left': set()})
+        added, removed = (delta['joined'], delta['left']) if joined else (delta['left'], delta['joined'])
+        # A leave followed by a join (or the reverse) within the same window cancels out
+        if username in removed:
+            removed.discard(username)
+        else:
+            added.add(username)
+        self.schedule(room)
+
+    def schedule(self, room):
+        loop = asyncio.get_running_loop()
+        scheduled_loop, handle = self.flush_handles.get(room, (None, None))
+        # A timer left behind on another (closed) event loop will never fire
+        if handle is not None and not handle.cancelled() and scheduled_loop is loop:
+            return
+        handle = loop.call_later(settings.CHAT_PRESENCE_INTERVAL_MS / 1000, self._start_flush, room)
+        self.flush_handles[room] = (loop, handle)
+
+    def _start_flush(self, room):
+        # Keep a reference to the task so it is not garbage collected while running
+        task = asyncio.ensure_future(self.flush(room))
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self, room):
+        _, handle = self.flush_handles.pop(room, (None, None))
+        if handle is not None:
+            handle.cancel()
+        delta = self.pending.pop(room, None)
+        if not delta or not (delta['joined'] or delta['left']):
+            return None
+        event = {
+            'type': 'presence.delta',
+            'joined': sorted(delta['joined']),
+            'left': sorted(delta['left']),
+            'ts': int(time.time() * 1000),
+        }
+        encoded_text, encoded_bytes = encode_event(event)
+        await get_channel_layer().group_send(
+            room_group_name(room),
+            {
+                'type': 'chat_message',
+                'text': encoded_text,
+                'bytes': encoded_bytes
+            }
+        )
+        return event
+
+
+# Tracker shared by every chat consumer of the process
+presence = PresenceTracker()
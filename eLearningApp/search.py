@@ -0,0 +1,128 @@
+import re
+import unicodedata
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, IntegerField, Max, Q, Sum, Value, When
+from .models import SearchTerm, CustomUser, Course
+
+# Indexed fields of each kind of searchable object with the weight of a match in each field
+# Emails are not indexed: their tokens (example, com...) match nearly every user and bloat the index
+SEARCH_FIELDS = {
+    SearchTerm.USER: {'username': 3, 'full_name': 2},
+    SearchTerm.COURSE: {'title': 3, 'description': 1},
+}
+
+SEARCH_MODELS = {
+    SearchTerm.USER: CustomUser,
+    SearchTerm.COURSE: Course,
+}
+
+# Query terms shorter than this only match whole terms instead of prefixes
+MIN_PREFIX_LENGTH = 2
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+# Split text into normalized lowercase terms
+def tokenize(text):
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return [token[:SearchTerm.MAX_TERM_LENGTH] for token in TOKEN_PATTERN.findall(text)]
+
+
+# Return the {term: weight} postings of an object
+def object_terms(kind, obj):
+    terms = {}
+    for field, weight in SEARCH_FIELDS[kind].items():
+        for term in tokenize(getattr(obj, field)):
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+# Replace the index entries of an object with its current terms
+def index_object(kind, obj):
+    with transaction.atomic():
+        SearchTerm.objects.filter(kind=kind, object_id=obj.pk).delete()
+        SearchTerm.objects.bulk_create([
+            SearchTerm(kind=kind, object_id=obj.pk, term=term, weight=weight)
+            for term, weight in object_terms(kind, obj).items()
+        ])
+
+
+# Remove an object from the index
+def remove_object(kind, object_id):
+    SearchTerm.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+# Rebuild the index of every object of a kind in batches, returning the number of objects indexed
+# The rebuild runs in one transaction, so searches keep using the old index until it is replaced
+def rebuild_index(kind, batch_size=1000):
+    fields = ['pk', *SEARCH_FIELDS[kind]]
+    count = 0
+    with transaction.atomic():
+        SearchTerm.objects.filter(kind=kind).delete()
+        batch = []
+        for obj in SEARCH_MODELS[kind].objects.only(*fields).order_by('pk').iterator(chunk_size=batch_size):
+            batch.extend(
+                SearchTerm(kind=kind, object_id=obj.pk, term=term, weight=weight)
+                for term, weight in object_terms(kind, obj).items()
+            )
+            count += 1
+            if len(batch) >= batch_size:
+                SearchTerm.objects.bulk_create(batch)
+                batch = []
+        SearchTerm.objects.bulk_create(batch)
+    return count
+
+
+# Highest code point, every term starting with a prefix sorts below prefix + PREFIX_END
+PREFIX_END = '\U0010ffff'
+
+
+# Condition matching the index entries of one query token
+# Prefixes are matched as a range on the term so the (kind, term) index is used on every database
+def _token_condition(token):
+    if len(token) < MIN_PREFIX_LENGTH:
+        return Q(term=token)
+    return Q(term__gte=token, term__lt=token + PREFIX_END)
+
+
+# Ranked object ids matching every token of the query, best matches first
+# Each token is a prefix lookup on the (kind, term) index, so the cost follows the size of the
+# matching postings instead of the size of the table
+def ranked_ids(kind, query):
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens:
+        return SearchTerm.objects.none().values_list('object_id', flat=True)
+
+    condition = Q()
+    matched = {}
+    for i, token in enumerate(tokens):
+        condition |= _token_condition(token)
+        # 1 when at least one entry of the object matches this token
+        matched[f'token_{i}'] = Max(Case(
+            When(_token_condition(token), then=Value(1)), default=Value(0), output_field=IntegerField()
+        ))
+
+    return (
+        SearchTerm.objects
+        .filter(condition, kind=kind)
+        .values('object_id')
+        .annotate(rank=Sum('weight'), **matched)
+        .filter(**{name: 1 for name in matched})
+        .order_by('-rank', '-object_id')
+        .values_list('object_id', flat=True)
+    )
+
+
+# Return one page of ranked search results as (objects, has_next)
+# A queryset can be given to load the objects with their related rows
+def search(kind, query, page=1, page_size=None, queryset=None):
+    page_size = page_size or settings.LISTING_PAGE_SIZE
+    offset = (max(page, 1) - 1) * page_size
+    ids = list(ranked_ids(kind, query)[offset:offset + page_size + 1])
+    has_next = len(ids) > page_size
+    ids = ids[:page_size]
+    if queryset is None:
+        queryset = SEARCH_MODELS[kind].objects.all()
+    objects = queryset.in_bulk(ids)
+    return [objects[pk] for pk in ids if pk in objects], has_next
@@ -1,9 +1,9 @@
 from django.contrib.auth.hashers import make_password
 from rest_framework import serializers
 from django.urls import reverse
-from .models import CustomUser
+from django.core.files.storage import default_storage
+from .models import CustomUser, Course, Feedback, Status, ChatMessage, MaterialUpload, Notification, ActivityEvent
 from django.core.exceptions import ValidationError
-import os
 
 # Serializer for CustomUser model
 class CustomUserSerializer(serializers.ModelSerializer):
@@ -12,19 +12,27 @@ class CustomUserSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = CustomUser
-        fields = ['url', 'id', 'username', 'password', 'email', 'full_name', 'role', 'photo', 'is_active']
+        fields = ['url', 'id', 'username', 'password', 'email', 'full_name', 'role', 'notification_mode', 'photo', 'photo_small', 'photo_large', 'is_active']
         # Set fields to optional to allow for partial update
         extra_kwargs = {
             'password': {'write_only': True, 'required': False},
             'is_active': {'read_only': True},
+            'photo_small': {'read_only': True},
+            'photo_large': {'read_only': True},
             'email': {'required': False},
             'full_name': {'required': False},
             'role': {'required': False},
+            'notification_mode': {'required': False},
             'photo': {'required': False},
         }
 
     def __init__(self, *args, **kwargs):
         super(CustomUserSerializer, self).__init__(*args, **kwargs)
+        # Only keep the fields selected with ?fields= on reads
+        selected = self.context.get('fields')
+        if selected is not None:
+            for name in set(self.fields) - set(selected):
+                self.fields.pop(name)
         # If creating a new user, set all fields to required
         if not self.instance:
             self.fields['photo'].required = True
@@ -42,19 +50,14 @@ class CustomUserSerializer(serializers.ModelSerializer):
         validated_data['is_active'] = True
         return super().create(validated_data)
 
-    # Override the update method to handle password hashing and photo removal
+    # Override the update method to handle password hashing
+    # A new photo is resized and the old files are deleted in the background (see signals.py)
     def update(self, instance, validated_data):
         # Hash the password if it is in the validated data
         password = validated_data.pop('password', None)
         if password:
             instance.set_password(password)
 
-        # If a new photo is provided, remove the old one
-        new_photo = validated_data.get('photo', None)
-        if new_photo and instance.photo:
-            if os.path.isfile(instance.photo.path):
-                os.remove(instance.photo.path)
-        
         # If no new photo is chosen, remove the photo key from validated_data
         if 'photo' in validated_data and not validated_data['photo']:
             validated_data.pop('photo')
@@ -73,3 +76,101 @@ class CustomUserSerializer(serializers.ModelSerializer):
     def get_url(self, obj):
         request = self.context.get('request')
         return request.build_absolute_uri(reverse('users-detail', args=[obj.pk]))
+
+
+# Fields of the user API that can be selected with ?fields=
+USER_READ_FIELDS = [name for name in CustomUserSerializer.Meta.fields if name != 'password']
+
+
+# Read only fast path for user listings
+# Works on .values() rows holding only the selected fields, and builds the user url from the
+# listing url computed once per page instead of calling reverse() for every user
+class CustomUserListSerializer(serializers.BaseSerializer):
+    FILE_FIELDS = ('photo', 'photo_small', 'photo_large')
+
+    def to_representation(self, row):
+        request = self.context['request']
+        data = {}
+        for name in self.context['fields']:
+            if name == 'url':
+                data['url'] = f"{self.context['users_url']}{row['id']}/"
+            elif name in self.FILE_FIELDS:
+                data[name] = request.build_absolute_uri(default_storage.url(row[name])) if row[name] else None
+            else:
+                data[name] = row[name]
+        return data
+
+
+# Read only serializer for course listings
+class CourseSerializer(serializers.ModelSerializer):
+    instructor = serializers.CharField(source='instructor.username', read_only=True)
+
+    class Meta:
+        model = Course
+        fields = ['id', 'title', 'description', 'instructor', 'enrollment_count', 'feedback_count', 'material_count']
+        read_only_fields = fields
+
+
+# Read only serializer for course feedback listings
+class FeedbackSerializer(serializers.ModelSerializer):
+    student = serializers.CharField(source='student.username', read_only=True)
+
+    class Meta:
+        model = Feedback
+        fields = ['id', 'course', 'student', 'text', 'created_at']
+        read_only_fields = fields
+
+
+# Read only serializer for status update listings
+class StatusSerializer(serializers.ModelSerializer):
+    user = serializers.CharField(source='user.username', read_only=True)
+
+    class Meta:
+        model = Status
+        fields = ['id', 'user', 'text', 'created_at']
+        read_only_fields = fields
+
+
+# Read only serializer for chat history
+class ChatMessageSerializer(serializers.ModelSerializer):
+    author = serializers.CharField(source='author.username', read_only=True)
+
+    class Meta:
+        model = ChatMessage
+        fields = ['id', 'uid', 'room', 'author', 'text', 'created_at']
+        read_only_fields = fields
+
+
+# Read only serializer for user search results
+class UserSearchSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomUser
+        fields = ['id', 'username', 'full_name', 'role']
+        read_only_fields = fields
+
+
+# Read only serializer for the state of a chunked material upload
+class MaterialUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MaterialUpload
+        fields = ['id', 'course', 'name', 'filename', 'size', 'sha256', 'received']
+        read_only_fields = fields
+
+
+# Read only serializer for the notification inbox
+class NotificationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Notification
+        fields = ['id', 'notification_type', 'message', 'read', 'created_at']
+        read_only_fields = fields
+
+
+# Serializer for the events of the activity feed
+class ActivityEventSerializer(serializers.ModelSerializer):
+    actor = serializers.CharField(source='actor.username', default=None, read_only=True)
+    course_title = serializers.CharField(source='course.title', default=None, read_only=True)
+
+    class Meta:
+        model = ActivityEvent
+        fields = ['id', 'kind', 'actor', 'course', 'course_title', 'text', 'created_at']
+        read_only_fields = fields
@@ -1,48 +1,208 @@
-from django.db.models.signals import post_save
+from django.contrib.auth.models import Group, Permission
+from django.db.models import Subquery
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from .models import Enrollment, CourseMaterial
-from .tasks import send_enrollment_notification, send_material_notification
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .models import Enrollment, CourseMaterial, CustomUser, Course, SearchTerm, Feedback, Status, ActivityEvent
+from .backends import invalidate_permission_cache, invalidate_user_cache
+from .chat import membership_cache_key
+from .search import SEARCH_FIELDS, index_object, remove_object
+from .counters import adjust_counter
+from .fragments import invalidate_fragments
+from django.core.cache import cache
+from .tasks import send_enrollment_notification, send_material_notification, fan_out_material_notification, process_profile_photo, delete_superseded_photos, fan_out_activity
+from .images import DEFAULT_PHOTO
+from .digests import queue_digest
+from .outbox import enqueue
+from .feed import create_event
 
 # Signal receiver to notify the teacher when a student enrolls in their course
+# Teachers who chose digests get the enrollment in their next digest instead (see digests.py)
 @receiver(post_save, sender=Enrollment)
 def notify_teacher_on_enrollment(sender, instance, created, **kwargs):
     if created:  # Check if a new enrollment instance was created
-        # Call the Celery task to send the enrollment notification
-        send_enrollment_notification.delay(instance.course.id, instance.student.id)
-
-        # Notify the teacher in real-time using Django Channels
-        message = f"{instance.student.full_name} has enrolled in your course: {instance.course.title}."
-        group_name = f'notifications_{instance.course.instructor.username}'
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            {
-                'type': 'user_notification',  # Specify the type of message handler
-                'notification_type': 'enrollment',  # Type of notification
-                'message': message  # The notification message
-            }
-        )
+        # Only the instructor's mode is read here, the message is built for digests alone
+        mode = Course.objects.filter(pk=instance.course_id).values_list('instructor__notification_mode', flat=True).first()
+        if mode == CustomUser.DIGEST:
+            instructor_id, title, student_name = (
+                Course.objects.filter(pk=instance.course_id)
+                .annotate(student_name=Subquery(CustomUser.objects.filter(pk=instance.student_id).values('full_name')[:1]))
+                .values_list('instructor_id', 'title', 'student_name')
+                .get()
+            )
+            queue_digest(instructor_id, 'enrollment', f"{student_name} has enrolled in your course: {title}.")
+            return
+
+        # The Celery task sends the email and the real-time notification once the enrollment is committed
+        enqueue(send_enrollment_notification, instance.course_id, instance.student_id, dedup_key=f'enrollment:{instance.pk}')
 
 # Signal receiver to notify students when new course material is added
 @receiver(post_save, sender=CourseMaterial)
 def notify_students_on_new_material(sender, instance, created, **kwargs):
     if created:  # Check if a new course material instance was created
-        # Call the Celery task to send the new material notification
-        send_material_notification.delay(instance.course.id)
-
-        # Notify each enrolled student in real-time using Django Channels
-        enrolled_students = instance.course.enrollments.all()
-        channel_layer = get_channel_layer()
-        for enrollment in enrolled_students:
-            group_name = f'notifications_{enrollment.student.username}'
-            message = f"New material added to your course: {instance.course.title}."
-            async_to_sync(channel_layer.group_send)(
-                group_name,
-                {
-                    'type': 'user_notification',  # Specify the type of message handler
-                    'notification_type': 'new_material',  # Type of notification
-                    'message': message  # The notification message
-                }
-            )
+        # Hand the email and real-time fan-out to Celery once the material is committed,
+        # so the upload request does not wait on a per-student loop or on the broker
+        enqueue(send_material_notification, instance.course_id, dedup_key=f'material:{instance.pk}:email')
+        enqueue(fan_out_material_notification, instance.course_id, dedup_key=f'material:{instance.pk}:fan_out')
+
+# Signal receiver to drop cached permissions when a user's permissions or groups change
+@receiver(m2m_changed, sender=CustomUser.user_permissions.through)
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+def invalidate_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # The instance is the user whose permissions or groups changed
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_permission_cache(instance)
+    elif action in ('post_add', 'post_remove'):
+        # The instance is a permission or group, pk_set holds the affected users
+        invalidate_permission_cache(*pk_set)
+    elif action == 'pre_clear':
+        # Remember the linked users before the relation is emptied
+        lookup = 'user_permissions' if isinstance(instance, Permission) else 'groups'
+        instance._cleared_user_ids = list(CustomUser.objects.filter(**{lookup: instance}).values_list('pk', flat=True))
+    elif action == 'post_clear':
+        invalidate_permission_cache(*getattr(instance, '_cleared_user_ids', []))
+
+# Signal receiver to drop cached permissions of every member when a group's permissions change
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        # The instance is the group, its members keep their membership
+        members = CustomUser.objects.filter(groups=instance)
+    elif reverse and action in ('post_add', 'post_remove'):
+        # The instance is a permission, pk_set holds the affected groups
+        members = CustomUser.objects.filter(groups__in=pk_set)
+    elif reverse and action == 'pre_clear':
+        # The groups are only known before the permission is removed from all of them
+        members = CustomUser.objects.filter(groups__permissions=instance)
+    else:
+        return
+    invalidate_permission_cache(*members.values_list('pk', flat=True).distinct())
+
+# Signal receiver to drop the cached row and permissions when a user is saved or deleted
+# Covers changes to is_active/is_superuser/password and ids reused after a deletion
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_saved_user_permissions(sender, instance, **kwargs):
+    invalidate_permission_cache(instance)
+    invalidate_user_cache(instance)
+
+# Signal receiver to forget the cached chat membership when a student enrolls or leaves a course
+@receiver(post_save, sender=Enrollment)
+@receiver(post_delete, sender=Enrollment)
+def invalidate_chat_membership(sender, instance, **kwargs):
+    cache.delete(membership_cache_key(instance.course_id, instance.student_id))
+
+# Signal receiver to keep the search index of users and courses up to date
+# Saves limited to fields that are not indexed, like the last_login update on each login, are skipped
+@receiver(post_save, sender=CustomUser)
+@receiver(post_save, sender=Course)
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    kind = SearchTerm.USER if sender is CustomUser else SearchTerm.COURSE
+    if update_fields is not None and not set(update_fields) & set(SEARCH_FIELDS[kind]):
+        return
+    index_object(kind, instance)
+
+# Signal receiver to drop deleted users and courses from the search index
+@receiver(post_delete, sender=CustomUser)
+@receiver(post_delete, sender=Course)
+def remove_from_search_index(sender, instance, **kwargs):
+    kind = SearchTerm.USER if sender is CustomUser else SearchTerm.COURSE
+    remove_object(kind, instance.pk)
+
+# Signal receivers to keep the enrollment, feedback and material counters of a course up to date
+@receiver(post_save, sender=Enrollment)
+@receiver(post_save, sender=Feedback)
+@receiver(post_save, sender=CourseMaterial)
+def increment_course_counter(sender, instance, created, **kwargs):
+    if created:
+        adjust_counter(sender, instance.course_id, 1)
+
+@receiver(post_delete, sender=Enrollment)
+@receiver(post_delete, sender=Feedback)
+@receiver(post_delete, sender=CourseMaterial)
+def decrement_course_counter(sender, instance, **kwargs):
+    adjust_counter(sender, instance.course_id, -1)
+
+# Signal receiver to remember the photo files a user is about to replace
+@receiver(pre_save, sender=CustomUser)
+def remember_replaced_photos(sender, instance, update_fields=None, **kwargs):
+    instance._replaced_photos = None
+    if instance.pk is None or (update_fields is not None and 'photo' not in update_fields):
+        return
+    old = CustomUser.objects.filter(pk=instance.pk).values_list('photo', 'photo_small', 'photo_large').first()
+    if old and old[0] != (instance.photo.name or ''):
+        instance._replaced_photos = [name for name in old if name]
+        # The thumbnails of the old photo do not match the new one
+        instance.photo_small = instance.photo_large = None
+
+# Signal receiver to process a new profile photo and delete the replaced files in the background
+# once the new photo is committed, instead of resizing and calling os.remove inside the request
+@receiver(post_save, sender=CustomUser)
+def process_new_photo(sender, instance, created, **kwargs):
+    replaced = getattr(instance, '_replaced_photos', None)
+    if not (created or replaced is not None):
+        return
+    photo = instance.photo.name
+    if photo and photo != DEFAULT_PHOTO:
+        enqueue(process_profile_photo, instance.pk, photo)
+    if replaced:
+        enqueue(delete_superseded_photos, instance.pk, replaced)
+
+# Fragments of a course rendered from each related model
+COURSE_FRAGMENTS = {
+    Course: ['course_header'],
+    CourseMaterial: ['course_materials', 'course_header'],
+    Enrollment: ['course_roster', 'course_header'],
+    Feedback: ['course_header'],
+}
+
+# Signal receivers to render the cached fragments of a course again when what they show changes
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+@receiver(post_save, sender=CourseMaterial)
+@receiver(post_delete, sender=CourseMaterial)
+@receiver(post_save, sender=Enrollment)
+@receiver(post_delete, sender=Enrollment)
+@receiver(post_save, sender=Feedback)
+@receiver(post_delete, sender=Feedback)
+def invalidate_course_fragments(sender, instance, **kwargs):
+    course_id = instance.pk if sender is Course else instance.course_id
+    for name in COURSE_FRAGMENTS[sender]:
+        invalidate_fragments(name, course_id)
+
+@receiver(post_save, sender=Status)
+@receiver(post_delete, sender=Status)
+def invalidate_status_feed(sender, instance, **kwargs):
+    invalidate_fragments('status_feed', instance.user_id)
+
+# Signal receiver to render the fragments showing a user's name again when it changes
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_fragments(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and not {'full_name', 'username'} & set(update_fields)):
+        return
+    invalidate_fragments('status_feed', instance.pk)
+    invalidate_fragments('course_roster', *instance.enrollments.values_list('course_id', flat=True))
+
+# Kind of activity event of each model shown in the activity feed
+ACTIVITY_KINDS = {
+    Status: ActivityEvent.STATUS,
+    CourseMaterial: ActivityEvent.MATERIAL,
+    Feedback: ActivityEvent.FEEDBACK,
+}
+
+# Signal receiver to record new statuses, materials and feedback as activity events
+# The copies into the feeds of the course members are written by a Celery task through the outbox
+@receiver(post_save, sender=Status)
+@receiver(post_save, sender=CourseMaterial)
+@receiver(post_save, sender=Feedback)
+def record_activity(sender, instance, created, **kwargs):
+    if created:
+        event = create_event(ACTIVITY_KINDS[sender], instance)
+        enqueue(fan_out_activity, event.pk, dedup_key=f'activity:{event.pk}')
+
+# Signal receiver to remove deleted statuses, materials and feedback from the feeds
+@receiver(post_delete, sender=Status)
+@receiver(post_delete, sender=CourseMaterial)
+@receiver(post_delete, sender=Feedback)
+def remove_activity(sender, instance, **kwargs):
+    ActivityEvent.objects.filter(kind=ACTIVITY_KINDS[sender], object_id=instance.pk).delete()
@@ -1,39 +1,163 @@
+import logging
+from smtplib import SMTPException
 from celery import shared_task
-from django.core.mail import send_mail
-from .models import CustomUser, Course
+from django.conf import settings
+from celery.utils.time import get_exponential_backoff_interval
+from django.core.mail import EmailMessage, send_mail, get_connection
+from django.db.models import Subquery
+from .models import CustomUser, Course, Enrollment
+from .notifications import notify_users
+from .images import process_photo, delete_photos
+from .backends import invalidate_user_cache
+from .digests import pending_recipients, send_digest
+from .outbox import relay, purge_dispatched
+from .feed import fan_out, trim_timelines
+from .metrics import record_items
+
+logger = logging.getLogger(__name__)
 
 # Task to send an email notification to the teacher when a student enrolls in a course
-@shared_task
+@shared_task(autoretry_for=(SMTPException, OSError), retry_backoff=True, retry_backoff_max=600, max_retries=5)
 def send_enrollment_notification(course_id, student_id):
-    # Retrieve the course and student objects based on their IDs
-    course = Course.objects.get(id=course_id)
-    student = CustomUser.objects.get(id=student_id)
-    
-    
+    # Fetch the course title, the instructor and the student's name in a single query
+    row = (
+        Course.objects.filter(id=course_id)
+        .annotate(student_name=Subquery(CustomUser.objects.filter(id=student_id).values('full_name')[:1]))
+        .values_list('title', 'instructor_id', 'instructor__username', 'instructor__email', 'student_name')
+        .first()
+    )
+    if row is None:
+        return
+    course_title, instructor_id, instructor_username, instructor_email, student_name = row
+
     subject = 'New Enrollment'
-    message = f'{student.full_name} has enrolled in your course: {course.title}.'
+    message = f'{student_name} has enrolled in your course: {course_title}.'
     
-    # The recipient of the email is the course instructor
-    recipient_list = [course.instructor.email]
-    
-    # Send the email
-    send_mail(subject, message, 'admin@elearning.com', recipient_list)
+    # Send the email to the course instructor
+    send_mail(subject, message, 'admin@elearning.com', [instructor_email])
+
+    # Notify the teacher in real-time using Django Channels, keeping it in their inbox
+    notify_users([(instructor_id, instructor_username)], 'enrollment', message)
+
+# Task to tell the teacher with one email and one real-time notification about a bulk enrollment
+@shared_task(autoretry_for=(SMTPException, OSError), retry_backoff=True, retry_backoff_max=600, max_retries=5)
+def send_bulk_enrollment_notification(course_id, count):
+    course = Course.objects.select_related('instructor').get(id=course_id)
+    message = f'{count} student{"s" if count != 1 else ""} enrolled in your course: {course.title}.'
+
+    send_mail('New Enrollments', message, 'admin@elearning.com', [course.instructor.email])
+    notify_users([(course.instructor_id, course.instructor.username)], 'enrollment', message)
+
+# Periodic task handing the side effects recorded in the outbox to the broker
+@shared_task
+def relay_outbox():
+    dispatched = relay()
+    purge_dispatched()
+    return dispatched
+
+# Periodic task sending the pending notification digests, one task per recipient
+@shared_task
+def flush_notification_digests():
+    recipients = pending_recipients()
+    for recipient_id in recipients:
+        send_notification_digest.delay(recipient_id)
+    return len(recipients)
+
+# Task to send the digest of one user, failed emails are retried with their entries put back
+@shared_task(autoretry_for=(SMTPException, OSError), retry_backoff=True, retry_backoff_max=600, max_retries=5)
+def send_notification_digest(recipient_id):
+    return send_digest(recipient_id)
 
 # Task to send an email notification to all students when new material is added to a course
 @shared_task
 def send_material_notification(course_id):
-    # Retrieve the course object based on its ID
-    course = Course.objects.get(id=course_id)
-    
-    # Get all students enrolled in the course
-    students = course.enrollments.all()
-    
+    # Fetch the course title and every enrolled student's address in a single join query
+    rows = list(Enrollment.objects.filter(course_id=course_id).values_list('course__title', 'student__email'))
+    if not rows:
+        return 0
+    course_title = rows[0][0]
+    recipients = [email for _, email in rows]
+
+    # Split the recipients into batches, each delivered and retried on its own
+    batch_size = settings.MATERIAL_EMAIL_BATCH_SIZE
+    for start in range(0, len(recipients), batch_size):
+        send_material_email_batch.delay(course_title, recipients[start:start + batch_size])
+    return len(recipients)
+
+# Task to deliver one batch of new material emails over a single mail connection
+# Every student receives their own message so addresses are never disclosed to each other
+# When sending fails, only the recipients not reached yet are retried, so nobody gets the email twice
+@shared_task(bind=True, max_retries=5)
+def send_material_email_batch(self, course_title, recipients):
     # Define the email subject and message
     subject = 'New Course Material'
-    message = f'New material has been added to your course: {course.title}.'
-    
-    # Create a list of email addresses for all enrolled students
-    recipient_list = [student.student.email for student in students]
-    
-    # Send the email to all students
-    send_mail(subject, message, 'admin@elearning.com', recipient_list)
+    message = f'New material has been added to your course: {course_title}.'
+
+    # Send the messages one by one through one connection and record the throughput
+    sent = 0
+    try:
+        with get_connection() as connection:
+            for recipient in recipients:
+                connection.send_messages([EmailMessage(subject, message, 'admin@elearning.com', [recipient])])
+                sent += 1
+    except (SMTPException, OSError) as error:
+        countdown = get_exponential_backoff_interval(1, self.request.retries, 600, full_jitter=True)
+        raise self.retry(args=(course_title, recipients[sent:]), exc=error, countdown=countdown)
+    finally:
+        record_items(self.name, sent)
+    return sent
+
+# Task to notify all enrolled students in real-time when new material is added to a course
+@shared_task
+def fan_out_material_notification(course_id):
+    # Fetch the course title with the ids and usernames of all enrolled students in a single join query
+    rows = list(Enrollment.objects.filter(course_id=course_id).values_list('course__title', 'student_id', 'student__username'))
+    if not rows:
+        return 0
+
+    # Store and push the notification to the students in batches
+    message = f"New material added to your course: {rows[0][0]}."
+    return notify_users([(student_id, username) for _, student_id, username in rows], 'new_material', message)
+
+
+# Task to copy a new activity event into the feeds of the course members
+@shared_task
+def fan_out_activity(event_id):
+    return fan_out(event_id)
+
+
+# Periodic task dropping the events beyond FEED_TIMELINE_SIZE from the feeds in the database
+@shared_task
+def trim_activity_feeds():
+    return trim_timelines()
+
+
+# Task to turn an uploaded profile photo into a metadata free photo and thumbnails with hashed names
+@shared_task
+def process_profile_photo(user_id, source_name):
+    try:
+        names = process_photo(user_id, source_name)
+    except (OSError, ValueError):
+        # Missing or unreadable uploads keep being served as they are
+        logger.warning('Could not process profile photo %s of user %s', source_name, user_id, exc_info=True)
+        return None
+    # Only apply the result if the user did not upload another photo meanwhile
+    updated = CustomUser.objects.filter(pk=user_id, photo=source_name).update(**names)
+    if not updated:
+        delete_photos(names.values(), keep=current_photos(user_id))
+        return None
+    # update() skips post_save, the cached user still points at the old files
+    invalidate_user_cache(user_id)
+    # The upload itself is superseded by the processed photo
+    delete_photos([source_name], keep=names.values())
+    return names
+
+# Task to delete the photo files a user no longer uses
+@shared_task
+def delete_superseded_photos(user_id, names):
+    delete_photos(names, keep=current_photos(user_id))
+
+# Names of the photo files a user currently references
+def current_photos(user_id):
+    row = CustomUser.objects.filter(pk=user_id).values_list('photo', 'photo_small', 'photo_large').first()
+    return [name for name in row or () if name]
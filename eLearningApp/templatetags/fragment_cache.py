@@ -0,0 +1,49 @@
+from django import template
+from django.conf import settings
+from django.core.cache import cache
+from eLearningApp.fragments import fragment_key, record_access
+
+register = template.Library()
+
+
+# Renders its content once per fragment version and variant, serving the cached HTML afterwards
+# The querysets used inside the block are only evaluated on a miss
+class FragmentCacheNode(template.Node):
+    def __init__(self, nodelist, name, version, variant, skip=None):
+        self.nodelist = nodelist
+        self.name = name
+        self.version = version
+        self.variant = variant
+        self.skip = skip
+
+    def render(self, context):
+        if self.skip is not None and self.skip.resolve(context):
+            return self.nodelist.render(context)
+        name = self.name.resolve(context)
+        key = fragment_key(name, self.version.resolve(context), [value.resolve(context) for value in self.variant])
+        value = cache.get(key)
+        record_access(name, value is not None)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, settings.FRAGMENT_CACHE_TIMEOUT)
+        return value
+
+
+# {% cachefragment "name" version [variant ...] [unless condition] %} ... {% endcachefragment %}
+# The block is rendered without the cache when the condition is true. Variants should only take a few
+# values: never key a fragment on raw client input such as a pagination cursor, skip the cache instead
+# Never put a form's {% csrf_token %} inside the block, the token belongs to one session
+@register.tag('cachefragment')
+def do_cachefragment(parser, token):
+    bits = token.split_contents()
+    skip = None
+    if len(bits) >= 2 and bits[-2] == 'unless':
+        skip = parser.compile_filter(bits[-1])
+        bits = bits[:-2]
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' takes at least a fragment name and a version")
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    return FragmentCacheNode(
+        nodelist, parser.compile_filter(bits[1]), parser.compile_filter(bits[2]), [parser.compile_filter(bit) for bit in bits[3:]], skip
+    )
@@ -1,4 +1,8 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction, OperationalError
+from django.utils import timezone
+from unittest import mock
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from rest_framework import status
@@ -6,6 +10,44 @@ from rest_framework.test import APITestCase
 from django.core.files.uploadedfile import SimpleUploadedFile
 import os
 from django.conf import settings
+from .models import Course, CourseMaterial, Enrollment, Feedback, Status, ChatMessage, SearchTerm, MaterialUpload, DigestEntry, Notification, OutboxMessage, ActivityEvent, TimelineEntry
+from .pagination import paginate_keyset
+from .search import search, rebuild_index
+from .counters import reconcile_counters, adjust_counter
+from . import enrollment
+from .notifications import notification_group_name, unread_count
+from .tasks import fan_out_material_notification, send_material_notification, send_material_email_batch, flush_notification_digests, relay_outbox, send_enrollment_notification
+from .metrics import task_metrics
+from .fragments import fragment_stats
+from .feed import read_timeline
+from .digests import send_digest
+from .signals import notify_students_on_new_material
+from eLearning.celery import app as celery_app
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+import json
+import msgpack
+from .consumers import ChatConsumer, NotificationConsumer
+from .chat import message_writer
+from .presence import presence
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from smtplib import SMTPException
+from django.core.management import call_command
+from io import StringIO
+import tempfile
+import io
+import hashlib
+import uuid
+from datetime import timedelta
+import threading
+from django.db import connections
+from django.core.cache import cache, caches
+from django.contrib.auth.models import Group, Permission, AnonymousUser
+from django.contrib.auth import get_user as get_session_user
+from django.test import RequestFactory
+from importlib import import_module
 
 # User Testing
 class CustomUserModelTests(TestCase):
@@ -124,3 +166,1287 @@ class UserAPITests(APITestCase):
         test_image_path = os.path.join(settings.MEDIA_ROOT, 'profile_photos', 'sample_image.png')
         if os.path.exists(test_image_path):
             os.remove(test_image_path)
+
+
+# User API listing testing
+@override_settings(USER_API_PAGE_SIZE=2)
+class UserListAPITests(APITestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser(
+            username='listadmin',
+            email='listadmin@example.com',
+            password='AdminPass123',
+        )
+        get_user_model().objects.bulk_create([
+            get_user_model()(username=f'lister{i}', email=f'lister{i}@example.com', role='teacher' if i % 2 else 'student', is_active=i != 3)
+            for i in range(5)
+        ])
+        self.client.force_authenticate(user=self.admin)
+
+    # Test that listings are paginated, filtered and limited to the selected fields in one query
+    def test_filtered_field_selection(self):
+        url = reverse('users-list')
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'role': 'teacher', 'fields': 'username,url'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['username'] for user in response.data['results']], ['lister1', 'lister3'])
+        self.assertEqual(set(response.data['results'][0]), {'url', 'username'})
+        self.assertTrue(response.data['results'][0]['url'].endswith(f"/users/{get_user_model().objects.get(username='lister1').pk}/"))
+        self.assertIsNone(response.data['next'])
+        response = self.client.get(url, {'is_active': 'false', 'fields': 'username'})
+        self.assertEqual(response.data['results'], [{'username': 'lister3'}])
+        self.assertEqual(self.client.get(url, {'fields': 'password'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Test that an unchanged page is revalidated with its ETag
+    def test_conditional_get(self):
+        url = reverse('users-list')
+        response = self.client.get(url)
+        self.assertIsNotNone(response.data['next'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        get_user_model().objects.filter(pk=self.admin.pk).update(full_name='Changed Admin')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+# Course detail page query budget testing
+class CourseDetailQueryBudgetTests(TestCase):
+    # Maximum number of queries the course detail page may issue, independent of course size
+    QUERY_BUDGET = 12
+
+    def setUp(self):
+        cache.clear()
+        self.teacher = get_user_model().objects.create_user(
+            username='budgetteacher',
+            email='budgetteacher@example.com',
+            password='TeacherPass123',
+            role='teacher',
+        )
+        self.course = Course.objects.create(
+            title='Query Budget Course',
+            description='A course used to measure queries',
+            instructor=self.teacher,
+        )
+
+    # Helper to add students, enrollments, feedbacks and materials without firing notifications
+    def populate(self, count, offset=0):
+        students = get_user_model().objects.bulk_create([
+            get_user_model()(username=f'student{offset + i}', email=f'student{offset + i}@example.com')
+            for i in range(count)
+        ])
+        Enrollment.objects.bulk_create([Enrollment(student=student, course=self.course) for student in students])
+        Feedback.objects.bulk_create([
+            Feedback(student=student, course=self.course, text='Great course') for student in students
+        ])
+        CourseMaterial.objects.bulk_create([
+            CourseMaterial(course=self.course, name=f'Material {offset + i}', file=f'course_materials/m{offset + i}.pdf')
+            for i in range(count)
+        ])
+        return students
+
+    # Helper to render the course detail page and return the number of queries it took
+    def count_queries(self, user):
+        # Measure the rendering of every fragment, not the cached copies
+        cache.clear()
+        self.client.force_login(user)
+        url = reverse('course_detail', args=[self.course.id])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    # Test that the instructor view stays within budget and does not grow with enrollments or feedbacks
+    def test_instructor_query_count_is_constant(self):
+        self.populate(3)
+        small = self.count_queries(self.teacher)
+        self.populate(50, offset=3)
+        large = self.count_queries(self.teacher)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, self.QUERY_BUDGET)
+
+    # Test that the enrolled student view stays within budget and does not grow with course size
+    def test_student_query_count_is_constant(self):
+        student = self.populate(3)[0]
+        small = self.count_queries(student)
+        self.populate(50, offset=3)
+        large = self.count_queries(student)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, self.QUERY_BUDGET)
+
+
+# Keyset pagination testing for the status, feedback and course listings
+@override_settings(LISTING_PAGE_SIZE=5, FEED_REDIS_URL='')
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username='pageuser',
+            email='pageuser@example.com',
+            password='PagePass123',
+            photo='profile_photos/pageuser.png',
+        )
+        self.client.force_login(self.user)
+        Status.objects.bulk_create([Status(user=self.user, text=f'Status {i}') for i in range(12)])
+
+    # Test that following the cursors walks every status exactly once, newest first
+    def test_paginate_keyset_walks_all_rows(self):
+        seen = []
+        cursor = None
+        while True:
+            page = paginate_keyset(Status.objects.filter(user=self.user), cursor=cursor)
+            self.assertLessEqual(len(page), 5)
+            seen.extend(status.id for status in page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        expected = list(Status.objects.filter(user=self.user).order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    # Test that an invalid cursor restarts the listing instead of failing
+    def test_invalid_cursor_returns_first_page(self):
+        page = paginate_keyset(Status.objects.filter(user=self.user), cursor='not-a-cursor')
+        self.assertEqual(len(page), 5)
+
+    # Test that the home page only renders one page of status updates
+    def test_home_renders_one_page(self):
+        response = self.client.get(reverse('home', args=[self.user.username]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['status_updates']), 5)
+        self.assertTrue(response.context['status_updates'].has_next)
+
+    # Test the cursor paginated status API
+    def test_status_api_is_paginated(self):
+        response = self.client.get(reverse('api_user_statuses', args=[self.user.username]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertIsNotNone(response.data['next'])
+
+
+# Base class for tests that exercise signal side effects
+# Celery tasks run eagerly and the channel layer is kept in memory, so no broker or Redis is needed
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}, FEED_REDIS_URL='')
+class SideEffectTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+        # Consumers run their queries through database_sync_to_async, which closes the old connections
+        # around each call, including the one holding the test transaction on any database but in-memory SQLite
+        patcher = mock.patch('channels.db.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Helper to dispatch the side effects recorded in the outbox, which run at once in eager mode
+    def relay(self):
+        return relay_outbox()
+
+    # Helper to subscribe a fresh channel to a group and return the channel name
+    def listen(self, group):
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(group, channel)
+        return channel
+
+    # Helper to read the next event delivered to a channel
+    def receive(self, channel):
+        return async_to_sync(get_channel_layer().receive)(channel)
+
+
+# Base class providing a teacher, a course and five enrolled students
+class EnrolledCourseTestCase(SideEffectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.teacher = get_user_model().objects.create_user(
+            username='fanoutteacher',
+            email='fanoutteacher@example.com',
+            password='TeacherPass123',
+            role='teacher',
+        )
+        self.course = Course.objects.create(
+            title='Fan-out Course',
+            description='A course used to test notifications',
+            instructor=self.teacher,
+        )
+        self.students = get_user_model().objects.bulk_create([
+            get_user_model()(username=f'fanout{i}', email=f'fanout{i}@example.com') for i in range(5)
+        ])
+        Enrollment.objects.bulk_create([Enrollment(student=student, course=self.course) for student in self.students])
+
+
+# New material notification fan-out testing
+class MaterialNotificationTests(EnrolledCourseTestCase):
+    # Test that the notifications are only recorded in the outbox, once, until it is relayed
+    def test_fan_out_waits_for_relay(self):
+        material = CourseMaterial.objects.create(course=self.course, name='Slides', file='course_materials/slides.pdf')
+        notify_students_on_new_material(CourseMaterial, material, created=True)
+        # Two material notifications and the activity feed fan-out
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.relay(), 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(self.relay(), 0)
+
+    # Test that every enrolled student is notified after commit
+    def test_fan_out_notifies_every_student(self):
+        channels = [self.listen(notification_group_name(student.username)) for student in self.students]
+        CourseMaterial.objects.create(course=self.course, name='Slides', file='course_materials/slides.pdf')
+        self.relay()
+        for student, channel in zip(self.students, channels):
+            event = self.receive(channel)
+            self.assertEqual(event['notification_type'], 'new_material')
+            self.assertIn(self.course.title, event['message'])
+            # The inbox id lets the client mark the live notification as read
+            self.assertEqual(event['id'], Notification.objects.get(user=student, notification_type='new_material').id)
+
+    # Test that the fan-out task loads the recipients in one join query and stores their notifications at once
+    def test_fan_out_query_count(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(fan_out_material_notification(self.course.id), 5)
+
+
+# Bulk enrollment testing
+@override_settings(ENROLLMENT_BATCH_SIZE=2)
+class BulkEnrollmentTests(EnrolledCourseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.newcomers = get_user_model().objects.bulk_create([
+            get_user_model()(username=f'cohort{i}', email=f'cohort{i}@example.com') for i in range(3)
+        ])
+
+    # Test a CSV roster upload, sending one aggregated notification to the teacher
+    def test_csv_roster_upload(self):
+        channel = self.listen(notification_group_name(self.teacher.username))
+        roster = SimpleUploadedFile(
+            'roster.csv', b'email\ncohort0@example.com\ncohort1@example.com\ncohort2\nfanout0\nnobody\n', content_type='text/csv'
+        )
+        self.client.force_login(self.teacher)
+        response = self.client.post(reverse('api_bulk_enrollment', args=[self.course.id]), {'roster': roster})
+        self.relay()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'total': 5, 'processed': 5, 'enrolled': 3, 'already_enrolled': 1, 'not_found': ['nobody'],
+        })
+        self.assertEqual(Enrollment.objects.filter(course=self.course).count(), 8)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('3 students enrolled', mail.outbox[0].body)
+        self.assertIn('3 students enrolled', self.receive(channel)['message'])
+
+    # Test that only the course teacher may import a roster
+    def test_json_roster_requires_teacher(self):
+        self.client.force_login(self.students[0])
+        response = self.client.post(
+            reverse('api_bulk_enrollment', args=[self.course.id]), {'students': ['cohort0']}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Enrollment.objects.filter(student=self.newcomers[0]).exists())
+
+    # Test that students inserted first by a concurrent import are neither counted nor reported twice
+    def test_concurrent_import_is_not_counted_twice(self):
+        reconcile_counters()
+        insert = enrollment._insert_enrollments
+
+        # The other import commits one of the students between the lookup and the insert of this one
+        def racing_insert(course, student_ids):
+            adjust_counter(Enrollment, course.pk, len(insert(course, {self.newcomers[0].pk})))
+            return insert(course, student_ids)
+
+        with mock.patch.object(enrollment, '_insert_enrollments', side_effect=racing_insert):
+            report = enrollment.bulk_enroll(self.course, [student.username for student in self.newcomers])
+        self.assertEqual((report['enrolled'], report['already_enrolled']), (2, 1))
+        self.assertEqual(Course.objects.get(pk=self.course.pk).enrollment_count, 8)
+        self.assertEqual(reconcile_counters(), 0)
+        self.assertLess(timezone.now() - Enrollment.objects.get(student=self.newcomers[1]).date_enrolled, timedelta(minutes=1))
+
+    # Test the roster import command and its progress report
+    def test_enroll_roster_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as roster:
+            json.dump([{'username': 'cohort0'}, 'cohort1@example.com', 'cohort2'], roster)
+        self.addCleanup(os.remove, roster.name)
+        out = StringIO()
+        call_command('enroll_roster', self.course.id, roster.name, stdout=out)
+        self.assertIn('2/3 processed: 2 enrolled', out.getvalue())
+        self.assertIn('Enrolled 3 students', out.getvalue())
+        self.assertEqual(Enrollment.objects.filter(course=self.course).count(), 8)
+
+
+# Idempotent enrollment testing
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class IdempotentEnrollmentTests(TransactionTestCase):
+    THREADS = 8
+
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+        self.teacher = get_user_model().objects.create_user(
+            username='raceteacher', email='raceteacher@example.com', password='TeacherPass123', role='teacher',
+            notification_mode=get_user_model().IMMEDIATE,
+        )
+        self.course = Course.objects.create(title='Race Course', description='Enrolled concurrently', instructor=self.teacher)
+        self.student = get_user_model().objects.create_user(
+            username='racestudent', email='racestudent@example.com', password='StudentPass123',
+        )
+
+    # Test that concurrent enroll requests insert one row and notify the teacher once
+    def test_concurrent_enroll_requests(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('In-memory SQLite locks whole tables across threads')
+        barrier = threading.Barrier(self.THREADS)
+        responses = []
+
+        def post():
+            try:
+                client = self.client_class()
+                client.force_login(self.student)
+                barrier.wait()
+                responses.append(client.post(reverse('enroll_in_course', args=[self.course.id])).status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses, [302] * self.THREADS)
+        self.assertEqual(Enrollment.objects.filter(student=self.student, course=self.course).count(), 1)
+        # The notification is recorded in the outbox and sent once relayed
+        self.assertEqual(len(mail.outbox), 0)
+        relay_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+
+    # Test that enrolling and unenrolling only accept POST and report the resulting state
+    def test_enrollment_is_post_only_and_idempotent(self):
+        self.client.force_login(self.student)
+        self.assertEqual(self.client.get(reverse('enroll_in_course', args=[self.course.id])).status_code, 405)
+        self.assertEqual(self.client.get(reverse('unenroll_from_course', args=[self.course.id])).status_code, 405)
+        url = reverse('api_enrollment', args=[self.course.id])
+        self.assertEqual(self.client.post(url).json(), {'enrolled': True, 'changed': True})
+        self.assertEqual(self.client.post(url).json(), {'enrolled': True, 'changed': False})
+        self.assertEqual(self.client.delete(url).json(), {'enrolled': False, 'changed': True})
+        self.assertEqual(self.client.delete(url).json(), {'enrolled': False, 'changed': False})
+
+
+# Course counter testing
+class CourseCounterTests(EnrolledCourseTestCase):
+    # Helper to read the counters of the course from the database
+    def counters(self):
+        return Course.objects.values_list('enrollment_count', 'feedback_count', 'material_count').get(pk=self.course.pk)
+
+    # Test that signals move the counters and the reconcile command fixes rows added in bulk
+    def test_counters_follow_changes(self):
+        call_command('reconcile_course_counters', stdout=StringIO())
+        self.assertEqual(self.counters(), (5, 0, 0))
+        extra = get_user_model().objects.create_user(username='counted', email='counted@example.com')
+        Enrollment.objects.create(student=extra, course=self.course)
+        feedback = Feedback.objects.create(student=extra, course=self.course, text='Nice')
+        CourseMaterial.objects.create(course=self.course, name='Slides', file='course_materials/slides.pdf')
+        self.assertEqual(self.counters(), (6, 1, 1))
+        feedback.delete()
+        Enrollment.objects.filter(course=self.course, student__in=self.students[:2]).delete()
+        self.assertEqual(self.counters(), (4, 0, 1))
+        self.assertEqual(reconcile_counters(), 0)
+
+    # Test that saving a course loaded before a counter moved keeps the new count
+    def test_stale_save_keeps_counters(self):
+        reconcile_counters()
+        stale = Course.objects.get(pk=self.course.pk)
+        extra = get_user_model().objects.create_user(username='counted', email='counted@example.com')
+        Enrollment.objects.create(student=extra, course=self.course)
+        stale.title = 'Renamed Fan-out Course'
+        stale.save()
+        self.assertEqual(self.counters(), (6, 0, 0))
+        self.assertEqual(Course.objects.get(pk=self.course.pk).title, 'Renamed Fan-out Course')
+
+        self.client.force_login(self.teacher)
+        self.client.post(reverse('course_detail', args=[self.course.pk]), {
+            'update_course_details': '', 'title': 'Fan-out Course Again', 'description': stale.description,
+        })
+        self.assertEqual(Course.objects.get(pk=self.course.pk).title, 'Fan-out Course Again')
+        self.assertEqual(self.counters(), (6, 0, 0))
+
+    # Test that popular courses are listed by enrollment count
+    def test_popular_sort(self):
+        reconcile_counters()
+        quiet = Course.objects.create(title='A Quiet Course', description='Nobody here yet', instructor=self.teacher)
+        self.client.force_login(self.teacher)
+        response = self.client.get(reverse('api_courses'), {'sort': 'popular'})
+        self.assertEqual([course['id'] for course in response.data['results']], [self.course.id, quiet.id])
+        self.assertEqual(response.data['results'][0]['enrollment_count'], 5)
+
+    # Test that following the cursors of the popular listing walks courses with tied counts exactly once
+    def test_popular_sort_pages_through_ties(self):
+        reconcile_counters()
+        quiet = [
+            Course.objects.create(title=f'Quiet Course {index}', description='Nobody here yet', instructor=self.teacher)
+            for index in range(5)
+        ]
+        self.client.force_login(self.teacher)
+        seen = []
+        response = self.client.get(reverse('api_courses'), {'sort': 'popular', 'page_size': 2})
+        while True:
+            seen.extend(course['id'] for course in response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, [self.course.id] + [course.id for course in reversed(quiet)])
+
+
+# Celery task query count, routing and metrics testing
+class TaskEfficiencyTests(EnrolledCourseTestCase):
+    # Test that the enrollment notification loads everything in one query besides storing the notification
+    def test_enrollment_notification_query_count(self):
+        with self.assertNumQueries(2):
+            send_enrollment_notification.delay(self.course.id, self.students[0].id)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.teacher.email])
+        self.assertIn(self.course.title, mail.outbox[0].body)
+
+    # Test that transactional and bulk mail tasks are routed to separate queues
+    def test_task_routing(self):
+        def queue(task):
+            return celery_app.amqp.router.route({}, task.name)['queue'].name
+        self.assertEqual(queue(send_enrollment_notification), 'transactional')
+        self.assertEqual(queue(send_material_notification), 'bulk')
+        self.assertEqual(queue(relay_outbox), 'default')
+
+    # Test that the runs and runtime of each task are recorded
+    def test_task_metrics(self):
+        fan_out_material_notification.delay(self.course.id)
+        fan_out_material_notification.delay(self.course.id)
+        metrics = task_metrics()[fan_out_material_notification.name]
+        self.assertEqual((metrics['runs'], metrics['failures']), (2, 0))
+        self.assertIsNotNone(metrics['avg_ms'])
+
+
+# Transactional outbox testing
+class OutboxTests(EnrolledCourseTestCase):
+    # Test that a rolled back change records no side effect
+    def test_rollback_sends_nothing(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            CourseMaterial.objects.create(course=self.course, name='Draft', file='course_materials/draft.pdf')
+            raise RuntimeError
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(self.relay(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    # Test that a failed dispatch is retried later instead of being lost
+    def test_failed_dispatch_is_retried(self):
+        CourseMaterial.objects.create(course=self.course, name='Slides', file='course_materials/slides.pdf')
+        with mock.patch.object(send_material_notification, 'apply_async', side_effect=OSError):
+            # The activity feed fan-out is still dispatched
+            self.assertEqual(self.relay(), 2)
+        message = OutboxMessage.objects.get(dispatched_at__isnull=True)
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(self.relay(), 0)
+        OutboxMessage.objects.filter(pk=message.pk).update(available_at=timezone.now())
+        self.assertEqual(self.relay(), 1)
+        self.assertEqual(len(mail.outbox), 5)
+
+
+    # Test that a message failing too many times is logged, kept apart, requeued on demand and purged later
+    @override_settings(OUTBOX_MAX_ATTEMPTS=1)
+    def test_dead_message_is_requeued_or_purged(self):
+        CourseMaterial.objects.create(course=self.course, name='Slides', file='course_materials/slides.pdf')
+        with mock.patch.object(send_material_notification, 'apply_async', side_effect=OSError), \
+                self.assertLogs('eLearningApp.outbox', 'ERROR'):
+            self.relay()
+        message = OutboxMessage.objects.get(failed_at__isnull=False)
+        OutboxMessage.objects.filter(pk=message.pk).update(available_at=timezone.now())
+        self.assertEqual(self.relay(), 0)
+
+        out = StringIO()
+        call_command('relay_outbox', '--requeue-failed', str(message.pk), stdout=out)
+        self.assertIn('Requeued 1', out.getvalue())
+        self.assertEqual(self.relay(), 1)
+        self.assertEqual(len(mail.outbox), 5)
+
+        OutboxMessage.objects.filter(pk=message.pk).update(dispatched_at=None, failed_at=timezone.now() - timedelta(days=30))
+        call_command('relay_outbox', '--once', stdout=out)
+        self.assertFalse(OutboxMessage.objects.filter(pk=message.pk).exists())
+
+
+# Notification inbox testing
+class NotificationInboxTests(EnrolledCourseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.student = self.students[0]
+        fan_out_material_notification(self.course.id)
+        fan_out_material_notification(self.course.id)
+
+    # Test that pushed notifications are stored with a cached unread count and marked read in bulk
+    def test_unread_count_and_mark_read(self):
+        self.assertEqual(Notification.objects.filter(user=self.student, notification_type='new_material').count(), 2)
+        self.assertEqual(unread_count(self.student.pk), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_count(self.student.pk), 2)
+
+        self.client.force_login(self.student)
+        response = self.client.get(reverse('api_notifications'), {'unread': 'true'})
+        first = response.data['results'][0]['id']
+        response = self.client.post(reverse('api_notifications_read'), {'ids': [first]}, content_type='application/json')
+        self.assertEqual(response.json(), {'marked': 1, 'unread_count': 1})
+        response = self.client.post(reverse('api_notifications_read'), {}, content_type='application/json')
+        self.assertEqual(response.json(), {'marked': 1, 'unread_count': 0})
+        self.assertEqual(len(self.client.get(reverse('api_notifications'), {'unread': 'true'}).data['results']), 0)
+        self.assertEqual(unread_count(self.students[1].pk), 2)
+
+    # Test that unread notifications sent while offline are replayed on connect
+    async def test_backlog_replayed_on_connect(self):
+        communicator = WebsocketClient(NotificationConsumer, '/ws/notifications/', self.student, {})
+        response = await communicator.connect()
+        self.assertEqual(response['type'], 'websocket.accept')
+        replayed = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertTrue(all(event['replayed'] and event['notification_type'] == 'new_material' for event in replayed))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+# Activity feed testing
+@override_settings(LISTING_PAGE_SIZE=2)
+class ActivityFeedTests(EnrolledCourseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.student = self.students[0]
+        self.material = CourseMaterial.objects.create(course=self.course, name='Slides', file='course_materials/slides.pdf')
+        Status.objects.create(user=self.teacher, text='Office hours moved')
+        Feedback.objects.create(course=self.course, student=self.student, text='Great course')
+
+    # Test that new activity reaches the feeds once relayed, newest first, one page at a time
+    def test_feed_is_fanned_out_and_paginated(self):
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.relay()
+        page = read_timeline(self.student.pk)
+        self.assertEqual([event.kind for event in page], [ActivityEvent.FEEDBACK, ActivityEvent.STATUS])
+        self.assertEqual([event.kind for event in read_timeline(self.student.pk, page.next_cursor)], [ActivityEvent.MATERIAL])
+        # Feedback only reaches its author and the teacher
+        self.assertEqual(len(read_timeline(self.students[1].pk)), 2)
+
+        self.client.force_login(self.student)
+        response = self.client.get(reverse('api_feed'))
+        self.assertEqual([event['text'] for event in response.data['results']], ['Great course', 'Office hours moved'])
+        self.assertEqual(response.data['results'][0]['course_title'], self.course.title)
+        response = self.client.get(reverse('api_feed'), {'cursor': response.data['next']})
+        self.assertEqual([event['text'] for event in response.data['results']], ['Slides'])
+        self.assertIsNone(response.data['next'])
+
+        # Deleted objects disappear from the feeds
+        self.material.delete()
+        self.assertEqual(TimelineEntry.objects.filter(user=self.student).count(), 2)
+
+    # Test that existing objects are backfilled once and feeds are trimmed to their size
+    def test_backfill_and_trim(self):
+        ActivityEvent.objects.all().delete()
+        out = StringIO()
+        call_command('backfill_activity_feed', stdout=out)
+        self.assertIn('Created 3', out.getvalue())
+        call_command('backfill_activity_feed', stdout=out)
+        self.assertIn('Created 0', out.getvalue())
+        self.assertEqual(TimelineEntry.objects.filter(user=self.teacher).count(), 3)
+
+        with self.settings(FEED_TIMELINE_SIZE=1):
+            call_command('trim_activity_feed', stdout=out)
+        self.assertEqual(TimelineEntry.objects.filter(user=self.teacher).count(), 1)
+        self.assertEqual(TimelineEntry.objects.filter(user=self.students[1]).count(), 1)
+
+
+# Enrollment notification digest testing
+class NotificationDigestTests(SideEffectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.teacher = get_user_model().objects.create_user(
+            username='digestteacher',
+            email='digestteacher@example.com',
+            role='teacher',
+            notification_mode=get_user_model().DIGEST,
+        )
+        self.course = Course.objects.create(title='Digest Course', description='Popular', instructor=self.teacher)
+        self.students = [
+            get_user_model().objects.create_user(username=f'digest{i}', email=f'digest{i}@example.com', full_name=f'Student {i}')
+            for i in range(3)
+        ]
+
+    # Test that enrollments are buffered and sent as one email and one real-time event
+    def test_enrollments_are_digested(self):
+        channel = self.listen(notification_group_name(self.teacher.username))
+        for student in self.students:
+            Enrollment.objects.create(student=student, course=self.course)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(DigestEntry.objects.filter(recipient=self.teacher).count(), 3)
+
+        self.assertEqual(flush_notification_digests(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].body.count('Digest Course'), 3)
+        self.assertEqual(self.receive(channel)['message'], '3 student(s) enrolled in your courses.')
+        self.assertFalse(DigestEntry.objects.exists())
+        self.assertEqual(flush_notification_digests(), 0)
+
+    # Test that the entries of a digest whose email fails are kept for the next attempt
+    def test_failed_digest_keeps_entries(self):
+        for student in self.students:
+            Enrollment.objects.create(student=student, course=self.course)
+        with mock.patch('eLearningApp.digests.send_mail', side_effect=SMTPException('Connection dropped')):
+            with self.assertRaises(SMTPException):
+                send_digest(self.teacher.pk)
+        self.assertEqual(DigestEntry.objects.filter(recipient=self.teacher).count(), 3)
+        self.assertEqual(send_digest(self.teacher.pk), 3)
+        self.assertEqual(mail.outbox[0].body.count('Student'), 3)
+        self.assertFalse(DigestEntry.objects.exists())
+
+    # Test that teachers get one email per enrollment unless they opted in to digests
+    def test_immediate_mode(self):
+        self.assertEqual(get_user_model()._meta.get_field('notification_mode').default, get_user_model().IMMEDIATE)
+        self.teacher.notification_mode = get_user_model().IMMEDIATE
+        self.teacher.save()
+        for student in self.students:
+            Enrollment.objects.create(student=student, course=Course.objects.get(pk=self.course.pk))
+        self.relay()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(DigestEntry.objects.exists())
+
+
+# Fragment cache testing
+@override_settings(FRAGMENT_CACHE_STATS=True)
+class FragmentCacheTests(EnrolledCourseTestCase):
+    # Helper to render the course page as a student and return the response with its query count
+    def view_course(self):
+        self.client.force_login(self.students[0])
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('course_detail', args=[self.course.id]))
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    # Test that cached fragments skip their queries and are rendered again once a material is added
+    def test_fragments_cached_until_changed(self):
+        _, cold = self.view_course()
+        _, warm = self.view_course()
+        self.assertLess(warm, cold)
+        CourseMaterial.objects.create(course=self.course, name='Fresh Slides', file='course_materials/fresh.pdf')
+        response, _ = self.view_course()
+        self.assertContains(response, 'Fresh Slides')
+        self.assertContains(response, '1 material(s)')
+
+    # Test that only the first page of the status feed is cached, so client cursors cannot fill the cache
+    @override_settings(LISTING_PAGE_SIZE=1)
+    def test_status_feed_pages_are_not_cached(self):
+        for text in ('Older news', 'Latest news'):
+            Status.objects.create(user=self.teacher, text=text)
+        self.client.force_login(self.teacher)
+        first = self.client.get(reverse('home', args=[self.teacher.username]))
+        cursor = first.context['status_updates'].next_cursor
+        self.assertContains(self.client.get(reverse('home', args=[self.teacher.username]), {'cursor': cursor}), 'Older news')
+        for cursor in ('forged-1', 'forged-2'):
+            self.client.get(reverse('home', args=[self.teacher.username]), {'cursor': cursor})
+        self.assertEqual(fragment_stats()['status_feed'], {'hits': 0, 'misses': 1, 'hit_rate': 0.0})
+
+    # Test that the stats endpoint reports hits and misses to staff only
+    def test_stats_endpoint(self):
+        self.view_course()
+        self.view_course()
+        self.client.force_login(self.students[0])
+        self.assertEqual(self.client.get(reverse('api_cache_stats')).status_code, status.HTTP_403_FORBIDDEN)
+        admin = get_user_model().objects.create_superuser(username='cacheadmin', email='cacheadmin@example.com', password='AdminPass123')
+        self.client.force_login(admin)
+        stats = self.client.get(reverse('api_cache_stats')).data
+        self.assertEqual(stats['course_materials'], {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+
+# Course material download testing
+@override_settings(MATERIAL_DOWNLOAD_CHUNK_SIZE=4)
+class MaterialDownloadTests(EnrolledCourseTestCase):
+    CONTENT = b'0123456789abcdefghij'
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.material = CourseMaterial.objects.create(
+            course=self.course, name='Lecture', file=SimpleUploadedFile('lecture.pdf', self.CONTENT)
+        )
+        self.url = reverse('download_material', args=[self.material.id])
+        self.client.force_login(self.students[0])
+
+    # Test that the whole file is streamed with its validators, and revalidation returns 304
+    def test_full_download_and_revalidation(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    # Test resumable downloads with Range and If-Range
+    def test_range_requests(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'56789')
+        self.assertEqual(response['Content-Range'], 'bytes 5-9/20')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'hij')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=50-').status_code, 416)
+
+    # Test that outsiders are refused and that the transfer can be offloaded to nginx
+    def test_access_and_offload(self):
+        outsider = get_user_model().objects.create_user(username='nosy', email='nosy@example.com')
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(self.teacher)
+        with self.settings(MATERIAL_DOWNLOAD_OFFLOAD='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.material.file.name)
+        self.assertEqual(response.content, b'')
+
+
+# Chunked material upload testing
+@override_settings(MATERIAL_UPLOAD_CHUNK_SIZE=4)
+class MaterialUploadTests(EnrolledCourseTestCase):
+    CONTENT = b'A long lecture recording, in pieces.'
+
+    def setUp(self):
+        super().setUp()
+        for name in ('MEDIA_ROOT', 'MATERIAL_UPLOAD_TEMP_DIR'):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            override = override_settings(**{name: directory.name})
+            override.enable()
+            self.addCleanup(override.disable)
+        self.client.force_login(self.teacher)
+
+    # Helper to start an upload of CONTENT with the given checksum and return its id
+    def start(self, sha256=None):
+        response = self.client.post(reverse('api_upload_start', args=[self.course.id]), {
+            'name': 'Recording', 'filename': 'recording.mp4', 'size': len(self.CONTENT),
+            'sha256': sha256 or hashlib.sha256(self.CONTENT).hexdigest(),
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    # Helper to send one chunk at an offset
+    def put(self, upload_id, offset, data):
+        return self.client.put(
+            reverse('api_upload', args=[upload_id]), data, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    # Test an interrupted upload resumed from the stored offset, which creates the material once finalized
+    def test_resumed_upload_creates_material(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, 0, self.CONTENT[:10]).data['received'], 10)
+        # A retried chunk at the wrong offset is refused with the offset to resume from
+        response = self.put(upload_id, 4, self.CONTENT[4:10])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['received'], 10)
+        received = self.client.get(reverse('api_upload', args=[upload_id])).data['received']
+        self.put(upload_id, received, self.CONTENT[received:])
+
+        response = self.client.post(reverse('api_upload_finalize', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(OutboxMessage.objects.filter(task__endswith='material_notification').count(), 2)
+        material = CourseMaterial.objects.get(pk=response.data['id'])
+        with material.file.open('rb') as file:
+            self.assertEqual(file.read(), self.CONTENT)
+        self.assertFalse(MaterialUpload.objects.exists())
+        self.assertEqual(os.listdir(settings.MATERIAL_UPLOAD_TEMP_DIR), [])
+
+    # Test that a file that does not match its checksum is discarded without creating a material
+    def test_checksum_mismatch_discards_upload(self):
+        upload_id = self.start(sha256='0' * 64)
+        self.put(upload_id, 0, self.CONTENT)
+        response = self.client.post(reverse('api_upload_finalize', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(CourseMaterial.objects.exists())
+        self.assertFalse(MaterialUpload.objects.exists())
+
+    # Test that a finalize failing to create the material leaves no stored file and can be retried
+    def test_failed_finalize_can_be_retried(self):
+        upload_id = self.start()
+        self.put(upload_id, 0, self.CONTENT)
+        with mock.patch.object(CourseMaterial, 'save', side_effect=OperationalError('connection lost')):
+            with self.assertRaises(OperationalError):
+                self.client.post(reverse('api_upload_finalize', args=[upload_id]))
+        self.assertEqual([files for _, _, files in os.walk(settings.MEDIA_ROOT) if files], [])
+        self.assertIsNone(MaterialUpload.objects.get(pk=upload_id).writer)
+
+        # A finalize already running is refused
+        MaterialUpload.objects.filter(pk=upload_id).update(writer=uuid.uuid4(), claimed_at=timezone.now())
+        response = self.client.post(reverse('api_upload_finalize', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        MaterialUpload.objects.filter(pk=upload_id).update(writer=None, claimed_at=None)
+
+        response = self.client.post(reverse('api_upload_finalize', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with CourseMaterial.objects.get(pk=response.data['id']).file.open('rb') as file:
+            self.assertEqual(file.read(), self.CONTENT)
+        self.assertEqual(os.listdir(settings.MATERIAL_UPLOAD_TEMP_DIR), [])
+
+    # Test that chunks past the declared size and uploads by other users are refused
+    def test_upload_limits(self):
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, 0, self.CONTENT + b'!').status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_login(self.students[0])
+        self.assertEqual(self.put(upload_id, 0, self.CONTENT).status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(reverse('api_upload_start', args=[self.course.id]), {}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    # Test that a chunk is refused while another request writes one, until that claim expires
+    def test_concurrent_chunk_is_refused(self):
+        upload_id = self.start()
+        MaterialUpload.objects.filter(pk=upload_id).update(writer=uuid.uuid4(), claimed_at=timezone.now())
+        response = self.put(upload_id, 0, self.CONTENT)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['received'], 0)
+
+        MaterialUpload.objects.filter(pk=upload_id).update(claimed_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(self.put(upload_id, 0, self.CONTENT).data['received'], len(self.CONTENT))
+        self.assertIsNone(MaterialUpload.objects.get(pk=upload_id).writer)
+        # A refused chunk releases its claim
+        upload_id = self.start()
+        self.assertEqual(self.put(upload_id, 0, self.CONTENT + b'!').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(MaterialUpload.objects.get(pk=upload_id).writer)
+
+
+# Profile photo processing testing
+class ProfilePhotoTests(SideEffectTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    # Helper to build an uploaded JPEG carrying EXIF metadata
+    def upload(self, color='red', size=(800, 600)):
+        from PIL import Image
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera Maker'
+        buffer = io.BytesIO()
+        Image.new('RGB', size, color).save(buffer, format='JPEG', exif=exif.tobytes())
+        return SimpleUploadedFile('upload.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    # Test that an uploaded photo is replaced by hashed, metadata free files and thumbnails
+    def test_photo_is_processed_in_background(self):
+        from PIL import Image
+        user = get_user_model().objects.create_user(username='photouser', email='photouser@example.com', photo=self.upload())
+        self.relay()
+        uploaded = 'profile_photos/upload.jpg'
+        user.refresh_from_db()
+        self.assertRegex(user.photo.name, rf'^profile_photos/{user.pk}-[0-9a-f]{{16}}\.webp$')
+        self.assertFalse(user.photo.storage.exists(uploaded))
+        with Image.open(user.photo_small.path) as small:
+            self.assertEqual((small.format, small.size), ('WEBP', (64, 64)))
+            self.assertEqual(len(small.getexif()), 0)
+        with Image.open(user.photo_large.path) as large:
+            self.assertEqual(large.size, (300, 300))
+        self.assertEqual(user.small_photo_url, user.photo_small.url)
+
+    # Test that replacing a photo deletes the files of the previous one in the background
+    def test_replaced_photo_files_are_deleted(self):
+        user = get_user_model().objects.create_user(username='photouser', email='photouser@example.com', photo=self.upload())
+        self.relay()
+        user.refresh_from_db()
+        old_files = [user.photo.path, user.photo_small.path, user.photo_large.path]
+        user.photo = self.upload(color='blue')
+        user.save()
+        self.relay()
+        user.refresh_from_db()
+        self.assertTrue(os.path.exists(user.photo_small.path))
+        for path in old_files:
+            self.assertFalse(os.path.exists(path))
+
+
+# New material email delivery testing
+@override_settings(MATERIAL_EMAIL_BATCH_SIZE=2)
+class MaterialEmailTests(EnrolledCourseTestCase):
+    # Test that every student gets a separate email, sent in batches
+    def test_emails_are_batched_per_recipient(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(send_material_notification(self.course.id), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            sorted(address for message in mail.outbox for address in message.to),
+            sorted(student.email for student in self.students),
+        )
+
+    # Test that a batch failing midway only retries the recipients not reached yet, and counts the emails sent
+    def test_failed_batch_retries_unsent_recipients(self):
+        send_messages = LocmemEmailBackend.send_messages
+        calls = []
+
+        def flaky_send(backend, messages):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise SMTPException('Connection dropped')
+            return send_messages(backend, messages)
+
+        with mock.patch.object(LocmemEmailBackend, 'send_messages', autospec=True, side_effect=flaky_send):
+            send_material_notification(self.course.id)
+        # Five deliveries plus the failed one, nobody was sent the email twice
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(
+            sorted(address for message in mail.outbox for address in message.to),
+            sorted(student.email for student in self.students),
+        )
+        self.assertEqual(task_metrics()[send_material_email_batch.name]['items'], 5)
+
+    # Test that a course without students sends nothing
+    def test_no_students_no_emails(self):
+        Enrollment.objects.all().delete()
+        self.assertEqual(send_material_notification(self.course.id), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+# Cached permission backend testing
+class PermissionCacheTests(TestCase):
+    PERMISSION = 'eLearningApp.can_create_course'
+
+    def setUp(self):
+        cache.clear()
+        self.teacher = get_user_model().objects.create_user(
+            username='permteacher',
+            email='permteacher@example.com',
+            password='TeacherPass123',
+            role='teacher',
+        )
+        self.permission = Permission.objects.get(codename='can_create_course')
+
+    # Helper to load a user the way each request does
+    def fresh(self, user):
+        return get_user_model().objects.get(pk=user.pk)
+
+    # Test that permission checks cost no queries once the cache is warm
+    def test_steady_state_costs_no_queries(self):
+        self.assertTrue(self.fresh(self.teacher).has_perm(self.PERMISSION))
+        user = self.fresh(self.teacher)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm(self.PERMISSION))
+
+    # Test that removing a permission is visible immediately
+    def test_removing_permission_invalidates_cache(self):
+        self.assertTrue(self.fresh(self.teacher).has_perm(self.PERMISSION))
+        self.teacher.user_permissions.remove(self.permission)
+        self.assertFalse(self.fresh(self.teacher).has_perm(self.PERMISSION))
+
+    # Test that permissions granted through a group are visible immediately
+    def test_group_permission_change_invalidates_cache(self):
+        student = get_user_model().objects.create_user(
+            username='permstudent',
+            email='permstudent@example.com',
+            password='StudentPass123',
+        )
+        group = Group.objects.create(name='Assistants')
+        student.groups.add(group)
+        self.assertFalse(self.fresh(student).has_perm(self.PERMISSION))
+        group.permissions.add(self.permission)
+        self.assertTrue(self.fresh(student).has_perm(self.PERMISSION))
+
+
+# Cached session and authenticated user testing
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches['sessions'].clear()
+        self.user = get_user_model().objects.create_user(
+            username='sessionuser',
+            email='sessionuser@example.com',
+            password='SessionPass123',
+            full_name='Session User',
+        )
+        self.client.login(username='sessionuser', password='SessionPass123')
+
+    # Helper to resolve the user of the logged in session the way AuthenticationMiddleware does
+    def session_user(self):
+        request = RequestFactory().get('/')
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore(
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        )
+        return get_session_user(request)
+
+    # Test that resolving the session and the user costs no queries once cached
+    def test_steady_state_costs_no_queries(self):
+        self.assertEqual(self.session_user(), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.session_user().username, 'sessionuser')
+
+    # Test that saving the user drops the cached row
+    def test_saved_user_is_reloaded(self):
+        self.session_user()
+        self.user.full_name = 'Renamed User'
+        self.user.save()
+        self.assertEqual(self.session_user().full_name, 'Renamed User')
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.session_user().is_authenticated)
+
+
+# Minimal WebSocket test client driving a consumer through the ASGI interface
+class WebsocketClient(ApplicationCommunicator):
+    def __init__(self, consumer, path, user, url_kwargs, subprotocols=()):
+        super().__init__(consumer.as_asgi(), {
+            'type': 'websocket',
+            'path': path,
+            'headers': [],
+            'subprotocols': list(subprotocols),
+            'user': user,
+            'url_route': {'args': (), 'kwargs': url_kwargs},
+        })
+
+    async def connect(self):
+        await self.send_input({'type': 'websocket.connect'})
+        return await self.receive_output(1)
+
+    async def send_json_to(self, data):
+        await self.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def receive_json_from(self):
+        return json.loads((await self.receive_output(1))['text'])
+
+    async def disconnect(self):
+        await self.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await self.wait(1)
+
+
+# Base class for chat consumer tests, connecting enrolled students to the course chat room
+@override_settings(CHAT_REDIS_URL='', CHAT_WRITE_INTERVAL=60, CHAT_PRESENCE_INTERVAL_MS=60000)
+class ChatTestCase(EnrolledCourseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.students[0]
+        self.addCleanup(presence.pending.clear)
+        # The writer is shared by the process, start without messages left by other tests
+        message_writer.pending = []
+        message_writer.retrying = False
+
+    # Helper to open a chat connection to the course room
+    async def connect(self, user=None, subprotocols=(), course=None):
+        course = course or self.course
+        communicator = WebsocketClient(
+            ChatConsumer, f'/ws/chat/{course.id}/', user or self.user, {'course_id': str(course.id)}, subprotocols
+        )
+        response = await communicator.connect()
+        self.assertEqual(response['type'], 'websocket.accept')
+        return communicator
+
+
+# Chat history persistence and replay testing
+@override_settings(CHAT_HISTORY_SIZE=3)
+class ChatHistoryTests(ChatTestCase):
+    # Test that messages are written in one batch, not one insert per message
+    async def test_messages_are_persisted_in_batches(self):
+        communicator = await self.connect()
+        for i in range(4):
+            await communicator.send_json_to({'message': f'Hello {i}'})
+            await communicator.receive_json_from()
+        self.assertEqual(await ChatMessage.objects.acount(), 0)
+        self.assertEqual(await message_writer.flush(), 4)
+        self.assertEqual(await ChatMessage.objects.filter(room=str(self.course.id)).acount(), 4)
+        await communicator.disconnect()
+
+    # Test that a failed batch is saved one message at a time, keeping the messages the database could not take yet
+    async def test_failed_batch_is_not_lost(self):
+        room = str(self.course.id)
+        first = ChatMessage(room=room, author=self.user, text='First')
+        await ChatMessage.objects.acreate(room=room, author=self.user, text='Saved before', uid=first.uid)
+        messages = [first] + [ChatMessage(room=room, author=self.user, text=f'Hello {i}') for i in range(3)]
+        for message in messages:
+            message_writer.add(message)
+        outage = OperationalError('database is locked')
+        save = ChatMessage.save
+
+        # The database goes away while the third message is saved
+        def save_until_outage(message, *args, **kwargs):
+            if message.text == 'Hello 1':
+                raise outage
+            return save(message, *args, **kwargs)
+
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=outage), \
+                mock.patch.object(ChatMessage, 'save', autospec=True, side_effect=save_until_outage):
+            self.assertEqual(await message_writer.flush(), 1)
+        # The duplicate is dropped, the message that hit the outage and the ones after it are kept
+        self.assertEqual([message.text for message in message_writer.pending], ['Hello 1', 'Hello 2'])
+        self.assertEqual(await message_writer.flush(), 2)
+        self.assertEqual(await ChatMessage.objects.filter(room=room, text__startswith='Hello').acount(), 3)
+        self.assertFalse(await ChatMessage.objects.filter(text='First').aexists())
+
+    # Test that a new connection receives the latest messages before anything else
+    async def test_latest_messages_are_replayed_on_join(self):
+        communicator = await self.connect()
+        for i in range(4):
+            await communicator.send_json_to({'message': f'Hello {i}'})
+            await communicator.receive_json_from()
+        await message_writer.flush()
+        await communicator.disconnect()
+
+        communicator = await self.connect()
+        replayed = [await communicator.receive_json_from() for _ in range(3)]
+        self.assertEqual([event['text'] for event in replayed], ['Hello 1', 'Hello 2', 'Hello 3'])
+        self.assertEqual(replayed[0]['username'], self.user.username)
+        await communicator.disconnect()
+
+    # Test that a message is delivered as a structured event carrying its stored id
+    async def test_messages_use_structured_events(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'chat.message', 'text': 'Hi there'})
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['type'], 'chat.message')
+        self.assertEqual(event['user_id'], self.user.pk)
+        self.assertEqual(event['text'], 'Hi there')
+        self.assertIsInstance(event['ts'], int)
+        await message_writer.flush()
+        self.assertTrue(await ChatMessage.objects.filter(uid=event['id']).aexists())
+        await communicator.disconnect()
+
+    # Test that clients negotiating the msgpack subprotocol receive binary frames
+    async def test_msgpack_subprotocol(self):
+        communicator = WebsocketClient(
+            ChatConsumer, f'/ws/chat/{self.course.id}/', self.user, {'course_id': str(self.course.id)}, ['msgpack']
+        )
+        response = await communicator.connect()
+        self.assertEqual(response['subprotocol'], 'msgpack')
+        await communicator.send_input({'type': 'websocket.receive', 'bytes': msgpack.packb({'text': 'Packed'})})
+        frame = await communicator.receive_output(1)
+        self.assertEqual(msgpack.unpackb(frame['bytes'])['text'], 'Packed')
+        await communicator.disconnect()
+
+
+# Chat presence testing
+class ChatPresenceTests(ChatTestCase):
+    # Helper to connect three enrolled students to the room
+    async def connect_all(self):
+        return [await self.connect(student) for student in self.students[:3]]
+
+    # Test that a burst of joins is announced to each member as a single delta
+    async def test_joins_are_coalesced(self):
+        communicators = await self.connect_all()
+        for communicator in communicators:
+            self.assertTrue(await communicator.receive_nothing(0.05))
+        await presence.flush(str(self.course.id))
+        for communicator in communicators:
+            event = await communicator.receive_json_from()
+            self.assertEqual(event['type'], 'presence.delta')
+            self.assertEqual(event['joined'], ['fanout0', 'fanout1', 'fanout2'])
+            self.assertTrue(await communicator.receive_nothing(0.05))
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    # Test that the presence query returns the current roster
+    async def test_presence_query_returns_roster(self):
+        communicators = await self.connect_all()
+        await communicators[-1].disconnect()
+        await communicators[0].send_json_to({'type': 'presence'})
+        event = await communicators[0].receive_json_from()
+        self.assertEqual(event['members'], ['fanout0', 'fanout1'])
+        for communicator in communicators[:-1]:
+            await communicator.disconnect()
+
+
+    # Test that a user with two connections stays in the room until both are closed
+    async def test_user_stays_while_connected_elsewhere(self):
+        room = str(self.course.id)
+        first, second = await self.connect(), await self.connect()
+        # A presence query is answered once the connection has joined the room
+        for communicator in (first, second):
+            await communicator.send_json_to({'type': 'presence'})
+            self.assertEqual((await communicator.receive_json_from())['members'], ['fanout0'])
+        self.assertEqual((await presence.flush(room))['joined'], ['fanout0'])
+        for communicator in (first, second):
+            self.assertEqual((await communicator.receive_json_from())['type'], 'presence.delta')
+        await first.disconnect()
+        self.assertIsNone(await presence.flush(room))
+        await second.send_json_to({'type': 'presence'})
+        self.assertEqual((await second.receive_json_from())['members'], ['fanout0'])
+        await second.disconnect()
+        self.assertEqual((await presence.flush(room))['left'], ['fanout0'])
+
+
+# Chat room authorization and rate limit testing
+class ChatAuthorizationTests(ChatTestCase):
+    # Helper to attempt a connection and return the first message sent back
+    async def attempt(self, user):
+        communicator = WebsocketClient(
+            ChatConsumer, f'/ws/chat/{self.course.id}/', user, {'course_id': str(self.course.id)}
+        )
+        return await communicator.connect()
+
+    # Test that anonymous sockets are rejected before joining the room group
+    async def test_anonymous_user_is_rejected(self):
+        response = await self.attempt(AnonymousUser())
+        self.assertEqual(response, {'type': 'websocket.close', 'code': 4401})
+        self.assertNotIn(f'chat_{self.course.id}', get_channel_layer().groups)
+
+    # Test that users outside the course are rejected
+    async def test_non_member_is_rejected(self):
+        outsider = await get_user_model().objects.acreate(username='outsider', email='outsider@example.com')
+        response = await self.attempt(outsider)
+        self.assertEqual(response, {'type': 'websocket.close', 'code': 4403})
+
+    # Test that the instructor may join the room
+    async def test_instructor_is_accepted(self):
+        communicator = await self.connect(self.teacher)
+        await communicator.disconnect()
+
+    # Test that frames beyond the burst allowance are dropped
+    @override_settings(CHAT_RATE_LIMIT=0.001, CHAT_RATE_BURST=2)
+    async def test_rate_limit(self):
+        communicator = await self.connect()
+        for i in range(2):
+            await communicator.send_json_to({'text': f'Message {i}'})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'chat.message')
+        await communicator.send_json_to({'text': 'One too many'})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'error', 'code': 'rate_limited'})
+        await communicator.disconnect()
+
+
+# Search index testing for users and courses
+@override_settings(LISTING_PAGE_SIZE=2)
+class SearchTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.teacher = User.objects.create_user(
+            username='searchteacher', email='searchteacher@example.com', password='TeacherPass123',
+            full_name='Grace Hopper', role='teacher',
+        )
+        self.student = User.objects.create_user(
+            username='searchstudent', email='searchstudent@example.com', password='StudentPass123',
+            full_name='Alan Turing',
+        )
+        self.python = Course.objects.create(title='Python Programming', description='Learn python basics', instructor=self.teacher)
+        self.databases = Course.objects.create(title='Databases', description='Indexes and python drivers', instructor=self.teacher)
+
+    # Test that saves and deletes keep the index current
+    def test_index_follows_changes(self):
+        self.assertEqual(search(SearchTerm.USER, 'alan')[0], [self.student])
+        # Email domains would match every user, emails are not indexed
+        self.assertEqual(search(SearchTerm.USER, 'example')[0], [])
+        self.student.full_name = 'Ada Lovelace'
+        self.student.save()
+        self.assertEqual(search(SearchTerm.USER, 'alan')[0], [])
+        self.assertEqual(search(SearchTerm.USER, 'lovel')[0], [self.student])
+        self.student.delete()
+        self.assertFalse(SearchTerm.objects.filter(kind=SearchTerm.USER, term='lovelace').exists())
+
+    # Test that every query term must match and title matches rank above description matches
+    def test_ranked_prefix_search(self):
+        self.assertEqual(search(SearchTerm.COURSE, 'pyth')[0], [self.python, self.databases])
+        self.assertEqual(search(SearchTerm.COURSE, 'python index')[0], [self.databases])
+        self.assertEqual(search(SearchTerm.COURSE, 'python missing')[0], [])
+        self.assertEqual(rebuild_index(SearchTerm.COURSE), 2)
+        self.assertEqual(search(SearchTerm.COURSE, 'pyth')[0], [self.python, self.databases])
+
+    # Test the search API, where only teachers may search users
+    def test_search_api(self):
+        self.client.force_login(self.student)
+        response = self.client.get(reverse('api_search'), {'q': 'python', 'type': 'courses'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([course['id'] for course in response.data['results']], [self.python.id, self.databases.id])
+        response = self.client.get(reverse('api_search'), {'q': 'grace', 'type': 'users'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_login(self.teacher)
+        response = self.client.get(reverse('api_search'), {'q': 'alan tur', 'type': 'users'})
+        self.assertEqual([user['username'] for user in response.data['results']], ['searchstudent'])
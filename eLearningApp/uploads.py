@@ -0,0 +1,195 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from .models import CourseMaterial, MaterialUpload
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+# Error raised for an upload request that cannot be applied
+class UploadError(ValueError):
+    pass
+
+
+# Error raised when a chunk does not start where the upload left off
+# The client resumes from `offset`, the number of bytes already stored
+class UploadOffsetError(UploadError):
+    def __init__(self, offset):
+        super().__init__(f'The next chunk must start at offset {offset}.')
+        self.offset = offset
+
+
+# Disk file of a finalized upload
+# Storages move files exposing temporary_file_path() into place instead of copying them
+class _UploadedPart(File):
+    def temporary_file_path(self):
+        return self.file.name
+
+
+# Path of the partial file of an upload
+def upload_path(upload):
+    return os.path.join(settings.MATERIAL_UPLOAD_TEMP_DIR, f'{upload.pk}.part')
+
+
+# Register a new upload of a course material and create its empty partial file
+def start_upload(course, uploader, name, filename, size, sha256):
+    if not name or not filename:
+        raise UploadError('A name and a filename are required.')
+    if not isinstance(size, int) or not 0 < size <= settings.MATERIAL_UPLOAD_MAX_SIZE:
+        raise UploadError(f'The size must be between 1 and {settings.MATERIAL_UPLOAD_MAX_SIZE} bytes.')
+    sha256 = str(sha256).lower()
+    if not SHA256_PATTERN.match(sha256):
+        raise UploadError('The sha256 checksum must be 64 hexadecimal characters.')
+
+    upload = MaterialUpload.objects.create(
+        course=course, uploader=uploader, name=name[:255], size=size, sha256=sha256,
+        filename=get_valid_filename(os.path.basename(filename))[:255],
+    )
+    os.makedirs(settings.MATERIAL_UPLOAD_TEMP_DIR, exist_ok=True)
+    open(upload_path(upload), 'wb').close()
+    return upload
+
+
+# Claim an upload for writing the chunk starting at offset, in a single conditional UPDATE
+# Fails when the offset is not the number of bytes received or another request is writing,
+# unless its claim is older than MATERIAL_UPLOAD_CLAIM_TIMEOUT
+def _claim(upload_id, offset):
+    writer = uuid.uuid4()
+    now = timezone.now()
+    expired = now - timedelta(seconds=settings.MATERIAL_UPLOAD_CLAIM_TIMEOUT)
+    claimed = MaterialUpload.objects.filter(
+        Q(writer__isnull=True) | Q(claimed_at__lt=expired), pk=upload_id, received=offset,
+    ).update(writer=writer, claimed_at=now, updated_at=now)
+    if not claimed:
+        raise UploadOffsetError(_received(upload_id))
+    return writer
+
+
+# Release a claim taken by _claim, unless another request took the upload over since
+def _release(upload_id, writer):
+    MaterialUpload.objects.filter(pk=upload_id, writer=writer).update(writer=None, claimed_at=None)
+
+
+# Number of bytes received by an upload, refusing uploads cancelled meanwhile
+def _received(upload_id):
+    received = MaterialUpload.objects.filter(pk=upload_id).values_list('received', flat=True).first()
+    if received is None:
+        raise UploadError('The upload was cancelled.')
+    return received
+
+
+# Append the body of a request to an upload, reading it in MATERIAL_UPLOAD_CHUNK_SIZE pieces
+# so memory use stays constant whatever the chunk size. The chunk must start at the current
+# offset, which makes retrying a chunk after an interruption safe. Returns the updated upload
+# No transaction or row lock is held while the body is streamed: the upload is claimed first,
+# and the offset only advances if the claim still holds once the chunk is on disk
+def write_chunk(upload_id, offset, stream):
+    upload = MaterialUpload.objects.get(pk=upload_id)
+    writer = _claim(upload_id, offset)
+    try:
+        remaining = upload.size - offset
+        with open(upload_path(upload), 'r+b') as part:
+            part.seek(offset)
+            # Drop anything a previous interrupted write left past the offset
+            part.truncate()
+            while True:
+                data = stream.read(min(settings.MATERIAL_UPLOAD_CHUNK_SIZE, remaining + 1))
+                if not data:
+                    break
+                if len(data) > remaining:
+                    raise UploadError('The chunk goes past the declared size of the file.')
+                part.write(data)
+                remaining -= len(data)
+    except BaseException:
+        # Release the claim, the next chunk truncates what was written past the offset
+        _release(upload_id, writer)
+        raise
+
+    upload.received = upload.size - remaining
+    upload.updated_at = timezone.now()
+    advanced = MaterialUpload.objects.filter(pk=upload_id, received=offset, writer=writer).update(
+        received=upload.received, writer=None, claimed_at=None, updated_at=upload.updated_at,
+    )
+    if not advanced:
+        # The claim expired and another request took the upload over
+        raise UploadOffsetError(_received(upload_id))
+    return upload
+
+
+# Verify a complete upload and turn it into a CourseMaterial
+# The row is created once the file is in place, so notify_students_on_new_material only runs for
+# verified files. An upload whose checksum does not match is discarded
+# The upload is claimed like a chunk write while the file is hashed and moved into the storage, so
+# the transaction only deletes the upload and creates the material. If it fails, the file is put
+# back as the partial file and the claim released, so finalizing can be retried
+def finalize_upload(upload_id):
+    upload = MaterialUpload.objects.select_related('course').get(pk=upload_id)
+    if upload.received != upload.size:
+        raise UploadOffsetError(upload.received)
+    try:
+        writer = _claim(upload_id, upload.size)
+    except UploadOffsetError as error:
+        if error.offset != upload.size:
+            raise
+        raise UploadError('The upload is already being finalized.')
+
+    path = upload_path(upload)
+    field = CourseMaterial._meta.get_field('file')
+    material = CourseMaterial(course=upload.course, name=upload.name)
+    try:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as part:
+            for data in iter(lambda: part.read(settings.MATERIAL_UPLOAD_CHUNK_SIZE), b''):
+                digest.update(data)
+        if digest.hexdigest() != upload.sha256:
+            abort_upload(upload)
+            raise UploadError('The checksum of the uploaded file does not match, the upload was discarded.')
+        with open(path, 'rb') as part:
+            material.file = field.storage.save(field.generate_filename(material, upload.filename), _UploadedPart(part))
+    except BaseException:
+        _release(upload_id, writer)
+        raise
+
+    try:
+        with transaction.atomic():
+            # The upload may have been cancelled, or taken over after the claim expired
+            if not MaterialUpload.objects.filter(pk=upload_id, writer=writer).delete()[0]:
+                raise UploadError('The upload was cancelled.')
+            material.save()
+    except BaseException:
+        if MaterialUpload.objects.filter(pk=upload_id, writer=writer).exists():
+            with field.storage.open(material.file.name, 'rb') as stored, open(path, 'wb') as part:
+                shutil.copyfileobj(stored, part, settings.MATERIAL_UPLOAD_CHUNK_SIZE)
+            _release(upload_id, writer)
+        field.storage.delete(material.file.name)
+        raise
+    if os.path.exists(path):
+        os.remove(path)
+    return material
+
+
+# Cancel an upload and delete its partial file
+def abort_upload(upload):
+    path = upload_path(upload)
+    upload.delete()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# Cancel the uploads that received nothing for the given time, returning how many were removed
+def purge_stale_uploads(older_than=timedelta(days=1)):
+    stale = MaterialUpload.objects.filter(updated_at__lt=timezone.now() - older_than)
+    count = 0
+    for upload in stale.iterator():
+        abort_upload(upload)
+        count += 1
+    return count
@@ -24,8 +24,9 @@ urlpatterns = [
     path('course/delete/<int:course_id>/', views.delete_course, name='delete_course'),  # URL for deleting a course
     path('courses/<int:course_id>/feedback/', views.leave_feedback, name='leave_feedback'),  # URL for leaving feedback on a course
     path('materials/delete/<int:material_id>/', views.delete_material, name='delete_material'),  # URL for deleting course material
+    path('materials/<int:material_id>/download/', views.download_material, name='download_material'),  # URL for downloading course material
     path('delete_feedback/<int:feedback_id>/', views.delete_feedback, name='delete_feedback'),  # URL for deleting feedback
-    path('chat/<str:room_name>/', views.room, name='room'),  # URL for accessing chat rooms
+    path('chat/<int:course_id>/', views.room, name='room'),  # URL for accessing the chat room of a course
     path('search/', views.user_search, name='user_search'),  # URL for searching users
     path('', views.user_login, name='login'),  # Default URL for user login
 
@@ -1,26 +1,343 @@
 from django.contrib.auth import login, logout, update_session_auth_hash
 from django.shortcuts import render, redirect, get_object_or_404
 from .forms import RegistrationForm, LoginForm, CourseForm, FeedbackForm, CourseMaterialForm, StatusForm, SearchForm, CustomUserUpdateForm, CourseUpdateForm
-from .models import Course, Enrollment, Feedback, CourseMaterial, Status, CustomUser
+from .models import Course, Enrollment, Feedback, CourseMaterial, Status, CustomUser, ChatMessage, SearchTerm, MaterialUpload, Notification
 from django.contrib.auth.decorators import login_required, permission_required
-from rest_framework import viewsets
+from rest_framework import viewsets, generics, views as api_views
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .serializers import CustomUserSerializer
-from django.http import HttpResponseForbidden
-from rest_framework.permissions import IsAdminUser
+from .serializers import CustomUserSerializer, CustomUserListSerializer, USER_READ_FIELDS, CourseSerializer, FeedbackSerializer, StatusSerializer, ChatMessageSerializer, UserSearchSerializer, MaterialUploadSerializer, NotificationSerializer, ActivityEventSerializer
+from .pagination import paginate_keyset, UserCursorPagination, CourseCursorPagination, NewestFirstCursorPagination, ChatMessageCursorPagination
+from django.http import HttpResponseForbidden, Http404
+from django.views.decorators.http import require_POST
+from django.utils.functional import SimpleLazyObject
+from django.utils.cache import get_conditional_response, patch_cache_control, set_response_etag
+from django.urls import reverse
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.status import HTTP_201_CREATED, HTTP_409_CONFLICT
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from .chat import is_course_member
+from .search import search
+from .downloads import serve_file
+from .fragments import fragment_versions, fragment_stats
+from .notifications import unread_count, mark_read
+from .metrics import task_metrics
+from .feed import read_timeline
+from .uploads import start_upload, write_chunk, finalize_upload, abort_upload, UploadError, UploadOffsetError
+from .enrollment import enroll, unenroll, bulk_enroll, parse_roster, RosterError
+import io
 import requests
 import os
+from django.conf import settings
 
 # CustomUserViewSet for API
+# Listings are cursor paginated and can be filtered with ?role= and ?is_active=
+# Reads only load and return the fields given with ?fields=, and answer 304 to a matching If-None-Match
 class CustomUserViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAdminUser]
     queryset = CustomUser.objects.all()
     serializer_class = CustomUserSerializer
+    pagination_class = UserCursorPagination
     lookup_field = 'id'
 
+    # Fields selected with ?fields=, all readable fields by default
+    def selected_fields(self):
+        requested = self.request.query_params.get('fields')
+        if not requested:
+            return USER_READ_FIELDS
+        names = {name.strip() for name in requested.split(',') if name.strip()}
+        unknown = names.difference(USER_READ_FIELDS)
+        if unknown:
+            raise ValidationError({'fields': f"Unknown fields: {', '.join(sorted(unknown))}."})
+        return [name for name in USER_READ_FIELDS if name in names]
+
+    def get_queryset(self):
+        queryset = CustomUser.objects.all()
+        if self.action == 'list':
+            role = self.request.query_params.get('role')
+            if role:
+                queryset = queryset.filter(role=role)
+            is_active = self.request.query_params.get('is_active')
+            if is_active is not None:
+                if is_active not in ('true', 'false'):
+                    raise ValidationError({'is_active': 'Must be true or false.'})
+                queryset = queryset.filter(is_active=is_active == 'true')
+        if self.request.method == 'GET':
+            # The id is always loaded for the url and the pagination cursor
+            columns = ['id', *(name for name in self.selected_fields() if name not in ('id', 'url'))]
+            queryset = queryset.values(*columns) if self.action == 'list' else queryset.only(*columns)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return CustomUserListSerializer
+        return CustomUserSerializer
+
     def get_serializer_context(self):
-        return {'request': self.request}
+        context = {'request': self.request}
+        if self.request.method == 'GET':
+            context['fields'] = self.selected_fields()
+            context['users_url'] = self.request.build_absolute_uri(reverse('users-list'))
+        return context
+
+    # Tag successful reads with an ETag of their content so clients can revalidate them
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+            return response
+        response.render()
+        set_response_etag(response)
+        patch_cache_control(response, private=True, no_cache=True)
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+# Cursor paginated course listing for API
+# Pass ?available=true to only list courses the current user is not enrolled in
+class CourseListAPIView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = CourseSerializer
+    pagination_class = CourseCursorPagination
+
+    def get_queryset(self):
+        queryset = Course.objects.select_related('instructor')
+        if self.request.query_params.get('available') == 'true':
+            queryset = queryset.exclude(enrollments__student=self.request.user)
+        return queryset
+
+
+# Cursor paginated feedback listing of a course for API
+class CourseFeedbackListAPIView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = FeedbackSerializer
+    pagination_class = NewestFirstCursorPagination
+
+    def get_queryset(self):
+        return Feedback.objects.filter(course_id=self.kwargs['course_id']).select_related('student')
+
+
+# Cursor paginated status update listing of a user for API
+class UserStatusListAPIView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = StatusSerializer
+    pagination_class = NewestFirstCursorPagination
+
+    def get_queryset(self):
+        return Status.objects.filter(user__username=self.kwargs['username']).select_related('user')
+
+
+# Cursor paginated chat history of a course for API, latest messages first
+class ChatMessageListAPIView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = ChatMessageSerializer
+    pagination_class = ChatMessageCursorPagination
+
+    def get_queryset(self):
+        course_id = self.kwargs['course_id']
+        if not is_course_member(self.request.user, course_id):
+            raise PermissionDenied("You are not a member of this course.")
+        return ChatMessage.objects.filter(room=str(course_id)).select_related('author')
+
+
+# Ranked search of users or courses for API
+# GET ?q=<query>&type=users|courses&page=<n>, searching users is limited to teachers and staff
+class SearchAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    SEARCH_TYPES = {
+        'users': (SearchTerm.USER, UserSearchSerializer),
+        'courses': (SearchTerm.COURSE, CourseSerializer),
+    }
+
+    def get(self, request):
+        search_type = request.query_params.get('type', 'courses')
+        if search_type not in self.SEARCH_TYPES:
+            raise ValidationError({'type': f"Must be one of: {', '.join(self.SEARCH_TYPES)}."})
+        if search_type == 'users' and not (request.user.is_staff or request.user.has_perm('eLearningApp.can_create_course')):
+            raise PermissionDenied("You do not have permission to search users.")
+
+        kind, serializer_class = self.SEARCH_TYPES[search_type]
+        queryset = Course.objects.select_related('instructor') if kind == SearchTerm.COURSE else None
+        page = _page_number(request)
+        results, has_next = search(kind, request.query_params.get('q', ''), page=page, queryset=queryset)
+        return Response({
+            'page': page,
+            'has_next': has_next,
+            'results': serializer_class(results, many=True).data,
+        })
+
+
+# Enrollment of the current user in a course for API
+# POST enrolls and DELETE unenrolls, both are idempotent and return the resulting state
+class EnrollmentAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, course_id):
+        course = get_object_or_404(Course, pk=course_id)
+        _, created = enroll(request.user, course)
+        return Response({'enrolled': True, 'changed': created})
+
+    def delete(self, request, course_id):
+        course = get_object_or_404(Course, pk=course_id)
+        deleted = unenroll(request.user, course)
+        return Response({'enrolled': False, 'changed': deleted})
+
+
+# Bulk enrollment of a roster in a course for API
+# POST a JSON list of usernames/emails (or {"students": [...]}), or upload a CSV or JSON file as `roster`
+class BulkEnrollmentAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, course_id):
+        course = get_object_or_404(Course, pk=course_id)
+        if not (request.user == course.instructor or request.user.is_staff):
+            raise PermissionDenied("Only the course teacher can enroll students.")
+
+        try:
+            roster = request.FILES.get('roster')
+            if roster is not None:
+                roster_format = 'json' if roster.name.lower().endswith('.json') else 'csv'
+                identifiers = parse_roster(roster.read(), roster_format)
+            else:
+                identifiers = parse_roster(request.data, 'json')
+        except RosterError as error:
+            raise ValidationError({'roster': str(error)})
+
+        report = bulk_enroll(course, identifiers)
+        return Response(report)
+
+
+# Cursor paginated notification inbox of the current user for API
+# Pass ?unread=true to only list unread notifications
+class NotificationListAPIView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = NotificationSerializer
+    pagination_class = NewestFirstCursorPagination
+
+    def get_queryset(self):
+        queryset = Notification.objects.filter(user=self.request.user)
+        if self.request.query_params.get('unread') == 'true':
+            queryset = queryset.filter(read=False)
+        return queryset
+
+
+# Activity feed of the current user for API, newest first
+# The next cursor is the id of the last event of the page
+class ActivityFeedAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        page = read_timeline(request.user.pk, request.query_params.get('cursor'))
+        return Response({
+            'next': page.next_cursor,
+            'results': ActivityEventSerializer(page, many=True).data,
+        })
+
+
+# Number of unread notifications of the current user for API
+class NotificationUnreadCountAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response({'unread_count': unread_count(request.user.pk)})
+
+
+# Mark notifications of the current user as read for API
+# Takes {"ids": [...]} to mark some of them, or no ids to mark all of them
+class NotificationReadAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        ids = request.data.get('ids')
+        if ids is not None and not (isinstance(ids, list) and all(isinstance(i, int) for i in ids)):
+            raise ValidationError({'ids': 'Must be a list of notification ids.'})
+        marked = mark_read(request.user.pk, ids)
+        return Response({'marked': marked, 'unread_count': unread_count(request.user.pk)})
+
+
+# Hit and miss counts of the page fragment cache for monitoring
+class FragmentCacheStatsAPIView(api_views.APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(fragment_stats())
+
+
+# Runs, failures and average runtime of each Celery task for monitoring
+class TaskMetricsAPIView(api_views.APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(task_metrics())
+
+
+# Upload of the current user, so nobody else can see or write to it
+def _own_upload(request, upload_id):
+    return get_object_or_404(MaterialUpload, pk=upload_id, uploader=request.user)
+
+
+# Start a chunked, resumable upload of a course material for API
+# POST {"name", "filename", "size", "sha256"}, then PUT the chunks and POST to finalize
+class MaterialUploadStartAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, course_id):
+        course = get_object_or_404(Course, pk=course_id)
+        if request.user != course.instructor:
+            raise PermissionDenied("Only the course teacher can upload materials.")
+        data = request.data
+        try:
+            upload = start_upload(
+                course, request.user, data.get('name'), data.get('filename'), data.get('size'), data.get('sha256', '')
+            )
+        except UploadError as error:
+            raise ValidationError({'detail': str(error)})
+        response = MaterialUploadSerializer(upload).data
+        response['chunk_size'] = settings.MATERIAL_UPLOAD_CHUNK_SIZE
+        return Response(response, status=HTTP_201_CREATED)
+
+
+# State, chunks and cancellation of an upload for API
+# GET returns the offset to resume from, PUT appends the raw request body at the Upload-Offset header
+class MaterialUploadAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id):
+        return Response(MaterialUploadSerializer(_own_upload(request, upload_id)).data)
+
+    def put(self, request, upload_id):
+        upload = _own_upload(request, upload_id)
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            raise ValidationError({'detail': 'The Upload-Offset header is required.'})
+        try:
+            upload = write_chunk(upload.pk, offset, request.stream or io.BytesIO())
+        except UploadOffsetError as error:
+            return Response({'detail': str(error), 'received': error.offset}, status=HTTP_409_CONFLICT)
+        except UploadError as error:
+            raise ValidationError({'detail': str(error)})
+        return Response(MaterialUploadSerializer(upload).data)
+
+    def delete(self, request, upload_id):
+        abort_upload(_own_upload(request, upload_id))
+        return Response({'detail': 'Upload cancelled.'})
+
+
+# Verify the checksum of a complete upload and create its course material for API
+class MaterialUploadFinalizeAPIView(api_views.APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        upload = _own_upload(request, upload_id)
+        try:
+            material = finalize_upload(upload.pk)
+        except MaterialUpload.DoesNotExist:
+            raise Http404("The upload was already finalized.")
+        except UploadOffsetError as error:
+            return Response({'detail': 'The upload is incomplete.', 'received': error.offset}, status=HTTP_409_CONFLICT)
+        except UploadError as error:
+            raise ValidationError({'detail': str(error)})
+        return Response({'id': material.id, 'name': material.name, 'course': material.course_id}, status=HTTP_201_CREATED)
 
 
 # Register function
@@ -81,10 +398,26 @@ def courses(request):
     else:
         # Prints out the enrolled and available to enroll courses
         enrolled_courses = Course.objects.filter(enrollments__student=request.user)
-        available_courses = Course.objects.exclude(enrollments__student=request.user)
-        context['enrolled_courses'] = enrolled_courses
+        # Newest courses first, or the most enrolled ones with ?sort=popular
+        sort = 'popular' if request.GET.get('sort') == 'popular' else 'newest'
+        available_courses = paginate_keyset(
+            Course.objects.exclude(enrollments__student=request.user).select_related('instructor'),
+            cursor=request.GET.get('cursor'),
+            ordering=('-enrollment_count', '-id') if sort == 'popular' else ('-id',),
+        )
+        context['sort'] = sort
+        context['enrolled_courses'] = enrolled_courses.select_related('instructor')
         context['available_courses'] = available_courses
 
+        # Ranked course search over titles and descriptions
+        query = request.GET.get('q', '').strip()
+        if query:
+            page = _page_number(request)
+            course_results, has_next = search(
+                SearchTerm.COURSE, query, page=page, queryset=Course.objects.select_related('instructor')
+            )
+            context.update({'query': query, 'course_results': course_results, 'page': page, 'has_next': has_next})
+
     return render(request, 'courses.html', context)
 
 
@@ -112,31 +445,35 @@ def home(request, username):
                 return redirect('home', username=home_user.username)
 
         elif 'update_profile' in request.POST and request.user.username == username:
-            old_photo = home_user.photo
             update_profile_form = CustomUserUpdateForm(request.POST, request.FILES, instance=home_user)
             if update_profile_form.is_valid():
-                # If a new photo is uploaded, delete the old photo from the file system
-                if 'photo' in request.FILES:
-                    if old_photo and old_photo != 'default.jpg':
-                        if os.path.isfile(old_photo.path):
-                            os.remove(old_photo.path)
+                # A new photo is resized and the old files are deleted in the background (see signals.py)
                 update_profile_form.save()
                 # Ensure the user does not get logged out after changing the password
                 update_session_auth_hash(request, home_user)
                 return redirect('home', username=home_user.username)
 
     if home_user.has_perm('eLearningApp.can_create_course'):
-        courses = Course.objects.filter(instructor=home_user)
+        courses = Course.objects.filter(instructor=home_user).select_related('instructor')
     else:
-        courses = Course.objects.filter(enrollments__student=home_user)
-    status_updates = Status.objects.filter(user=home_user).order_by('-created_at')
+        courses = Course.objects.filter(enrollments__student=home_user).select_related('instructor')
+    # The feed is only queried when its cached fragment needs rendering
+    status_updates = SimpleLazyObject(lambda: paginate_keyset(
+        Status.objects.filter(user=home_user).select_related('user'),
+        cursor=request.GET.get('cursor'),
+    ))
+    # The activity feed is precomputed per user and only shown to its owner
+    activity = SimpleLazyObject(lambda: read_timeline(home_user.pk, request.GET.get('activity_cursor')))
 
     context = {
         'home': home_user,
+        'fragments': fragment_versions(home_user.pk, 'status_feed'),
+        'is_owner': request.user == home_user,
         'status_form': status_form if request.user.username == username else None,
         'update_profile_form': update_profile_form if request.user.username == username else None,
         'courses': courses,
         'status_updates': status_updates,
+        'activity': activity if request.user == home_user else None,
     }
 
     return render(request, 'home.html', context)
@@ -145,7 +482,7 @@ def home(request, username):
 # Course Detail Function that only allows users that are logged in to view
 @login_required
 def course_detail(request, course_id):
-    course = get_object_or_404(Course, pk=course_id)
+    course = get_object_or_404(Course.objects.select_related('instructor'), pk=course_id)
     enrolled = Enrollment.objects.filter(student=request.user, course=course).exists()
 
     # Check if the current user is the teacher of the course or a student
@@ -153,7 +490,6 @@ def course_detail(request, course_id):
         # If the user is neither the course instructor nor a student, deny access
         return HttpResponseForbidden("You are not allowed to view this page.")
 
-    feedbacks = Feedback.objects.filter(course=course)
     feedback_form = FeedbackForm()
     upload_form = CourseMaterialForm()
     course_update_form = CourseUpdateForm(instance=course)
@@ -190,30 +526,46 @@ def course_detail(request, course_id):
                 course_update_form.save()
                 return redirect('course_detail', course_id=course.id)
 
+    # Each list the template renders costs one query, independent of the size of the course.
+    # Materials and the roster are only queried when their cached fragments need rendering
+    can_create_course = request.user.has_perm('eLearningApp.can_create_course')
+    materials = course.materials.all() if enrolled or can_create_course else CourseMaterial.objects.none()
+    enrollments = course.enrollments.select_related('student') if can_create_course else Enrollment.objects.none()
+    feedbacks = paginate_keyset(
+        Feedback.objects.filter(course=course).select_related('student'),
+        cursor=request.GET.get('cursor'),
+    )
+
     context = {
         'course': course,
         'enrolled': enrolled,
+        'materials': materials,
+        'enrollments': enrollments,
         'feedbacks': feedbacks,
         'feedback_form': feedback_form,
         'upload_form': upload_form,
         'course_update_form': course_update_form,
+        'can_create_course': can_create_course,
+        'fragments': fragment_versions(course.id, 'course_header', 'course_materials', 'course_roster'),
     }
     return render(request, 'course_detail.html', context)
 
 
 # Enroll in course function
 @login_required
+@require_POST
 def enroll_in_course(request, course_id):
     course = get_object_or_404(Course, pk=course_id)
-    Enrollment.objects.create(student=request.user, course=course)
+    enroll(request.user, course)
     return redirect('course_detail', course_id=course_id)
 
 
-# Enroll from course function
+# Unenroll from course function
 @login_required
+@require_POST
 def unenroll_from_course(request, course_id):
     course = get_object_or_404(Course, pk=course_id)
-    Enrollment.objects.filter(student=request.user, course=course).delete()
+    unenroll(request.user, course)
     return redirect('course_detail', course_id=course_id)
 
 
@@ -260,10 +612,30 @@ def delete_material(request, material_id):
     return redirect('course_detail', course_id=course_id)
 
 
-# Chat room function
+# Material download function that only allows the course teacher and enrolled students
+# Files are streamed in chunks with Range and ETag support so large downloads can be resumed
 @login_required
-def room(request, room_name):
-    return render(request, 'room.html', {'room_name': room_name})
+def download_material(request, material_id):
+    material = get_object_or_404(CourseMaterial.objects.only('file', 'course_id'), id=material_id)
+    if not is_course_member(request.user, material.course_id):
+        return HttpResponseForbidden("You are not allowed to download this material.")
+    try:
+        return serve_file(request, material.file)
+    except FileNotFoundError:
+        raise Http404("The material file is missing.")
+
+
+# Chat room function that only allows the course teacher and enrolled students
+@login_required
+def room(request, course_id):
+    course = get_object_or_404(Course, pk=course_id)
+    if not is_course_member(request.user, course.id):
+        return HttpResponseForbidden("You are not allowed to join this chat room.")
+    return render(request, 'room.html', {
+        'course': course,
+        # Heartbeats are sent twice per presence lifetime so a single lost one does not drop the user
+        'heartbeat_interval': settings.CHAT_PRESENCE_TTL * 1000 // 2,
+    })
 
 
 # Search function that only allows teachers to view
@@ -272,19 +644,33 @@ def room(request, room_name):
 def user_search(request):
     search_form = SearchForm()
     search_results = []
+    has_next = False
+    page = _page_number(request)
 
-    if request.method == 'POST':
-        search_form = SearchForm(request.POST)
+    # Searches are submitted with GET so the result pages can be linked
+    data = request.POST if request.method == 'POST' else request.GET
+    if 'query' in data:
+        search_form = SearchForm(data)
         if search_form.is_valid():
             query = search_form.cleaned_data['query']
-            search_results = CustomUser.objects.filter(username__icontains=query)
+            search_results, has_next = search(SearchTerm.USER, query, page=page)
 
     return render(request, 'user_search.html', {
         'search_form': search_form,
         'search_results': search_results,
+        'page': page,
+        'has_next': has_next,
     })
 
 
+# Page number of a search from the query string, defaulting to the first page
+def _page_number(request):
+    try:
+        return max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
+
 # Delete status function
 @login_required
 def delete_status(request, status_id):
@@ -3,8 +3,8 @@ from . import consumers
 
 #  WebSocket URL patterns for chat and notifications
 websocket_urlpatterns = [
-    # URL pattern for chat functionality
-    re_path(r'ws/chat/(?P<room_name>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    # URL pattern for chat functionality, one room per course
+    re_path(r'ws/chat/(?P<course_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
 
     # URL pattern for notifications
     re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),